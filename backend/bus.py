@@ -0,0 +1,412 @@
+"""Cross-worker session bus.
+
+Carries session output, input and membership events between uvicorn workers
+and records which worker owns each session's PTY, so a session can be viewed
+from any worker. Backends, picked by SESSION_BUS:
+
+    memory://                  this process only (default)
+    redis://[:password@]host:port[/db]
+    unix:///path/to/socket     the same RESP protocol over a unix socket
+
+Any server speaking RESP with PUBLISH/SUBSCRIBE, SET NX PX, GET, DEL and
+PEXPIRE works. For development, `python bus.py --port 6390` runs LocalBroker,
+a small stand-in implementing just those commands.
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import time
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1.0  # seconds between attempts after a lost connection
+
+Callback = Callable[[str, bytes], None]
+
+
+class BusError(Exception):
+    """Error reply from the server."""
+
+
+def encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts += [b"$%d\r\n" % len(data), data, b"\r\n"]
+    return b"".join(parts)
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, BusError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Read one RESP value. Error replies are returned, not raised, so a
+    pipelined caller gets them in order."""
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Bus connection closed")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    if prefix == b"-":
+        return BusError(rest.decode())
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected bus reply {line[:32]!r}")
+
+
+class InProcessBus:
+    """Delivers to subscribers in this process.
+
+    Several ConnectionManagers can share one instance to stand in for
+    separate workers.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, List[Callback]] = {}
+        self.keys: Dict[str, Tuple[str, float]] = {}  # key: (value, expires at)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self.subscribers.clear()
+
+    def publish(self, channel: str, payload: bytes):
+        loop = asyncio.get_running_loop()
+        for callback in self.subscribers.get(channel, ()):
+            loop.call_soon(callback, channel, payload)
+
+    def subscribe(self, channel: str, callback: Callback):
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel: str, callback: Callback):
+        callbacks = self.subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self.subscribers.pop(channel, None)
+
+    def _live(self, key: str) -> Optional[Tuple[str, float]]:
+        entry = self.keys.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self.keys[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._live(key)
+        return entry[0] if entry else None
+
+    async def claim(self, key: str, value: str, ttl: float) -> bool:
+        """Set key to value unless it is already held; expires after ttl seconds."""
+        if self._live(key):
+            return False
+        self.keys[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def refresh(self, key: str, value: str, ttl: float) -> bool:
+        """Extend a claim we still hold."""
+        entry = self._live(key)
+        if entry is None or entry[0] != value:
+            return False
+        self.keys[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def release(self, key: str, value: str):
+        entry = self._live(key)
+        if entry is not None and entry[0] == value:
+            del self.keys[key]
+
+
+class RedisBus:
+    """RESP client using one pipelined command connection and one subscriber
+    connection. Both reconnect on their own; anything published while a
+    connection is down is lost, as with Redis pub/sub in general.
+    """
+
+    def __init__(self, url: str):
+        self.url = urlparse(url)
+        self.subscribers: Dict[str, List[Callback]] = {}
+        self.pending: Deque[Optional[asyncio.Future]] = collections.deque()  # None: reply nobody waits for
+        self.reader = self.writer = None
+        self.sub_reader = self.sub_writer = None
+        self.tasks: List[asyncio.Task] = []
+        self.closed = False
+
+    async def _open(self):
+        if self.url.scheme == "unix":
+            reader, writer = await asyncio.open_unix_connection(self.url.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.url.hostname or "localhost", self.url.port or 6379)
+        setup = []
+        if self.url.password:
+            setup.append(("AUTH", self.url.password))
+        database = self.url.path.strip("/") if self.url.scheme != "unix" else ""
+        if database and database != "0":
+            setup.append(("SELECT", database))
+        for command in setup:
+            writer.write(encode_command(*command))
+            reply = await read_reply(reader)
+            if isinstance(reply, BusError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def start(self):
+        self.reader, self.writer = await self._open()
+        self.sub_reader, self.sub_writer = await self._open()
+        if self.subscribers:
+            self.sub_writer.write(encode_command("SUBSCRIBE", *self.subscribers))
+        self.tasks = [asyncio.create_task(self._read_replies()), asyncio.create_task(self._read_messages())]
+
+    async def close(self):
+        self.closed = True
+        for task in self.tasks:
+            task.cancel()
+        for writer in (self.writer, self.sub_writer):
+            if writer is not None:
+                writer.close()
+        self._fail_pending()
+
+    def _fail_pending(self):
+        while self.pending:
+            future = self.pending.popleft()
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError("Bus connection lost"))
+
+    async def _reconnect(self):
+        while not self.closed:
+            await asyncio.sleep(RECONNECT_DELAY)
+            try:
+                return await self._open()
+            except (OSError, BusError) as e:
+                logger.warning("Bus reconnect to %s failed: %s", self.url.geturl(), e)
+
+    async def _read_replies(self):
+        while not self.closed:
+            try:
+                while True:
+                    reply = await read_reply(self.reader)
+                    future = self.pending.popleft()
+                    if future is not None and not future.done():
+                        future.set_result(reply)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError, IndexError) as e:
+                logger.warning("Bus command connection lost: %s", e)
+                self.writer = None
+                self._fail_pending()
+                self.reader, self.writer = await self._reconnect() or (None, None)
+
+    async def _read_messages(self):
+        while not self.closed:
+            try:
+                while True:
+                    reply = await read_reply(self.sub_reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        channel = reply[1].decode()
+                        for callback in list(self.subscribers.get(channel, ())):
+                            try:
+                                callback(channel, reply[2])
+                            except Exception:
+                                logger.exception("Bus subscriber for %s failed", channel)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+                logger.warning("Bus subscriber connection lost: %s", e)
+                self.sub_writer = None
+                self.sub_reader, self.sub_writer = await self._reconnect() or (None, None)
+                if self.sub_writer is not None and self.subscribers:
+                    self.sub_writer.write(encode_command("SUBSCRIBE", *self.subscribers))
+
+    async def _command(self, *args):
+        if self.writer is None:
+            raise ConnectionError("Bus is not connected")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(encode_command(*args))
+        reply = await future
+        if isinstance(reply, BusError):
+            raise reply
+        return reply
+
+    def publish(self, channel: str, payload: bytes):
+        # Fire and forget; the receiver count reply is discarded in order
+        if self.writer is None:
+            return
+        self.pending.append(None)
+        self.writer.write(encode_command("PUBLISH", channel, payload))
+
+    def subscribe(self, channel: str, callback: Callback):
+        callbacks = self.subscribers.setdefault(channel, [])
+        if not callbacks and self.sub_writer is not None:
+            self.sub_writer.write(encode_command("SUBSCRIBE", channel))
+        callbacks.append(callback)
+
+    def unsubscribe(self, channel: str, callback: Callback):
+        callbacks = self.subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks and self.subscribers.pop(channel, None) is not None and self.sub_writer is not None:
+            self.sub_writer.write(encode_command("UNSUBSCRIBE", channel))
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._command("GET", key)
+        return value.decode() if value is not None else None
+
+    async def claim(self, key: str, value: str, ttl: float) -> bool:
+        return await self._command("SET", key, value, "NX", "PX", int(ttl * 1000)) == "OK"
+
+    async def refresh(self, key: str, value: str, ttl: float) -> bool:
+        # GET then PEXPIRE is not atomic; a claim lost in between is extended once
+        if await self.get(key) != value:
+            return False
+        return await self._command("PEXPIRE", key, int(ttl * 1000)) == 1
+
+    async def release(self, key: str, value: str):
+        if await self.get(key) == value:
+            await self._command("DEL", key)
+
+
+class LocalBroker:
+    """RESP server with pub/sub and expiring keys, standing in for Redis."""
+
+    NO_REPLY = object()  # (UN)SUBSCRIBE confirmations are written as they happen
+
+    def __init__(self):
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.keys: Dict[bytes, Tuple[bytes, Optional[float]]] = {}  # key: (value, expires at)
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: Optional[str] = None):
+        if path:
+            self.server = await asyncio.start_unix_server(self._client, path)
+        else:
+            self.server = await asyncio.start_server(self._client, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                request = await read_reply(reader)
+                if not isinstance(request, list) or not request:
+                    break
+                reply = self._execute(request[0].upper(), request[1:], writer, subscribed)
+                if reply is not self.NO_REPLY:
+                    writer.write(encode_reply(reply))
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels.get(channel, set()).discard(writer)
+            writer.close()
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        entry = self.keys.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.keys[key]
+            return None
+        return entry[0] if entry else None
+
+    def _execute(self, name: bytes, args: List[bytes], writer, subscribed: Set[bytes]):
+        if name == b"PING":
+            return "PONG"
+        if name in (b"AUTH", b"SELECT"):
+            return "OK"
+        if name == b"PUBLISH" and len(args) == 2:
+            receivers = self.channels.get(args[0], ())
+            message = encode_reply([b"message", args[0], args[1]])
+            for receiver in receivers:
+                receiver.write(message)
+            return len(receivers)
+        if name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+            for channel in args or list(subscribed):
+                if name == b"SUBSCRIBE":
+                    subscribed.add(channel)
+                    self.channels.setdefault(channel, set()).add(writer)
+                else:
+                    subscribed.discard(channel)
+                    self.channels.get(channel, set()).discard(writer)
+                writer.write(encode_reply([name.lower(), channel, len(subscribed)]))
+            return self.NO_REPLY
+        if name == b"SET" and len(args) >= 2:
+            options = [arg.upper() for arg in args[2:]]
+            expires = None
+            for unit, scale in ((b"PX", 0.001), (b"EX", 1.0)):
+                if unit in options:
+                    expires = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+            exists = self._live(args[0]) is not None
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                return None
+            self.keys[args[0]] = (args[1], expires)
+            return "OK"
+        if name == b"GET" and len(args) == 1:
+            return self._live(args[0])
+        if name == b"DEL":
+            removed = sum(1 for key in args if self._live(key) is not None)
+            for key in args:
+                self.keys.pop(key, None)
+            return removed
+        if name == b"PEXPIRE" and len(args) == 2:
+            value = self._live(args[0])
+            if value is None:
+                return 0
+            self.keys[args[0]] = (value, time.monotonic() + int(args[1]) / 1000)
+            return 1
+        return BusError(f"ERR unknown command or wrong arguments for '{name.decode(errors='replace')}'")
+
+
+def create_bus(url: str):
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return InProcessBus()
+    if scheme in ("redis", "unix"):
+        return RedisBus(url)
+    raise ValueError(f"Unsupported SESSION_BUS {url!r}; use memory://, redis:// or unix://")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the local stand-in bus broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    parser.add_argument("--unix", help="listen on a unix socket instead")
+    args = parser.parse_args()
+
+    async def serve():
+        server = await LocalBroker().start(args.host, args.port, args.unix)
+        print(f"Bus broker listening on {args.unix or f'{args.host}:{args.port}'}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
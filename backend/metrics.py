@@ -0,0 +1,156 @@
+import hashlib
+import hmac
+import os
+import secrets
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Instrumentation is off unless METRICS_ENABLED=true. Metric objects then do
+# nothing, and hot paths check ENABLED before taking timestamps.
+ENABLED = os.environ.get('METRICS_ENABLED', 'false') == 'true'
+# Bearer token the scraper must send, if set
+TOKEN = os.environ.get('METRICS_TOKEN', '')
+# A session id is all it takes to join a session, so labels carry a keyed hash
+# of it instead. Set the key to keep labels stable across workers and restarts.
+LABEL_KEY = os.environ.get('METRICS_LABEL_KEY', '').encode() or secrets.token_bytes(16)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def session_label(session_id: str) -> str:
+    return hmac.new(LABEL_KEY, session_id.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def remove(self, *label_values):
+        """Forget one label combination, e.g. when its session ends."""
+        self.values.pop(tuple(label_values), None)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, *label_values):
+        if ENABLED:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        if ENABLED:
+            self.values[label_values] = value
+
+
+class CallbackGauge(Metric):
+    """Gauge computed at scrape time from live state, so it costs nothing in between."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, callback: Callable[[], Iterable[Tuple[Tuple, float]]]):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in self.callback()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple, List] = {}  # labels: [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        if not ENABLED:
+            return
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                # Values above the last bound are only in the count, which is the +Inf bucket
+                cumulative = series[-1] if bound == float("inf") else cumulative + count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def callback_gauge(self, name, help, labels, callback) -> CallbackGauge:
+        return self.register(CallbackGauge(name, help, labels, callback))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,448 @@
+import bisect
+import codecs
+import collections
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Session ids become file names, so only plain ids are recorded
+SAFE_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+CHUNK_BYTES = int(os.environ.get('RECORDING_CHUNK_BYTES', str(64 * 1024)))  # uncompressed events per chunk
+CHUNK_SECONDS = float(os.environ.get('RECORDING_CHUNK_SECONDS', '5'))  # max age of an unwritten chunk
+
+# Search index: words of two or more characters in output with escape sequences removed
+ESCAPE_RE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[()*+#%]?.|[\x00-\x08\x0b-\x1f\x7f]', re.S)
+TERM_RE = re.compile(r'\w{2,64}')
+MAX_SEARCH_CHUNKS = 200  # candidate chunks scanned per search
+SEARCH_INDEX_CACHE = max(int(os.environ.get('SEARCH_INDEX_CACHE', '32')), 1)  # recordings whose term index stays loaded
+
+
+def recording_paths(directory: Path, session_id: str):
+    """Return the (data, index, terms) paths of a session's recording."""
+    return (directory / f"{session_id}.cast.gz", directory / f"{session_id}.idx",
+            directory / f"{session_id}.terms")
+
+
+def plain_text(text: str) -> str:
+    return ESCAPE_RE.sub("", text)
+
+
+def terms(text: str) -> set:
+    return {term.lower() for term in TERM_RE.findall(text)}
+
+
+class RecordingWriter:
+    """Background thread that owns all recording file I/O.
+
+    Recorders hand events over through a thread-safe queue, so the event loop
+    never waits on compression or disk. The thread starts with the first job.
+    """
+
+    def __init__(self):
+        self.jobs: queue.Queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.open: set = set()
+
+    def submit(self, recorder: "SessionRecorder", kind: str, payload=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="recording-writer", daemon=True)
+                self.thread.start()
+        self.jobs.put((recorder, kind, payload))
+
+    def stop(self):
+        """Flush every open recording and wait for the thread to finish."""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.jobs.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=1.0)
+            except queue.Empty:
+                job = ()
+            if job is None:
+                for recorder in list(self.open):
+                    recorder._close()
+                self.open.clear()
+                return
+            if job:
+                recorder, kind, payload = job
+                try:
+                    if kind == "open":
+                        recorder._open(payload)
+                        self.open.add(recorder)
+                    elif kind == "close":
+                        recorder._close()
+                        self.open.discard(recorder)
+                    else:
+                        recorder._write_event(kind, *payload)
+                except OSError:
+                    logger.exception("Recording for session %s failed", recorder.session_id)
+                    self.open.discard(recorder)
+            # Time-based flushes keep recordings of slow sessions current
+            now = time.monotonic()
+            for recorder in list(self.open):
+                if recorder.chunk and now - recorder.chunk_opened >= CHUNK_SECONDS:
+                    recorder._flush_chunk()
+
+
+writer = RecordingWriter()
+
+
+class SessionRecorder:
+    """Records a session's PTY output and input as a chunked asciicast v2 file.
+
+    Events are grouped into chunks, each written as an independent gzip member,
+    so ``zcat`` of the data file yields a plain asciicast recording. After each
+    chunk an index line with its byte offset, length and time span is appended
+    to the ``.idx`` file, which lets ``read_range`` decompress only the chunks
+    that overlap a requested time range. The words in each chunk's output are
+    appended to a ``.terms`` file at the same time, from which ``search``
+    builds an inverted index as the recording grows.
+
+    A session that already has a recording (the host reconnected, the shell
+    was restarted) continues it: new chunks are appended after the existing
+    ones, with event times carrying on from the recording's last event.
+    """
+
+    def __init__(self, directory: Path, session_id: str, width: int, height: int):
+        self.directory = directory
+        self.session_id = session_id
+        self.started = time.monotonic()
+        # Writer-thread state
+        self.data_file = None
+        self.index_file = None
+        self.terms_file = None
+        self.offset = 0
+        self.chunks = 0  # chunks written, the header included
+        self.time_offset = 0.0  # added to event times; nonzero when continuing a recording
+        self.chunk_output: List[str] = []  # output text of the chunk, for its terms
+        self.chunk: List[str] = []
+        self.chunk_bytes = 0
+        self.chunk_opened = 0.0
+        self.chunk_start = 0.0
+        self.chunk_end = 0.0
+        self.decoders = {}
+        writer.submit(self, "open", {
+            "version": 2,
+            "width": width,
+            "height": height,
+            "timestamp": int(time.time()),
+            "title": f"TermDesk session {session_id}"
+        })
+
+    # Event loop side
+
+    def output(self, data: bytes):
+        writer.submit(self, "o", (time.monotonic() - self.started, data))
+
+    def input(self, data: bytes):
+        writer.submit(self, "i", (time.monotonic() - self.started, data))
+
+    def resize(self, cols: int, rows: int):
+        writer.submit(self, "r", (time.monotonic() - self.started, f"{cols}x{rows}".encode()))
+
+    def close(self):
+        writer.submit(self, "close")
+
+    # Writer thread side
+
+    def _open(self, header: Dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data_path, index_path, terms_path = recording_paths(self.directory, self.session_id)
+        entries = read_index(self.directory, self.session_id)
+        if entries and entries[0].get("header") and data_path.exists():
+            self._resume(header, entries)
+            return
+        self.data_file = open(data_path, "wb")
+        self.index_file = open(index_path, "w")
+        self.terms_file = open(terms_path, "w")
+        self.chunk = [json.dumps(header) + "\n"]
+        self._flush_chunk(header=True)
+
+    def _resume(self, header: Dict, entries: List[Dict]):
+        data_path, index_path, terms_path = recording_paths(self.directory, self.session_id)
+        last = entries[-1]
+        self.offset = last["offset"] + last["length"]
+        self.chunks = len(entries)
+        # Cut off whatever an interrupted writer left after the last indexed chunk
+        truncate(data_path, self.offset)
+        truncate(index_path)
+        if terms_path.exists():
+            truncate(terms_path)
+        previous = json.loads(read_chunk(self.directory, self.session_id, entries[0]))
+        # Times go on from the last event; replay shouldn't sit through the hours
+        # no shell was running
+        self.time_offset = max((entry.get("end", 0.0) for entry in entries), default=0.0)
+        self.data_file = open(data_path, "ab")
+        self.index_file = open(index_path, "a")
+        self.terms_file = open(terms_path, "a")
+        if (header["width"], header["height"]) != (previous["width"], previous["height"]):
+            self._write_event("r", 0.0, f"{header['width']}x{header['height']}".encode())
+
+    def _write_event(self, kind: str, elapsed: float, data: bytes):
+        if self.data_file is None:
+            return
+        decoder = self.decoders.get(kind)
+        if decoder is None:
+            decoder = self.decoders[kind] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        text = decoder.decode(data)
+        if not text:
+            return
+        elapsed += self.time_offset
+        line = json.dumps([round(elapsed, 6), kind, text]) + "\n"
+        if not self.chunk:
+            self.chunk_opened = time.monotonic()
+            self.chunk_start = elapsed
+        self.chunk.append(line)
+        self.chunk_bytes += len(line)
+        if kind == "o":
+            self.chunk_output.append(text)
+        self.chunk_end = elapsed
+        if self.chunk_bytes >= CHUNK_BYTES:
+            self._flush_chunk()
+
+    def _flush_chunk(self, header: bool = False):
+        if not self.chunk or self.data_file is None:
+            return
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: one gzip member
+        data = compressor.compress("".join(self.chunk).encode()) + compressor.flush()
+        self.data_file.write(data)
+        self.data_file.flush()
+        entry = {"offset": self.offset, "length": len(data)}
+        if header:
+            entry["header"] = True
+        else:
+            entry.update(start=self.chunk_start, end=self.chunk_end, events=len(self.chunk))
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+        # Terms come from the joined output so words split across reads are whole
+        chunk_terms = terms(plain_text("".join(self.chunk_output)))
+        if chunk_terms:
+            self.terms_file.write(json.dumps({"chunk": self.chunks, "terms": sorted(chunk_terms)}) + "\n")
+            self.terms_file.flush()
+        self.offset += len(data)
+        self.chunks += 1
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.chunk_output = []
+
+    def _close(self):
+        if self.data_file is None:
+            return
+        self._flush_chunk()
+        self.data_file.close()
+        self.index_file.close()
+        self.terms_file.close()
+        self.data_file = self.index_file = self.terms_file = None
+
+
+def truncate(path: Path, size: Optional[int] = None):
+    """Cut a file to ``size`` bytes, or after its last complete line."""
+    with open(path, "r+b") as f:
+        if size is None:
+            size = f.read().rfind(b"\n") + 1
+        f.truncate(size)
+
+
+def read_index(directory: Path, session_id: str) -> Optional[List[Dict]]:
+    """Return the chunk index of a recording, or None if there is none."""
+    if not SAFE_SESSION_ID.match(session_id):
+        return None
+    _, index_path, _ = recording_paths(directory, session_id)
+    if not index_path.exists():
+        return None
+    with open(index_path) as index_file:
+        # A line without its newline is still being written
+        entries = [json.loads(line) for line in index_file if line.endswith("\n")]
+    return entries or None
+
+
+def read_chunk(directory: Path, session_id: str, entry: Dict) -> str:
+    data_path, _, _ = recording_paths(directory, session_id)
+    with open(data_path, "rb") as data_file:
+        data_file.seek(entry["offset"])
+        return zlib.decompress(data_file.read(entry["length"]), 31).decode()
+
+
+def iter_chunks(directory: Path, session_id: str, start: float = 0.0,
+                end: Optional[float] = None, include_input: bool = True) -> Iterator[List[str]]:
+    """Yield the header line, then the event lines of each chunk in the range.
+
+    Chunks whose time span does not overlap ``start``..``end`` are skipped
+    without being read, so seeking into a long recording stays cheap.
+    ``include_input=False`` leaves out input ("i") events.
+    """
+    entries = read_index(directory, session_id) or []
+    for entry in entries:
+        if entry.get("header"):
+            yield [read_chunk(directory, session_id, entry)]
+            continue
+        if entry["end"] < start or (end is not None and entry["start"] > end):
+            continue
+        events = []
+        for line in read_chunk(directory, session_id, entry).splitlines(keepends=True):
+            elapsed, kind, _ = json.loads(line)
+            if elapsed >= start and (end is None or elapsed <= end) and (include_input or kind != "i"):
+                events.append(line)
+        if events:
+            yield events
+
+
+def read_range(directory: Path, session_id: str, start: float = 0.0, end: Optional[float] = None,
+               include_input: bool = True) -> Optional[str]:
+    """Return the asciicast header plus the events between ``start`` and ``end``.
+
+    Returns None when the session has no recording.
+    """
+    if read_index(directory, session_id) is None:
+        return None
+    chunks = iter_chunks(directory, session_id, start, end, include_input)
+    return "".join(line for chunk in chunks for line in chunk)
+
+
+class TermIndex:
+    """Inverted index (term -> chunk numbers) over a recording's ``.terms`` file.
+
+    The file is read incrementally: each search only parses lines appended
+    since the previous one, so a live session's index keeps up as it runs.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, List[int]] = {}
+        self.sorted_terms: Optional[List[str]] = None  # for prefix lookups, rebuilt on demand
+        self.position = 0
+        self.inode = None  # of the file read so far
+        self.lock = threading.Lock()
+
+    def update(self, terms_path: Path):
+        with self.lock, open(terms_path) as terms_file:
+            stat = os.fstat(terms_file.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.position:
+                # Not the file we indexed (the recording was deleted and made again)
+                self.postings = {}
+                self.sorted_terms = None
+                self.position = 0
+                self.inode = stat.st_ino
+            terms_file.seek(self.position)
+            for line in iter(terms_file.readline, ""):
+                if not line.endswith("\n"):
+                    break
+                self.position = terms_file.tell()
+                entry = json.loads(line)
+                for term in entry["terms"]:
+                    if term not in self.postings:
+                        self.postings[term] = []
+                        self.sorted_terms = None
+                    self.postings[term].append(entry["chunk"])
+
+    def _prefixed(self, prefix: str) -> set:
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.postings)
+        chunks = set()
+        i = bisect.bisect_left(self.sorted_terms, prefix)
+        while i < len(self.sorted_terms) and self.sorted_terms[i].startswith(prefix):
+            chunks.update(self.postings[self.sorted_terms[i]])
+            i += 1
+        return chunks
+
+    def candidates(self, query_terms: set) -> List[int]:
+        """Chunks containing every query term, each term also matching as a prefix."""
+        chunks = None
+        with self.lock:
+            for term in query_terms:
+                posting = self._prefixed(term)
+                chunks = posting if chunks is None else chunks & posting
+                if not chunks:
+                    return []
+        return sorted(chunks or ())
+
+
+term_indexes: "collections.OrderedDict[str, TermIndex]" = collections.OrderedDict()  # least recently searched first
+term_indexes_lock = threading.Lock()
+
+
+def search(directory: Path, session_id: str, query: str, limit: int = 50) -> Optional[Dict]:
+    """Find ``query`` in a recording's output, as a word/prefix search.
+
+    Every word of the query has to start a word of the output, so "second"
+    finds "SECOND_2" but "cond_2" doesn't. The inverted index
+    narrows the search to chunks with such words for every query word; only
+    those chunks are decompressed and scanned for the query text, ignoring
+    case. A query without words (punctuation, one letter) scans every chunk
+    for the text.
+
+    Returns ``{"results": [...], "truncated": bool}``, where ``truncated``
+    says that more than MAX_SEARCH_CHUNKS chunks were candidates and the
+    rest weren't scanned. Returns None when the session has no recording.
+    """
+    entries = read_index(directory, session_id)
+    if entries is None:
+        return None
+    _, _, terms_path = recording_paths(directory, session_id)
+    with term_indexes_lock:
+        index = term_indexes.get(session_id)
+        if index is None:
+            index = term_indexes[session_id] = TermIndex()
+            while len(term_indexes) > SEARCH_INDEX_CACHE:
+                term_indexes.popitem(last=False)
+        term_indexes.move_to_end(session_id)
+    if terms_path.exists():
+        index.update(terms_path)
+
+    query_terms = terms(query)
+    needle = query.lower()
+    if query_terms:
+        chunks = index.candidates(query_terms)
+    else:
+        # Nothing indexable (punctuation, one letter): scan everything
+        chunks = [n for n, entry in enumerate(entries) if not entry.get("header")]
+
+    results = []
+    for chunk in chunks[:MAX_SEARCH_CHUNKS]:
+        if chunk >= len(entries):
+            continue
+        # Join the chunk's output so matches spanning reads are found, remembering
+        # where each event starts to attribute matches to a timestamp
+        starts, times, parts, length = [], [], [], 0
+        for line in read_chunk(directory, session_id, entries[chunk]).splitlines():
+            elapsed, kind, text = json.loads(line)
+            if kind != "o":
+                continue
+            text = plain_text(text)
+            starts.append(length)
+            times.append(elapsed)
+            parts.append(text)
+            length += len(text)
+        output = "".join(parts)
+        haystack = output.lower()
+        position = haystack.find(needle)
+        while position != -1:
+            event = bisect.bisect_right(starts, position) - 1
+            line_start = output.rfind("\n", 0, position) + 1
+            line_end = output.find("\n", position)
+            results.append({
+                "time": times[event],
+                "chunk": chunk,
+                "line": output[line_start:line_end if line_end != -1 else len(output)].strip()
+            })
+            if len(results) >= limit:
+                return {"results": results, "truncated": False}
+            position = haystack.find(needle, position + len(needle))
+    return {"results": results, "truncated": len(chunks) > MAX_SEARCH_CHUNKS}
@@ -0,0 +1,441 @@
+import re
+from typing import List, Optional
+
+# One terminal control token: CSI, OSC, DCS/PM/APC strings, charset designation,
+# a two-byte ESC sequence, or a C0 control. A lone ESC at the end of a chunk
+# matches nothing and is held back until the rest of the sequence arrives.
+TOKEN_RE = re.compile(
+    r'\x1b\[([0-?]*)[ -/]*([@-~])'
+    r'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'
+    r'|\x1b[P^_][^\x1b]*\x1b\\'
+    r'|\x1b[()*+#%].'
+    r'|\x1b([0-OQ-Z\\`-~])'
+    r'|([\x00-\x1a\x1c-\x1f\x7f])',
+    re.S
+)
+MAX_PENDING = 4096  # longest unterminated sequence worth waiting for
+
+# SGR flags that are tracked individually, with the codes that clear them
+SGR_FLAGS = {1: (22,), 2: (22,), 3: (23,), 4: (24,), 5: (25,), 7: (27,), 8: (28,), 9: (29,)}
+
+BLANK = " "
+
+
+class Screen:
+    """Parsed model of a terminal screen, fed with a session's PTY output.
+
+    Tracks cells with their SGR attributes, the cursor, the scroll region and
+    the alternate screen, which is enough to rebuild what a viewer would see.
+    ``snapshot`` renders the current state as a compact escape sequence stream
+    so a new viewer can be brought up to date with one screenful of data.
+    Characters are assumed to be one cell wide.
+    """
+
+    def __init__(self, cols: int = 80, rows: int = 24):
+        self.cols = cols
+        self.rows = rows
+        self.pending = ""
+        self.reset()
+
+    def reset(self):
+        self.chars = self._blank_lines(self.rows)
+        self.attrs = self._blank_attrs(self.rows)
+        self.saved_lines = None  # main screen while the alternate screen is active
+        self.x = 0
+        self.y = 0
+        self.wrap_pending = False
+        self.top = 0
+        self.bottom = self.rows - 1
+        self.autowrap = True
+        self.cursor_visible = True
+        self.flags = set()
+        self.fg: Optional[str] = None
+        self.bg: Optional[str] = None
+        self.attr = ""
+        self.saved_cursor = (0, 0, "", set(), None, None)
+
+    def _blank_lines(self, count: int) -> List[List[str]]:
+        return [[BLANK] * self.cols for _ in range(count)]
+
+    def _blank_attrs(self, count: int) -> List[List[str]]:
+        return [[""] * self.cols for _ in range(count)]
+
+    # Input
+
+    def feed(self, text: str):
+        text = self.pending + text
+        self.pending = ""
+        escape = text.rfind("\x1b")
+        if escape != -1 and not TOKEN_RE.match(text, escape):
+            if len(text) - escape < MAX_PENDING:
+                self.pending = text[escape:]
+            text = text[:escape]
+        if "\x1b" not in text:
+            text = self._skip_scrolled(text)
+
+        pos = 0
+        for match in TOKEN_RE.finditer(text):
+            if match.start() > pos:
+                self._draw(text[pos:match.start()])
+            pos = match.end()
+            control = match.group(4)
+            if control is not None:
+                self._control(control)
+            elif match.group(2) is not None:
+                self._csi(match.group(1), match.group(2))
+            elif match.group(3) is not None:
+                self._esc(match.group(3))
+        if pos < len(text):
+            self._draw(text[pos:])
+
+    def _skip_scrolled(self, text: str) -> str:
+        # Plain output with more lines than the screen (logs, `yes`) scrolls
+        # everything before its last screenful away; drop that part unparsed.
+        if self.top != 0 or self.bottom != self.rows - 1 or text.count("\n") <= self.rows:
+            return text
+        cut = len(text)
+        for _ in range(self.rows + 1):
+            cut = text.rfind("\n", 0, cut)
+        if cut <= 0 or text[cut - 1] != "\r":
+            return text
+        self.chars = self._blank_lines(self.rows)
+        self.attrs = self._blank_attrs(self.rows)
+        self.x = 0
+        self.y = self.rows - 1
+        self.wrap_pending = False
+        return text[cut + 1:]
+
+    def _draw(self, run: str):
+        while run:
+            if self.wrap_pending:
+                self.x = 0
+                self._linefeed()
+                self.wrap_pending = False
+            part = run[:self.cols - self.x]
+            run = run[len(part):]
+            end = self.x + len(part)
+            self.chars[self.y][self.x:end] = part
+            self.attrs[self.y][self.x:end] = [self.attr] * len(part)
+            if end >= self.cols:
+                self.x = self.cols - 1
+                if self.autowrap:
+                    self.wrap_pending = True
+                else:
+                    run = ""
+            else:
+                self.x = end
+
+    def _control(self, char: str):
+        if char == "\r":
+            self.x = 0
+        elif char in "\n\x0b\x0c":
+            self._linefeed()
+        elif char == "\x08":
+            self.x = max(0, self.x - 1)
+        elif char == "\t":
+            self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+        else:
+            return
+        self.wrap_pending = False
+
+    def _esc(self, final: str):
+        if final == "7":
+            self._save_cursor()
+        elif final == "8":
+            self._restore_cursor()
+        elif final == "D":
+            self._linefeed()
+        elif final == "E":
+            self.x = 0
+            self._linefeed()
+        elif final == "M":
+            if self.y == self.top:
+                self._scroll_down(1)
+            elif self.y > 0:
+                self.y -= 1
+        elif final == "c":
+            self.reset()
+        self.wrap_pending = False
+
+    def _csi(self, params: str, final: str):
+        private = params[:1] in ("?", ">", "<", "=")
+        if private:
+            marker, params = params[0], params[1:]
+            if marker == "?" and final in "hl":
+                for mode in self._params(params):
+                    self._private_mode(mode, final == "h")
+            return
+        args = self._params(params)
+        n = max(args[0] if args else 1, 1)
+        self.wrap_pending = False
+
+        if final == "m":
+            self._sgr(args)
+        elif final == "A":
+            self.y = max(self.top if self.y >= self.top else 0, self.y - n)
+        elif final in "Be":
+            self.y = min(self.bottom if self.y <= self.bottom else self.rows - 1, self.y + n)
+        elif final in "Ca":
+            self.x = min(self.cols - 1, self.x + n)
+        elif final == "D":
+            self.x = max(0, self.x - n)
+        elif final == "E":
+            self.x = 0
+            self.y = min(self.rows - 1, self.y + n)
+        elif final == "F":
+            self.x = 0
+            self.y = max(0, self.y - n)
+        elif final in "G`":
+            self.x = min(self.cols - 1, n - 1)
+        elif final == "d":
+            self.y = min(self.rows - 1, n - 1)
+        elif final in "Hf":
+            row = args[0] if args else 1
+            col = args[1] if len(args) > 1 else 1
+            self.y = min(self.rows - 1, max(row, 1) - 1)
+            self.x = min(self.cols - 1, max(col, 1) - 1)
+        elif final == "J":
+            self._erase_display(args[0] if args else 0)
+        elif final == "K":
+            self._erase_line(args[0] if args else 0)
+        elif final == "L":
+            if self.top <= self.y <= self.bottom:
+                self._scroll_down(n, self.y)
+        elif final == "M":
+            if self.top <= self.y <= self.bottom:
+                self._scroll_up(n, self.y)
+        elif final == "@":
+            self._insert_chars(n)
+        elif final == "P":
+            self._delete_chars(n)
+        elif final == "X":
+            end = min(self.cols, self.x + n)
+            self._clear(self.y, self.x, end)
+        elif final == "S":
+            self._scroll_up(n)
+        elif final == "T":
+            self._scroll_down(n)
+        elif final == "r":
+            top = (args[0] if args and args[0] else 1) - 1
+            bottom = (args[1] if len(args) > 1 and args[1] else self.rows) - 1
+            if 0 <= top < bottom < self.rows:
+                self.top, self.bottom = top, bottom
+                self.x = self.y = 0
+        elif final == "s":
+            self._save_cursor()
+        elif final == "u":
+            self._restore_cursor()
+
+    @staticmethod
+    def _params(params: str) -> List[int]:
+        values = []
+        for part in params.split(";") if params else ():
+            part = part.split(":", 1)[0]
+            values.append(int(part) if part.isdigit() else 0)
+        return values
+
+    def _private_mode(self, mode: int, enable: bool):
+        if mode == 25:
+            self.cursor_visible = enable
+        elif mode == 7:
+            self.autowrap = enable
+        elif mode in (47, 1047, 1049):
+            if mode == 1049 and enable:
+                self._save_cursor()
+            if enable and self.saved_lines is None:
+                self.saved_lines = (self.chars, self.attrs)
+                self.chars = self._blank_lines(self.rows)
+                self.attrs = self._blank_attrs(self.rows)
+            elif not enable and self.saved_lines is not None:
+                self.chars, self.attrs = self.saved_lines
+                self.saved_lines = None
+            if mode == 1049 and not enable:
+                self._restore_cursor()
+
+    def _sgr(self, args: List[int]):
+        if not args:
+            args = [0]
+        i = 0
+        while i < len(args):
+            code = args[i]
+            if code == 0:
+                self.flags = set()
+                self.fg = self.bg = None
+            elif code in SGR_FLAGS:
+                self.flags.add(code)
+            elif code in (22, 23, 24, 25, 27, 28, 29):
+                self.flags -= {flag for flag, clears in SGR_FLAGS.items() if code in clears}
+            elif 30 <= code <= 37 or 90 <= code <= 97:
+                self.fg = str(code)
+            elif code == 39:
+                self.fg = None
+            elif 40 <= code <= 47 or 100 <= code <= 107:
+                self.bg = str(code)
+            elif code == 49:
+                self.bg = None
+            elif code in (38, 48):
+                # Extended colour: 5;n (256 colours) or 2;r;g;b (true colour)
+                if i + 2 < len(args) and args[i + 1] == 5:
+                    color = f"{code};5;{args[i + 2]}"
+                    i += 2
+                elif i + 4 < len(args) and args[i + 1] == 2:
+                    color = f"{code};2;{args[i + 2]};{args[i + 3]};{args[i + 4]}"
+                    i += 4
+                else:
+                    break
+                if code == 38:
+                    self.fg = color
+                else:
+                    self.bg = color
+            i += 1
+        parts = [str(flag) for flag in sorted(self.flags)]
+        if self.fg:
+            parts.append(self.fg)
+        if self.bg:
+            parts.append(self.bg)
+        self.attr = ";".join(parts)
+
+    def _save_cursor(self):
+        self.saved_cursor = (self.x, self.y, self.attr, set(self.flags), self.fg, self.bg)
+
+    def _restore_cursor(self):
+        x, y, self.attr, flags, self.fg, self.bg = self.saved_cursor
+        self.flags = set(flags)
+        self.x = min(x, self.cols - 1)
+        self.y = min(y, self.rows - 1)
+
+    # Editing
+
+    def _linefeed(self):
+        if self.y == self.bottom:
+            self._scroll_up(1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _scroll_up(self, n: int, top: Optional[int] = None):
+        top = self.top if top is None else top
+        n = min(n, self.bottom - top + 1)
+        for lines, blank in ((self.chars, self._blank_lines), (self.attrs, self._blank_attrs)):
+            del lines[top:top + n]
+            lines[self.bottom - n + 1:self.bottom - n + 1] = blank(n)
+
+    def _scroll_down(self, n: int, top: Optional[int] = None):
+        top = self.top if top is None else top
+        n = min(n, self.bottom - top + 1)
+        for lines, blank in ((self.chars, self._blank_lines), (self.attrs, self._blank_attrs)):
+            del lines[self.bottom - n + 1:self.bottom + 1]
+            lines[top:top] = blank(n)
+
+    def _clear(self, y: int, start: int, end: int):
+        self.chars[y][start:end] = [BLANK] * (end - start)
+        self.attrs[y][start:end] = [""] * (end - start)
+
+    def _erase_line(self, mode: int):
+        if mode == 0:
+            self._clear(self.y, self.x, self.cols)
+        elif mode == 1:
+            self._clear(self.y, 0, self.x + 1)
+        elif mode == 2:
+            self._clear(self.y, 0, self.cols)
+
+    def _erase_display(self, mode: int):
+        if mode == 0:
+            self._erase_line(0)
+            rows = range(self.y + 1, self.rows)
+        elif mode == 1:
+            self._erase_line(1)
+            rows = range(0, self.y)
+        elif mode in (2, 3):
+            rows = range(self.rows)
+        else:
+            return
+        for y in rows:
+            self._clear(y, 0, self.cols)
+
+    def _insert_chars(self, n: int):
+        n = min(n, self.cols - self.x)
+        for line, fill in ((self.chars[self.y], BLANK), (self.attrs[self.y], "")):
+            line[self.x:self.x] = [fill] * n
+            del line[self.cols:]
+
+    def _delete_chars(self, n: int):
+        n = min(n, self.cols - self.x)
+        for line, fill in ((self.chars[self.y], BLANK), (self.attrs[self.y], "")):
+            del line[self.x:self.x + n]
+            line.extend([fill] * n)
+
+    # Geometry
+
+    def resize(self, cols: int, rows: int):
+        if cols == self.cols and rows == self.rows:
+            return
+        buffers = [(self.chars, self.attrs)]
+        if self.saved_lines is not None:
+            buffers.append(self.saved_lines)
+        for chars, attrs in buffers:
+            if rows < self.rows:
+                # Keep the cursor line on screen by dropping lines from the top first
+                excess = min(self.rows - rows, max(0, self.y - rows + 1))
+                del chars[:excess]
+                del attrs[:excess]
+                del chars[rows:]
+                del attrs[rows:]
+            for line, fill in [(line, BLANK) for line in chars] + [(line, "") for line in attrs]:
+                if cols < self.cols:
+                    del line[cols:]
+                else:
+                    line.extend([fill] * (cols - self.cols))
+        if rows < self.rows:
+            self.y -= min(self.rows - rows, max(0, self.y - rows + 1))
+        old_rows = self.rows
+        self.cols, self.rows = cols, rows
+        for chars, attrs in buffers:
+            if rows > old_rows:
+                chars.extend(self._blank_lines(rows - old_rows))
+                attrs.extend(self._blank_attrs(rows - old_rows))
+        self.top, self.bottom = 0, rows - 1
+        self.x = min(self.x, cols - 1)
+        self.y = min(self.y, rows - 1)
+        self.wrap_pending = False
+
+    # Output
+
+    def snapshot(self) -> str:
+        """Escape sequences that redraw the current screen on a fresh terminal."""
+        out = ["\x1bc"]
+        if self.saved_lines is not None:
+            out.append("\x1b[?1049h")
+        out.append("\x1b[H\x1b[2J")
+        for y in range(self.rows):
+            chars, attrs = self.chars[y], self.attrs[y]
+            end = self.cols
+            while end and chars[end - 1] == BLANK and not attrs[end - 1]:
+                end -= 1
+            if not end:
+                continue
+            out.append(f"\x1b[{y + 1}H")
+            attr = ""
+            start = 0
+            for x in range(end):
+                if attrs[x] != attr:
+                    out.append("".join(chars[start:x]))
+                    out.append(f"\x1b[0;{attrs[x]}m" if attrs[x] else "\x1b[0m")
+                    attr = attrs[x]
+                    start = x
+            out.append("".join(chars[start:end]))
+            if attr:
+                out.append("\x1b[0m")
+        if self.top != 0 or self.bottom != self.rows - 1:
+            out.append(f"\x1b[{self.top + 1};{self.bottom + 1}r")
+        if not self.autowrap:
+            out.append("\x1b[?7l")
+        if self.attr:
+            out.append(f"\x1b[0;{self.attr}m")
+        out.append(f"\x1b[{self.y + 1};{self.x + 1}H")
+        if not self.cursor_visible:
+            out.append("\x1b[?25l")
+        return "".join(out)
+
+    def text(self) -> str:
+        """Plain text of the visible screen, trailing blanks trimmed."""
+        return "\n".join("".join(line).rstrip() for line in self.chars)
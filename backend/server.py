@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -6,144 +7,2233 @@ import os
 import logging
 import asyncio
 import pty
+import fcntl
+import termios
+import signal
+import resource
 import subprocess
-import select
 import json
+import codecs
+import base64
+import socket
+import struct
+import time
+import itertools
+import threading
+import collections
+import secrets
+import shlex
+import zlib
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence
 import uuid
 from datetime import datetime, timezone
+from screen import Screen
+import recorder
+import metrics
+import bus
+from sessions import SessionStore
+from pymongo.errors import PyMongoError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')))
 db = client[os.environ['DB_NAME']]
 
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
+# PTY output tuning
+PTY_READ_SIZE = 65536
+# execute_command: commands queue per session and run one at a time; shell
+# integration marks (shell_integration.bash) delimit each one's output
+COMMAND_TIMEOUT = float(os.environ.get('COMMAND_TIMEOUT', '30'))  # default seconds before a command is interrupted
+COMMAND_MAX_TIMEOUT = float(os.environ.get('COMMAND_MAX_TIMEOUT', '600'))  # cap on a client-requested timeout
+COMMAND_INTERRUPT_GRACE = float(os.environ.get('COMMAND_INTERRUPT_GRACE', '1.0'))  # wait for the prompt after SIGINT
+COMMAND_PROMPT_POLL = 0.1  # how often a command waiting for the prompt checks for a program reading input
+COMMAND_INPUT_SETTLE = 0.5  # seconds a line typed into a program may take to return to the prompt
+COMMAND_QUEUE_SIZE = int(os.environ.get('COMMAND_QUEUE_SIZE', '32'))  # pending commands per session
+COMMAND_OUTPUT_BYTES = int(os.environ.get('COMMAND_OUTPUT_BYTES', str(256 * 1024)))  # output kept per command
+COMMAND_HISTORY_BYTES = int(os.environ.get('COMMAND_HISTORY_BYTES', str(128 * 1024)))  # results replayed to late joiners
+SHELL_RC = ROOT_DIR / 'shell_integration.bash'
+OUTPUT_FLUSH_INTERVAL = float(os.environ.get('OUTPUT_FLUSH_MS', '16')) / 1000  # coalescing window under load
+OUTPUT_FLUSH_BYTES = int(os.environ.get('OUTPUT_FLUSH_BYTES', str(32 * 1024)))  # frame size that flushes early
+PTY_WRITE_BUFFER = int(os.environ.get('PTY_WRITE_BUFFER', str(64 * 1024)))  # pending input before senders wait
+PTY_POOL_SIZE = int(os.environ.get('PTY_POOL_SIZE', '2'))  # idle pre-spawned shells per worker; 0 disables
+# Output rate limits (bytes/s, 0 = unlimited): a session over its quota stops
+# being read until its bucket refills, and sessions producing bulk output
+# split OUTPUT_WORKER_RATE evenly
+OUTPUT_RATE_LIMIT = int(os.environ.get('OUTPUT_RATE_LIMIT', str(4 * 1024 * 1024)))  # default per-session quota
+OUTPUT_RATE_MAX = int(os.environ.get('OUTPUT_RATE_MAX', str(16 * 1024 * 1024)))  # cap on a session's own quota
+OUTPUT_BURST = int(os.environ.get('OUTPUT_BURST', str(1024 * 1024)))  # bytes a session may send at once
+OUTPUT_WORKER_RATE = int(os.environ.get('OUTPUT_WORKER_RATE', str(32 * 1024 * 1024)))  # shared by busy sessions
+ECHO_WINDOW = float(os.environ.get('ECHO_WINDOW_MS', '100')) / 1000  # output this soon after input is echo
+ECHO_BYTES = int(os.environ.get('ECHO_BYTES', '4096'))  # uncharged echo per input
+OUTPUT_THROTTLE_HOLD = 1.0  # seconds without a pause before viewers hear throttling ended
+OUTPUT_SHARE_INTERVAL = 0.5  # how often the busy-session count behind the fair share is redone
+# Envelope cost of one terminal_chunk frame, used to estimate bytes saved by coalescing
+FRAME_OVERHEAD = len(json.dumps({"type": "terminal_chunk", "seq": 0, "data": ""}))
+
+# Binary protocol (?protocol=binary): a 5-byte header of frame type and sequence
+# number followed by raw bytes. Terminal output and keystrokes use binary
+# frames; control messages (member_update, grant_permission, ...) stay JSON.
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_OUTPUT = 0x01  # server -> client: PTY output
+FRAME_INPUT = 0x02  # client -> server: keystrokes written to the PTY
+FRAME_SCROLLBACK = 0x03  # server -> client: buffered history, seq is the next live frame
+FRAME_SNAPSHOT = 0x04  # server -> client: screen redraw, seq is the next live frame
+FRAME_RESUME = 0x05  # server -> client: output missed since last_seq, seq is the next live frame
+
+def pack_frame(frame_type: int, seq: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(frame_type, seq & 0xFFFFFFFF) + payload
+
+def unpack_frame(frame: bytes):
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame")
+    frame_type, seq = FRAME_HEADER.unpack_from(frame)
+    return frame_type, seq, frame[FRAME_HEADER.size:]
+
+# Output compression (?compress=deflate, binary protocol only): output frames of
+# at least COMPRESS_MIN_BYTES go out as raw deflate, compressed once per frame
+# however many members asked for it. Each frame is compressed on its own, so
+# dropped frames, resyncs and late joins never leave a viewer unable to decode;
+# a preset dictionary of common escape sequences, sent in the welcome, makes up
+# for the missing history on short frames.
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '256'))  # smaller frames go uncompressed
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '1'))  # zlib level; compression runs on the event loop
+FRAME_COMPRESSED = 0x80  # frame type flag: payload is raw deflate (wbits -15) with COMPRESS_DICTIONARY
+COMPRESS_DICTIONARY = (
+    b"drwxr-xr-x -rw-r--r-- total No such file or directory command not found "
+    b"\x1b[38;5;\x1b[48;5;\x1b[1;31m\x1b[1;32m\x1b[1;34m\x1b[0;32m\x1b[01;31m\x1b[01;36m"
+    b"\x1b[01;32m\x1b[01;34m\x1b[22m\x1b[27m\x1b[39m\x1b[49m\x1b[1m\x1b[7m\x1b[2J\x1b[H\x1b[J"
+    b"\x1b[K\x1b[m\x1b[0m\r\n\x1b[?2004l\r\x1b[?2004h"
+)
+_DEFLATE = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=COMPRESS_DICTIONARY)
+
+def pack_output(frame_type: int, seq: int, data: bytes, compress: bool) -> bytes:
+    """A frame of PTY output, compressed if asked for and worth it."""
+    if compress and len(data) >= COMPRESS_MIN_BYTES:
+        # Copying the primed compressor skips loading the dictionary per frame
+        compressor = _DEFLATE.copy()
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            return pack_frame(frame_type | FRAME_COMPRESSED, seq, compressed)
+    return pack_frame(frame_type, seq, data)
+
+# Scrollback replayed to members that join (or resync) mid-session
+SCROLLBACK_BYTES = int(os.environ.get('SCROLLBACK_BYTES', str(256 * 1024)))  # per-session cap
+# What joiners get: "snapshot" redraws the parsed screen, "scrollback" replays raw history
+JOIN_REPLAY = os.environ.get('JOIN_REPLAY', 'snapshot')
+if JOIN_REPLAY not in ("snapshot", "scrollback"):
+    raise ValueError("JOIN_REPLAY must be snapshot or scrollback")
+# The screen model is only parsed while streaming members need snapshots; the
+# first of them gets one rebuilt from this much of the scrollback
+SNAPSHOT_REBUILD_BYTES = int(os.environ.get('SNAPSHOT_REBUILD_BYTES', str(64 * 1024)))
+# Resuming (?resume=<token>&last_seq=<n>, or &last_command=<id> for members that
+# don't stream): a dropped member keeps its place, and the session its shell,
+# for RESUME_GRACE seconds; 0 disconnects at once
+RESUME_GRACE = float(os.environ.get('RESUME_GRACE', '30'))
+RESUME_FRAMES = int(os.environ.get('RESUME_FRAMES', '4096'))  # frames indexed per session for partial replay
+SCREEN_COLS = int(os.environ.get('SCREEN_COLS', '80'))  # initial PTY size, and the size under RESIZE_POLICY=fixed
+SCREEN_ROWS = int(os.environ.get('SCREEN_ROWS', '24'))
+
+# Terminal size: "host" follows the host's terminal, "smallest" fits every
+# member that reported a size, "fixed" keeps SCREEN_COLS x SCREEN_ROWS
+RESIZE_POLICIES = ("host", "smallest", "fixed")
+RESIZE_POLICY = os.environ.get('RESIZE_POLICY', 'host')
+if RESIZE_POLICY not in RESIZE_POLICIES:
+    raise ValueError(f"RESIZE_POLICY must be one of {', '.join(RESIZE_POLICIES)}")
+RESIZE_DEBOUNCE = float(os.environ.get('RESIZE_DEBOUNCE_MS', '100')) / 1000  # quiet time before a new size is applied
+MAX_COLS = 1000
+MAX_ROWS = 500
+
+def set_window_size(fd: int, cols: int, rows: int):
+    # On a change the kernel sends SIGWINCH to the terminal's foreground process group
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+
+# Session recordings: opt-in per session (host connects with ?record=true) or for all sessions
+RECORDINGS_DIR = Path(os.environ.get('RECORDINGS_DIR', str(ROOT_DIR / 'recordings')))
+RECORD_ALL_SESSIONS = os.environ.get('RECORD_ALL_SESSIONS', 'false') == 'true'
+# Keystrokes, passwords typed at no-echo prompts included; only ever on disk,
+# the recording endpoints serve output and resizes
+RECORD_INPUT = os.environ.get('RECORD_INPUT', 'false') == 'true'
+
+class ScrollbackBuffer:
+    """Byte ring holding the last ``capacity`` bytes of a session's output.
+
+    The buffer grows on demand until it reaches capacity and then overwrites
+    its oldest bytes in place, so an idle session costs little and a busy one
+    never costs more than SCROLLBACK_BYTES. Output frames written with
+    write_frame are indexed by sequence number so a resuming member can be
+    sent just the frames it missed.
+    """
+
+    __slots__ = ("capacity", "buffer", "start", "total", "frames")
+
+    def __init__(self, capacity: int = SCROLLBACK_BYTES):
+        self.capacity = capacity
+        self.buffer = bytearray()
+        self.start = 0  # index of the oldest byte once the ring is full
+        self.total = 0  # bytes ever written
+        self.frames = collections.deque(maxlen=RESUME_FRAMES)  # (seq, total before it), consecutive seqs
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        if len(data) >= self.capacity:
+            self.buffer = bytearray(data[-self.capacity:])
+            self.start = 0
+            return
+        room = self.capacity - len(self.buffer)
+        if room:
+            self.buffer += data[:room]
+            data = data[room:]
+            if not data:
+                return
+        # Full: overwrite the oldest bytes, wrapping at the end of the buffer
+        first = min(len(data), self.capacity - self.start)
+        self.buffer[self.start:self.start + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.start = (self.start + len(data)) % self.capacity
+
+    def getvalue(self) -> bytes:
+        if not self.start:
+            return bytes(self.buffer)
+        return bytes(self.buffer[self.start:] + self.buffer[:self.start])
+
+    def write_frame(self, seq: int, data: bytes):
+        frames = self.frames
+        if frames and frames[-1][0] != seq - 1:
+            frames.clear()  # a gap (lost bus message) breaks seq arithmetic
+        frames.append((seq, self.total))
+        self.write(data)
+        evicted = self.total - len(self.buffer)
+        while frames and frames[0][1] < evicted:
+            frames.popleft()
+
+    def since(self, seq: int) -> Optional[bytes]:
+        """Output from frame ``seq`` on, or None if that frame is no longer held."""
+        frames = self.frames
+        if not frames or not frames[0][0] <= seq <= frames[-1][0]:
+            return None
+        held = self.getvalue()
+        return held[len(held) - (self.total - frames[seq - frames[0][0]][1]):]
+
+class CommandHistory:
+    """The session's recent terminal_output messages, capped by total size.
+
+    Messages are kept serialized, so replaying them to a joiner costs no
+    encoding and the cap counts what is actually sent. The oldest go first;
+    a single result over the cap keeps only the end of its output.
+    """
+
+    __slots__ = ("capacity", "entries", "size")
+
+    def __init__(self, capacity: int = COMMAND_HISTORY_BYTES):
+        self.capacity = capacity
+        self.entries = collections.deque()  # (command id, JSON message)
+        self.size = 0
+
+    def __iter__(self):
+        return (payload for _, payload in self.entries)
+
+    @property
+    def newest(self) -> Optional[int]:
+        return self.entries[-1][0] if self.entries else None
+
+    def since(self, command_id: Optional[int]) -> List[str]:
+        """Messages after the one for ``command_id``; all of them if it's gone."""
+        ids = [entry_id for entry_id, _ in self.entries]
+        start = ids.index(command_id) + 1 if command_id in ids else 0
+        return [payload for _, payload in itertools.islice(self.entries, start, None)]
+
+    def append(self, message: Dict):
+        payload = json.dumps(message)
+        if len(payload) > self.capacity:
+            message = {**message, "truncated": True}
+            # Each character cut shortens the JSON by at least one
+            message["output"] = message["output"][len(json.dumps(message)) - self.capacity:]
+            payload = json.dumps(message)
+        self.entries.append((message["id"], payload))
+        self.size += len(payload)
+        while self.size > self.capacity:
+            self.size -= len(self.entries.popleft()[1])
+
+    def extend(self, payloads: List[str]):
+        for payload in payloads:
+            self.append(json.loads(payload))
+
+# Cross-worker routing: PTY output, input and membership events travel over the
+# bus so a session can be viewed from any worker; one worker owns each PTY
+SESSION_BUS = os.environ.get('SESSION_BUS', 'memory://')
+SESSION_OWNER_TTL = float(os.environ.get('SESSION_OWNER_TTL', '15'))  # seconds before a dead worker's claims lapse
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+BUS_PREFIX = "termdesk:"
+
+def bus_key(session_id: str, kind: str) -> str:
+    # kind: output, input, events (channels) or owner (PTY ownership key)
+    return f"{BUS_PREFIX}{session_id}:{kind}"
+
+# Per-member send queues
+SEND_QUEUE_SIZE = max(int(os.environ.get('SEND_QUEUE_SIZE', '256')), 4)  # frames buffered per member
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "resync", "disconnect")
+SLOW_CONSUMER_POLICY = os.environ.get('SLOW_CONSUMER_POLICY', 'drop_oldest')
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"SLOW_CONSUMER_POLICY must be one of {', '.join(SLOW_CONSUMER_POLICIES)}")
+# Membership changes within this window go out as one member_delta
+MEMBER_UPDATE_DEBOUNCE = float(os.environ.get('MEMBER_UPDATE_DEBOUNCE_MS', '50')) / 1000
+
+# Metrics, served at /metrics (outside the public /api) when METRICS_ENABLED=true.
+# Per-session series are labelled with metrics.session_label, never the id
+PTY_READ_BYTES = metrics.registry.counter(
+    "termdesk_pty_read_bytes_total", "Bytes read from session PTYs", ("session",))
+OUTPUT_FRAMES = metrics.registry.counter(
+    "termdesk_output_frames_total", "Coalesced output frames produced", ("session",))
+BROADCAST_SECONDS = metrics.registry.histogram(
+    "termdesk_broadcast_seconds", "Time to fan one message out to a session's members")
+SLOW_CONSUMERS = metrics.registry.counter(
+    "termdesk_slow_consumer_total", "Send queue overflows handled by the slow-consumer policy", ("policy",))
+COMMAND_SECONDS = metrics.registry.histogram(
+    "termdesk_command_seconds", "execute_command run time, from write to the next prompt")
+COMMANDS = metrics.registry.counter(
+    "termdesk_commands_total", "execute_command requests, by outcome", ("status",))
+MONGO_SECONDS = metrics.registry.histogram(
+    "termdesk_mongo_seconds", "MongoDB call latency", ("operation",))
+# Session documents: cached lookups, state changes written behind in batches
+session_store = SessionStore(lambda: db.sessions, MONGO_SECONDS)
+# Unknown session ids are refused at the WebSocket; false skips the lookup
+VALIDATE_WS_SESSIONS = os.environ.get('VALIDATE_WS_SESSIONS', 'true') == 'true'
+LOOP_LAG_SECONDS = metrics.registry.histogram(
+    "termdesk_event_loop_lag_seconds", "How late the event loop woke a sleeping probe task")
+LOOP_LAG_INTERVAL = 0.5
+OUTPUT_THROTTLES = metrics.registry.counter(
+    "termdesk_output_throttle_total", "Times a session's PTY reads were paused by its output rate limit")
+COMPRESSION_BYTES = metrics.registry.counter(
+    "termdesk_output_compression_bytes_total", "Output compressed for deflate members, before and after", ("stage",))
+PTY_INPUT_BYTES = metrics.registry.counter(
+    "termdesk_pty_input_bytes_total", "Bytes of member input queued for session PTYs", ("session",))
+PTY_WRITES = metrics.registry.counter(
+    "termdesk_pty_writes_total", "write() calls made to session PTYs", ("session",))
+PTY_POOL_TAKES = metrics.registry.counter(
+    "termdesk_pty_pool_total", "Session shells started, by whether a pre-spawned one was ready", ("result",))
+PTY_START_SECONDS = metrics.registry.histogram(
+    "termdesk_pty_start_seconds", "Time to get a session its shell, pool hit or spawn")
+SESSIONS_ENDED = metrics.registry.counter(
+    "termdesk_sessions_ended_total", "Sessions ended by the server, by reason", ("reason",))
+
+# Coalesces PTY reads into output frames
+class PromptMarks:
+    """Splits PTY output at OSC 133 shell-integration marks.
+
+    feed() returns output bytes interleaved with marks: ("C",) a command
+    started, ("D", exit status) it finished, ("A",) the prompt is back. A mark
+    split across reads is held until the rest arrives.
+    """
+
+    PREFIX = b"\x1b]133;"
+    MAX_MARK = 32
+
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data: bytes) -> list:
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+        parts = []
+        position = 0
+        while True:
+            start = data.find(self.PREFIX, position)
+            if start < 0:
+                break
+            end = data.find(b"\x07", start, start + self.MAX_MARK)
+            if end < 0:
+                if len(data) - start < self.MAX_MARK:
+                    self.pending = data[start:]
+                    data = data[:start]
+                else:
+                    start += 1  # not a mark after all
+                    if start > position:
+                        parts.append(data[position:start])
+                    position = start
+                    continue
+                break
+            if start > position:
+                parts.append(data[position:start])
+            fields = data[start + len(self.PREFIX):end].decode("ascii", errors="replace").split(";")
+            if fields[0] == "D":
+                try:
+                    parts.append(("D", int(fields[1])))
+                except (IndexError, ValueError):
+                    parts.append(("D", None))
+            else:
+                parts.append((fields[0],))
+            position = end + 1
+        tail = data[position:]
+        # Hold back a mark cut off inside its prefix
+        escape = tail.rfind(b"\x1b", max(0, len(tail) - len(self.PREFIX)))
+        if escape >= 0 and self.PREFIX.startswith(tail[escape:]):
+            self.pending = tail[escape:] + self.pending
+            tail = tail[:escape]
+        if tail:
+            parts.append(tail)
+        return parts
+
+COMMAND_IDS = itertools.count(1)
+
+class ShellCommand:
+    """One queued execute_command."""
+
+    __slots__ = ("id", "command", "username", "timeout", "status", "exit_code", "output", "written", "done")
+
+    def __init__(self, command: str, username: str, timeout: float):
+        self.id = next(COMMAND_IDS)
+        self.command = command
+        self.username = username
+        self.timeout = timeout
+        self.status = "queued"  # then running, and completed/timeout/cancelled/input/busy/rejected
+        self.exit_code: Optional[int] = None
+        self.output = bytearray()
+        self.written = False
+        self.done = asyncio.Event()
+
+class OutputBatcher:
+    """Turns a queue of PTY reads into frames under a time/size budget.
+
+    Sparse output passes straight through. When reads arrive faster than
+    OUTPUT_FLUSH_INTERVAL they are held until the interval ends or
+    OUTPUT_FLUSH_BYTES accumulate, so a chatty command costs one frame per
+    interval instead of one per read.
+    """
+
+    def __init__(self, source: asyncio.Queue, interval: float = OUTPUT_FLUSH_INTERVAL,
+                 max_bytes: int = OUTPUT_FLUSH_BYTES):
+        self.source = source
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.last_frame = 0.0
+        self.eof = False
+        self.reads = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def _drain(self, frame: bytearray):
+        # Take whatever is already queued, up to the size budget
+        while len(frame) < self.max_bytes:
+            try:
+                data = self.source.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if data is None:
+                self.eof = True
+                return
+            self.reads += 1
+            frame += data
+
+    async def next_frame(self) -> Optional[bytes]:
+        """Return the next coalesced frame, or None once the PTY hit EOF."""
+        if self.eof:
+            return None
+        data = await self.source.get()
+        if data is None:
+            self.eof = True
+            return None
+        self.reads += 1
+        frame = bytearray(data)
+        self._drain(frame)
+        loop = asyncio.get_running_loop()
+        wait = self.last_frame + self.interval - loop.time()
+        if wait > 0 and len(frame) < self.max_bytes and not self.eof:
+            # Output is dense: hold the frame open for the rest of the window
+            await asyncio.sleep(wait)
+            self._drain(frame)
+        self.last_frame = loop.time()
+        self.frames += 1
+        self.bytes += len(frame)
+        return bytes(frame)
+
+    def stats(self) -> Dict:
+        frames_saved = self.reads - self.frames
+        return {
+            "reads": self.reads,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "frames_saved": frames_saved,
+            "bytes_saved": frames_saved * FRAME_OVERHEAD
+        }
+
+class OutputLimiter:
+    """Token bucket on one session's PTY output.
+
+    Output is charged as it is read. A session that used up its burst isn't
+    read again until the bucket refills, so the shell blocks on a full tty
+    instead of the worker queueing its output. Output right after input
+    (echo, a prompt, a short answer) is free, so typing stays responsive
+    while a session is throttled.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "last_input", "echo_bytes", "resume", "clear")
+
+    def __init__(self, rate: int = OUTPUT_RATE_LIMIT, burst: int = OUTPUT_BURST):
+        self.rate = rate  # the session's quota, bytes/s; 0 = unlimited
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.last_input = 0.0
+        self.echo_bytes = 0  # free output used since the last input
+        self.resume: Optional[asyncio.TimerHandle] = None  # set while reads are paused
+        self.clear: Optional[asyncio.TimerHandle] = None  # ends the throttled state
+
+    def input(self):
+        self.last_input = time.monotonic()
+        self.echo_bytes = 0
+
+    def is_echo(self, size: int) -> bool:
+        if time.monotonic() - self.last_input < ECHO_WINDOW and self.echo_bytes + size <= ECHO_BYTES:
+            self.echo_bytes += size
+            return True
+        return False
+
+    def charge(self, size: int, rate: float) -> float:
+        """Take `size` bytes at `rate` bytes/s; returns how long reads should pause."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= size
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+    def cancel(self):
+        for timer in (self.resume, self.clear):
+            if timer is not None:
+                timer.cancel()
+
+# Coalesces member input into PTY writes
+class PtyWriter:
+    """Non-blocking writer for a PTY master.
+
+    Input queued during one event loop iteration (several typists, a paste
+    split over frames) goes out in a single write at the end of it. When the
+    tty's input buffer is full the rest waits for the fd to become writable,
+    and `drain` holds senders back while more than max_pending bytes are
+    outstanding, so their websockets stop being read.
+    """
+
+    def __init__(self, fd: int, label: str, max_pending: int = PTY_WRITE_BUFFER):
+        self.fd = fd
+        self.label = label  # the session's metrics label
+        self.max_pending = max_pending
+        self.pending = bytearray()
+        self.scheduled = False
+        self.watching = False  # add_writer registered while the tty is full
+        self.closed = False
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def write(self, data: bytes):
+        if self.closed:
+            return
+        self.pending += data
+        PTY_INPUT_BYTES.inc(len(data), self.label)
+        if not self.scheduled and not self.watching:
+            asyncio.get_running_loop().call_soon(self._flush)
+            self.scheduled = True
+        if len(self.pending) > self.max_pending:
+            self.drained.clear()
+
+    async def drain(self):
+        """Wait until the backlog is back under max_pending."""
+        await self.drained.wait()
+
+    def _flush(self):
+        self.scheduled = False
+        if self.closed:
+            return
+        while self.pending:
+            try:
+                written = os.write(self.fd, self.pending)
+            except BlockingIOError:
+                break
+            except OSError:
+                # The shell is gone; the reader side reports EOF
+                self.close()
+                return
+            PTY_WRITES.inc(1, self.label)
+            del self.pending[:written]
+        loop = asyncio.get_running_loop()
+        if self.pending and not self.watching:
+            loop.add_writer(self.fd, self._flush)
+            self.watching = True
+        elif not self.pending and self.watching:
+            loop.remove_writer(self.fd)
+            self.watching = False
+        if len(self.pending) <= self.max_pending:
+            self.drained.set()
+
+    def close(self):
+        if self.watching:
+            asyncio.get_running_loop().remove_writer(self.fd)
+            self.watching = False
+        self.closed = True
+        self.pending.clear()
+        self.drained.set()
+
+# Shell lifecycle and resource limits
+PTY_KILL_GRACE = float(os.environ.get('PTY_KILL_GRACE', '2'))  # seconds between SIGHUP and SIGKILL
+SESSION_IDLE_TIMEOUT = float(os.environ.get('SESSION_IDLE_TIMEOUT', '3600'))  # seconds without input or output; 0 disables
+SESSION_MAX_LIFETIME = float(os.environ.get('SESSION_MAX_LIFETIME', '0'))  # seconds a shell may run at all; 0 disables
+LIFECYCLE_INTERVAL = 5.0
+SESSION_CPU_SECONDS = int(os.environ.get('SESSION_CPU_SECONDS', '0'))  # RLIMIT_CPU per process; 0 = unlimited
+SESSION_MEMORY_MB = int(os.environ.get('SESSION_MEMORY_MB', '0'))  # RLIMIT_AS per process, or memory.max per session with cgroups
+SESSION_MAX_PROCESSES = int(os.environ.get('SESSION_MAX_PROCESSES', '0'))  # RLIMIT_NPROC (per user!), or pids.max per session with cgroups
+SESSION_CPU_PERCENT = int(os.environ.get('SESSION_CPU_PERCENT', '0'))  # cpu.max per session with cgroups, % of one CPU
+SESSION_CGROUP_ROOT = os.environ.get('SESSION_CGROUP_ROOT', '')  # delegated cgroup v2 directory; each shell gets a child cgroup
+
+if SESSION_CGROUP_ROOT:
+    SHELL_RLIMITS = [(resource.RLIMIT_CPU, SESSION_CPU_SECONDS)]
+    CGROUP_LIMITS = [
+        ("memory.max", SESSION_MEMORY_MB * 1024 * 1024),
+        ("pids.max", SESSION_MAX_PROCESSES),
+        ("cpu.max", f"{SESSION_CPU_PERCENT * 1000} 100000" if SESSION_CPU_PERCENT else 0)
+    ]
+else:
+    SHELL_RLIMITS = [
+        (resource.RLIMIT_CPU, SESSION_CPU_SECONDS),
+        (resource.RLIMIT_AS, SESSION_MEMORY_MB * 1024 * 1024),
+        (resource.RLIMIT_NPROC, SESSION_MAX_PROCESSES)
+    ]
+    CGROUP_LIMITS = []
+
+# ulimit option and unit of each rlimit
+ULIMIT_OPTIONS = {
+    resource.RLIMIT_CPU: ("-t", 1),
+    resource.RLIMIT_AS: ("-v", 1024),
+    resource.RLIMIT_NPROC: ("-u", 1)
+}
+
+# Session shells
+shell_cgroups: Dict[int, Path] = {}  # shell pid: its cgroup
+
+def create_cgroup() -> Path:
+    """A child cgroup of SESSION_CGROUP_ROOT with the session limits set."""
+    cgroup = Path(SESSION_CGROUP_ROOT) / f"shell-{uuid.uuid4().hex[:12]}"
+    cgroup.mkdir()
+    try:
+        for name, value in CGROUP_LIMITS:
+            if value:
+                (cgroup / name).write_text(str(value))
+    except OSError:
+        cgroup.rmdir()
+        raise
+    return cgroup
+
+def shell_command(cgroup: Optional[Path] = None) -> List[str]:
+    """argv of a session shell.
+
+    Limits are applied by a bash prelude that then execs the real shell: the
+    shell is forked from threads (the pool, asyncio.to_thread), where running
+    Python between fork and exec isn't safe.
+    """
+    shell = ["/bin/bash", "--rcfile", str(SHELL_RC)]
+    prelude = []
+    for limit, value in SHELL_RLIMITS:
+        if value:
+            # The soft and hard limit both, never above the hard limit we have
+            _, hard = resource.getrlimit(limit)
+            value = value if hard == resource.RLIM_INFINITY else min(value, hard)
+            option, unit = ULIMIT_OPTIONS[limit]
+            prelude.append(f"ulimit {option} {max(value // unit, 1)}")
+    if cgroup is not None:
+        prelude.append(f"echo $$ > {shlex.quote(str(cgroup / 'cgroup.procs'))}")
+    if not prelude:
+        return shell
+    script = " && ".join(prelude) + " || exit 126; exec " + " ".join(shlex.quote(arg) for arg in shell)
+    return ["/bin/bash", "-c", script]
+
+def spawn_shell():
+    """Start /bin/bash on a new PTY; returns (master, process)."""
+    cgroup = create_cgroup() if SESSION_CGROUP_ROOT else None
+    master, slave = pty.openpty()
+    try:
+        set_window_size(slave, SCREEN_COLS, SCREEN_ROWS)
+        # A session of its own: the shell leads its process group and session
+        process = subprocess.Popen(
+            shell_command(cgroup),
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            start_new_session=True
+        )
+    except (OSError, subprocess.SubprocessError):
+        os.close(master)
+        if cgroup is not None:
+            cgroup.rmdir()
+        raise
+    finally:
+        # Only the shell keeps the slave open, so the master sees EOF when it exits
+        os.close(slave)
+    if cgroup is not None:
+        shell_cgroups[process.pid] = cgroup
+    return master, process
+
+def session_pids(session_id: int) -> List[int]:
+    # Every process in a session, including jobs bash moved to their own process groups
+    pids = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return pids
+    for entry in entries:
+        if entry.isdigit():
+            try:
+                if os.getsid(int(entry)) == session_id:
+                    pids.append(int(entry))
+            except OSError:
+                pass
+    return pids
+
+def signal_session(process: subprocess.Popen, sig: int):
+    """Signal the shell's process group and anything else left in its session."""
+    if process.returncode is None:
+        # start_new_session made the shell the leader of its own session and process group
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+    for pid in session_pids(process.pid):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+def remove_cgroup(pid: int):
+    cgroup = shell_cgroups.get(pid)
+    if cgroup is None:
+        return
+    try:
+        cgroup.rmdir()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # Kept for the next attempt; processes may still be leaving it
+        logger.warning("Could not remove cgroup of shell %s: %s", pid, e)
+        return
+    del shell_cgroups[pid]
+
+def kill_remaining(process: subprocess.Popen):
+    """SIGKILL what is left of a shell's session. Scans /proc, so it blocks."""
+    signal_session(process, signal.SIGKILL)
+    if process.poll() is not None:
+        remove_cgroup(process.pid)
+
+def close_shell(shell, grace: float = PTY_KILL_GRACE):
+    """Hang up a shell and wait for it, killing what is left after grace
+    seconds. Blocks, so only call it off the event loop or for a shell that
+    has already exited."""
+    master, process = shell
+    os.close(master)
+    signal_session(process, signal.SIGHUP)
+    try:
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    signal_session(process, signal.SIGKILL)
+    process.wait()
+    remove_cgroup(process.pid)
+
+class PtyPool:
+    """Shells spawned ahead of time, so a host's session starts without a
+    fork/exec (or bash reading its rc files) while they wait.
+
+    A worker thread keeps `size` idle shells ready and refills the pool
+    whenever `take` hands one out.
+    """
+
+    def __init__(self, size: int = PTY_POOL_SIZE):
+        self.size = size
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.stopped = False
+        self.thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self.idle)
+
+    def start(self):
+        if self.size > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._fill, name="pty-pool", daemon=True)
+            self.thread.start()
+            self.wanted.set()
+
+    def _fill(self):
+        while True:
+            self.wanted.wait()
+            with self.lock:
+                if self.stopped:
+                    return
+                if len(self.idle) >= self.size:
+                    self.wanted.clear()
+                    continue
+            try:
+                shell = spawn_shell()
+            except (OSError, subprocess.SubprocessError):
+                logger.exception("Could not pre-spawn a shell")
+                time.sleep(1)
+                continue
+            with self.lock:
+                if self.stopped:
+                    close_shell(shell)
+                    return
+                self.idle.append(shell)
+
+    def take(self):
+        """An idle shell that is still running, or None if the pool is empty."""
+        shell = None
+        with self.lock:
+            while self.idle:
+                candidate = self.idle.popleft()
+                if candidate[1].poll() is None:
+                    shell = candidate
+                    break
+                close_shell(candidate)
+        if self.thread is not None:
+            self.wanted.set()
+        return shell
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            idle, self.idle = list(self.idle), collections.deque()
+        self.wanted.set()
+        for shell in idle:
+            close_shell(shell)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+SESSION_END_MESSAGES = {
+    "exited": "The shell has exited",
+    "idle": "The session was closed after being idle",
+    "lifetime": "The session reached its maximum lifetime"
+}
+
+# Session membership
+MEMBER_IDS = itertools.count(1)
+
+class Member:
+    """One websocket connection to a session."""
+
+    __slots__ = ("id", "ws", "session_id", "username", "has_permission", "is_host",
+                 "stream", "protocol", "queue", "closing", "close_code", "sender", "size",
+                 "token", "detached", "expiry", "compress", "key", "last_command")
+
+    def __init__(self, websocket: WebSocket, session_id: str, username: str, is_host: bool,
+                 stream: bool, protocol: str, compress: bool = False):
+        self.id = next(MEMBER_IDS)
+        self.ws = websocket
+        self.session_id = session_id
+        self.username = username
+        self.has_permission = is_host
+        self.is_host = is_host
+        self.stream = stream or protocol == "binary"
+        self.protocol = protocol
+        self.compress = compress and protocol == "binary"  # output frames may be deflated
+        self.queue: asyncio.Queue = asyncio.Queue(SEND_QUEUE_SIZE)  # str/bytes frames; None asks the sender to close
+        self.closing = False
+        self.close_code = 1000
+        self.sender: Optional[asyncio.Task] = None
+        self.size: Optional[tuple] = None  # (cols, rows) of the member's terminal, once reported
+        self.token = secrets.token_urlsafe(16)  # resume token, handed out in the welcome
+        self.detached = False  # connection dropped, waiting for a resume
+        self.expiry: Optional[asyncio.TimerHandle] = None
+        self.last_command: Optional[int] = None  # newest command result it had been sent when its connection went
+        self.key = ""  # "worker:id", unique across workers; set by the manager
+
+    def public(self) -> Dict:
+        return {
+            "id": self.key,
+            "username": self.username,
+            "has_permission": self.has_permission,
+            "is_host": self.is_host,
+            "detached": self.detached
+        }
+
+class SessionMembers:
+    """A session's members on this worker, indexed by connection id and username.
+
+    Every change bumps `version` and drops the cached views, so member lists,
+    streaming fan-out lists and the serialized member_update are rebuilt at
+    most once per change instead of once per message.
+
+    Members learn about changes from member_delta messages. `sent` is the
+    session's member list (every worker's) as of the last delta, and
+    `sent_version` counts the deltas; changes are batched for
+    MEMBER_UPDATE_DEBOUNCE while `flush` is pending.
+    """
+
+    __slots__ = ("by_id", "by_username", "version", "_public", "_streams", "update_payload",
+                 "sent", "sent_version", "flush", "messages", "announce", "announcements")
+
+    def __init__(self):
+        self.by_id: Dict[int, Member] = {}
+        self.by_username: Dict[str, Dict[int, Member]] = {}  # one user may have several tabs open
+        self.version = 0
+        self.sent: Dict[str, Dict] = {}  # member id: public view, as last delivered
+        self.sent_version = 0
+        self.flush: Optional[asyncio.TimerHandle] = None
+        self.messages: List[str] = []  # system messages for the next delta
+        self.announce = False  # our own members changed; tell the other workers at the flush
+        self.announcements: List[str] = []  # messages to pass on with them
+        self.touch()
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def touch(self):
+        self.version += 1
+        self._public = None
+        self._streams = None
+        self.update_payload = None  # full member_update JSON, built by the manager
+
+    def add(self, member: Member):
+        self.by_id[member.id] = member
+        self.by_username.setdefault(member.username, {})[member.id] = member
+        self.touch()
+
+    def remove(self, member: Member) -> bool:
+        if self.by_id.pop(member.id, None) is None:
+            return False
+        same_name = self.by_username[member.username]
+        del same_name[member.id]
+        if not same_name:
+            del self.by_username[member.username]
+        self.touch()
+        return True
+
+    def set_permission(self, username: str, has_permission: bool) -> bool:
+        changed = False
+        for member in self.by_username.get(username, {}).values():
+            if member.has_permission != has_permission:
+                member.has_permission = has_permission
+                changed = True
+        if changed:
+            self.touch()
+        return changed
+
+    def public(self) -> List[Dict]:
+        if self._public is None:
+            self._public = [member.public() for member in self.by_id.values()]
+        return self._public
+
+    def streams(self):
+        """(binary, deflate, json) members that receive live output."""
+        if self._streams is None:
+            streaming = [member for member in self.by_id.values() if member.stream and not member.detached]
+            self._streams = (
+                tuple(member for member in streaming if member.protocol == "binary" and not member.compress),
+                tuple(member for member in streaming if member.compress),
+                tuple(member for member in streaming if member.protocol == "json")
+            )
+        return self._streams
+
 # WebSocket connection manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[Dict]] = {}  # session_id: [{ws, username, has_permission}]
-        self.pty_processes: Dict[str, Dict] = {}  # session_id: {master, slave, process}
+    def __init__(self, session_bus=None, worker_id: str = WORKER_ID):
+        self.active_connections: Dict[str, SessionMembers] = {}  # session_id: this worker's members
+        self.pty_processes: Dict[str, Dict] = {}  # session_id: {master, process, seq, ...}
+        self.bus = session_bus if session_bus is not None else bus.create_bus(SESSION_BUS)
+        self.worker_id = worker_id
+        self.bus_sessions = set()  # sessions whose events channel we listen to
+        self.mirrors: Dict[str, Dict] = {}  # session_id: output state of a PTY owned by another worker
+        self.remote_members: Dict[str, Dict[str, tuple]] = {}  # session_id: {worker_id: (last seen, members)}
+        self.peers: Dict[str, Dict[str, float]] = {}  # session_id: {worker_id: last heard from}
+        self.heartbeat: Optional[asyncio.Task] = None
+        self.background = set()  # fire-and-forget tasks, referenced until done
+        self.pool = PtyPool()
+        self.lifecycle: Optional[asyncio.Task] = None
+        self.unwatched: Dict[int, tuple] = {}  # pid: (process, on_exit) for shells without a pidfd
+        self.resumable: Dict[str, Member] = {}  # resume token: member
+        self.bulk_output: Dict[str, float] = {}  # session_id: when it last sent rate-limited output
+        self.output_share = float(OUTPUT_WORKER_RATE)  # each busy session's part of OUTPUT_WORKER_RATE
+        self.share_updated = 0.0
 
-    async def connect(self, websocket: WebSocket, session_id: str, username: str, is_host: bool):
+    async def connect(self, websocket: WebSocket, session_id: str, username: str, is_host: bool,
+                      stream: bool = False, protocol: str = "json", compress: bool = False) -> Member:
         await websocket.accept()
         if session_id not in self.active_connections:
-            self.active_connections[session_id] = []
+            self.active_connections[session_id] = SessionMembers()
         
-        self.active_connections[session_id].append({
-            "ws": websocket,
-            "username": username,
-            "has_permission": is_host,
-            "is_host": is_host
-        })
+        member = Member(websocket, session_id, username, is_host, stream, protocol, compress)
+        member.key = f"{self.worker_id}:{member.id}"
+        member.sender = asyncio.create_task(self._send_loop(member))
+        self.active_connections[session_id].add(member)
+        self.resumable[member.token] = member
+        self._join_bus(session_id)
+        if self.heartbeat is None:
+            self.heartbeat = asyncio.create_task(self._heartbeat())
+        return member
 
-    def disconnect(self, websocket: WebSocket, session_id: str):
-        if session_id in self.active_connections:
-            self.active_connections[session_id] = [
-                conn for conn in self.active_connections[session_id] 
-                if conn["ws"] != websocket
-            ]
-            if not self.active_connections[session_id]:
-                del self.active_connections[session_id]
-                # Clean up PTY if exists
-                if session_id in self.pty_processes:
-                    try:
-                        os.close(self.pty_processes[session_id]["master"])
-                        self.pty_processes[session_id]["process"].terminate()
-                    except:
-                        pass
-                    del self.pty_processes[session_id]
-
-    async def broadcast(self, session_id: str, message: dict):
+    async def attach(self, session_id: str, is_host: bool, record: bool = False):
+        """Find the session's PTY for a new member.
+
+        A host starts the PTY unless another worker already owns it; members
+        on any other worker mirror the owner's output from the bus.
+        """
+        if session_id in self.pty_processes:
+            return
+        if is_host and await self.bus.claim(bus_key(session_id, "owner"), self.worker_id, SESSION_OWNER_TTL):
+            await self.create_pty(session_id, record=record)
+        elif session_id not in self.mirrors:
+            self._start_mirror(session_id)
+
+    async def resume(self, websocket: WebSocket, session_id: str, token: str) -> Optional[Member]:
+        """Hand a member's place back to a reconnecting client.
+
+        Also takes over from a connection that is still open, since the
+        server often hasn't noticed yet that a flaky network dropped it.
+        """
+        member = self.resumable.get(token)
+        if member is None or member.session_id != session_id:
+            return None
+        await websocket.accept()
+        if self.resumable.get(token) is not member or member.closing:
+            # Gone while we were accepting
+            return None
+        if member.detached:
+            member.expiry.cancel()
+            member.expiry = None
+            member.detached = False
+        else:
+            self._note_last_command(member)
+            member.sender.cancel()
+            self._spawn(self._close_quietly(member.ws))
+        member.ws = websocket
+        member.queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        member.sender = asyncio.create_task(self._send_loop(member))
+        self.active_connections[session_id].touch()
+        return member
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+    def detach(self, member: Member) -> bool:
+        """Keep a dropped member's place for RESUME_GRACE seconds.
+
+        Detached members get no messages but still count as members, so the
+        session's shell stays up. False if the member can't be resumed.
+        """
+        if member.detached:
+            return True
+        if not RESUME_GRACE or member.closing or member.token not in self.resumable:
+            return False
+        member.detached = True
+        self._note_last_command(member)
+        if member.sender is not asyncio.current_task():
+            member.sender.cancel()
+        member.expiry = asyncio.get_running_loop().call_later(RESUME_GRACE, self._expire, member)
+        self.active_connections[member.session_id].touch()
+        return True
+
+    def _note_last_command(self, member: Member):
+        pty_session = self.output_state(member.session_id)
+        if pty_session is not None:
+            member.last_command = pty_session["history"].newest
+
+    def _expire(self, member: Member):
+        member.expiry = None
+        self.disconnect(member)
+        self._spawn(self.broadcast_members(member.session_id, f"{member.username} left the session"))
+
+    def disconnect(self, member: Member):
+        session_id = member.session_id
+        members = self.active_connections.get(session_id)
+        if members is None or not members.remove(member):
+            return
+        self.resumable.pop(member.token, None)
+        if member.expiry is not None:
+            member.expiry.cancel()
+            member.expiry = None
+        if member.size is not None:
+            self._member_size(session_id, member.key, None)
+        if member.sender is not asyncio.current_task():
+            member.sender.cancel()
+        if not members:
+            if members.flush is not None:
+                members.flush.cancel()
+            del self.active_connections[session_id]
+            if session_id in self.pty_processes:
+                # Members on other workers keep the PTY alive
+                self._close_if_idle(session_id)
+            else:
+                self._leave_bus(session_id)
+
+    def _close_if_idle(self, session_id: str):
+        if session_id not in self.pty_processes:
+            return
+        if self.active_connections.get(session_id) or self.remote_members.get(session_id):
+            return
+        self._close_pty(session_id)
+
+    def _close_pty(self, session_id: str):
+        pty_session = self.pty_processes.pop(session_id)
+        pty_session["reader"].cancel()
+        if pty_session["command_runner"] is not None:
+            pty_session["command_runner"].cancel()
+        if pty_session["recorder"]:
+            pty_session["recorder"].close()
+        logger.info("PTY for session %s closed, output %s", session_id, pty_session["batcher"].stats())
+        pty_session["writer"].close()
+        label = pty_session["label"]
+        PTY_READ_BYTES.remove(label)
+        OUTPUT_FRAMES.remove(label)
+        PTY_INPUT_BYTES.remove(label)
+        PTY_WRITES.remove(label)
+        if pty_session["resize_timer"] is not None:
+            pty_session["resize_timer"].cancel()
+        pty_session["limiter"].cancel()
+        self.bulk_output.pop(session_id, None)
+        self._terminate(pty_session["master"], pty_session["process"])
+        self.bus.unsubscribe(bus_key(session_id, "input"), self._on_input)
+        self._spawn(self.bus.release(bus_key(session_id, "owner"), self.worker_id))
+        self._leave_bus(session_id)
+        session_store.update(session_id, active=False, member_count=0)
+
+    async def broadcast(self, session_id: str, message: dict, stream: Optional[bool] = None):
+        # stream=True/False limits delivery to members that did/didn't opt into streaming
+        self._deliver(session_id, message, stream)
+        if self._has_peers(session_id):
+            self._publish_event(session_id, {"kind": "broadcast", "message": message, "stream": stream})
+
+    def _deliver(self, session_id: str, message: dict, stream: Optional[bool] = None):
+        # Fan a message out to this worker's members of the session
         if session_id in self.active_connections:
-            disconnected = []
-            for connection in self.active_connections[session_id]:
-                try:
-                    await connection["ws"].send_json(message)
-                except:
-                    disconnected.append(connection)
-            
-            for conn in disconnected:
-                self.disconnect(conn["ws"], session_id)
+            # Serialize once; every member's queue shares the same string
+            self._deliver_payload(session_id, json.dumps(message), stream)
+
+    def _deliver_payload(self, session_id: str, payload: str, stream: Optional[bool] = None):
+        started = time.perf_counter() if metrics.ENABLED else 0
+        for member in self.active_connections.get(session_id, ()):
+            if stream is not None and member.stream != stream:
+                continue
+            self.enqueue(member, payload)
+        if metrics.ENABLED:
+            BROADCAST_SECONDS.observe(time.perf_counter() - started)
+
+    async def send(self, member: Member, message: dict):
+        # Direct messages go through the member's queue so they stay ordered with broadcasts
+        self.enqueue(member, json.dumps(message))
+
+    def enqueue(self, member: Member, payload):
+        if member.closing or member.detached:
+            return
+        queue = member.queue
+        if queue.full():
+            # Slow consumer: never let one member hold up the rest of the session
+            SLOW_CONSUMERS.inc(1, SLOW_CONSUMER_POLICY)
+            if SLOW_CONSUMER_POLICY == "drop_oldest":
+                queue.get_nowait()
+            else:
+                dropped = queue.qsize()
+                while not queue.empty():
+                    queue.get_nowait()
+                if SLOW_CONSUMER_POLICY == "disconnect":
+                    self.close_member(member, 1013)
+                    return
+                queue.put_nowait(json.dumps({
+                    "type": "resync",
+                    "dropped": dropped
+                }))
+                # Streaming members start over from a replay; live frames with a
+                # lower seq than the replay are already contained in it
+                replay = self.replay_frame(member)
+                if replay is not None:
+                    queue.put_nowait(replay)
+        queue.put_nowait(payload)
+
+    def close_member(self, member: Member, code: int = 1000):
+        # The sender closes the socket once what is already queued has gone out
+        if member.closing:
+            return
+        if member.detached:
+            self.disconnect(member)
+            return
+        member.closing = True
+        member.close_code = code
+        if member.queue.full():
+            member.queue.get_nowait()
+        member.queue.put_nowait(None)
+
+    def output_state(self, session_id: str) -> Optional[Dict]:
+        # The local PTY, or a synced mirror of one on another worker
+        mirror = self.mirrors.get(session_id)
+        if mirror is not None and mirror["synced"]:
+            return mirror
+        return self.pty_processes.get(session_id)
+
+    def replay_frame(self, member: Member):
+        pty_session = self.output_state(member.session_id)
+        if pty_session is None or not member.stream:
+            return None
+        if JOIN_REPLAY == "snapshot":
+            # One screenful, however long the session has been running
+            data = self._screen(pty_session).snapshot()
+            if member.protocol == "binary":
+                return pack_output(FRAME_SNAPSHOT, pty_session["seq"], data.encode(), member.compress)
+            return json.dumps({
+                "type": "snapshot",
+                "seq": pty_session["seq"],
+                "data": data
+            })
+        if not len(pty_session["scrollback"]):
+            return None
+        data = pty_session["scrollback"].getvalue()
+        if member.protocol == "binary":
+            return pack_output(FRAME_SCROLLBACK, pty_session["seq"], data, member.compress)
+        # Skip a character cut in half by eviction; hold back one still being written
+        text = codecs.getincrementaldecoder('utf-8')(errors='replace').decode(data.lstrip(bytes(range(0x80, 0xC0))))
+        return json.dumps({
+            "type": "scrollback",
+            "seq": pty_session["seq"],
+            "data": text
+        })
+
+    def _screen(self, pty_session: Dict) -> Screen:
+        """The session's screen model, rebuilt from its scrollback if not kept."""
+        screen = pty_session["screen"]
+        if screen is None:
+            screen = pty_session["screen"] = Screen(*pty_session["size"])
+            data = pty_session["scrollback"].getvalue()
+            if len(data) > SNAPSHOT_REBUILD_BYTES:
+                # Start at a line, not inside a character or escape sequence
+                data = data[-SNAPSHOT_REBUILD_BYTES:]
+                data = data[data.find(b"\n") + 1:]
+            pty_session["screen_decoder"].reset()
+            screen.feed(pty_session["screen_decoder"].decode(data))
+        return screen
+
+    def _feed_screen(self, session_id: str, pty_session: Dict, data: bytes) -> float:
+        # Parsing is slow next to everything else done with output, so it only
+        # happens while someone here streams; returns the seconds it took
+        screen = pty_session["screen"]
+        if screen is None:
+            return 0.0
+        members = self.active_connections.get(session_id)
+        if members is None or not any(members.streams()):
+            pty_session["screen"] = None
+            return 0.0
+        started = time.perf_counter()
+        screen.feed(pty_session["screen_decoder"].decode(data))
+        return time.perf_counter() - started
+
+    def send_replay(self, member: Member):
+        replay = self.replay_frame(member)
+        if replay is not None:
+            self.enqueue(member, replay)
+
+    def send_history(self, member: Member, after: Optional[int] = None):
+        """Recent command results, for a member that doesn't stream the terminal.
+
+        A resumed member passes the id of the last result it saw (``after``)
+        and gets only the ones that finished since.
+        """
+        pty_session = self.output_state(member.session_id)
+        if pty_session is None or member.stream:
+            return
+        history = pty_session["history"]
+        for payload in history if after is None else history.since(after):
+            self.enqueue(member, payload)
+
+    def send_missing(self, member: Member, last_seq: int) -> bool:
+        """Send only the output after frame ``last_seq``; False if it's no longer held."""
+        pty_session = self.output_state(member.session_id)
+        if pty_session is None or not member.stream:
+            return False
+        next_seq = pty_session["seq"]
+        # Binary frames carry 32-bit seqs
+        missing = (next_seq - 1 - last_seq) & 0xFFFFFFFF
+        if not missing:
+            return True
+        data = pty_session["scrollback"].since(next_seq - missing)
+        if data is None:
+            return False
+        if member.protocol == "binary":
+            self.enqueue(member, pack_output(FRAME_RESUME, next_seq, data, member.compress))
+        else:
+            self.enqueue(member, json.dumps({
+                "type": "resume",
+                "seq": next_seq,
+                "data": data.decode(errors="replace")
+            }))
+        return True
+
+    async def _send_loop(self, member: Member):
+        queue = member.queue
+        websocket = member.ws
+        try:
+            while True:
+                payload = await queue.get()
+                if payload is None:
+                    if member.close_code == 1013:
+                        logger.info("Disconnecting slow consumer %s from session %s", member.username, member.session_id)
+                    await websocket.close(code=member.close_code)
+                    break
+                if isinstance(payload, bytes):
+                    await websocket.send_bytes(payload)
+                else:
+                    await websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # A failed send is a dropped connection too
+            if self.detach(member):
+                return
+        self.disconnect(member)
+
+    def local_members(self, session_id: str) -> List[Dict]:
+        members = self.active_connections.get(session_id)
+        return members.public() if members is not None else []
 
     def get_members(self, session_id: str) -> List[Dict]:
-        if session_id not in self.active_connections:
-            return []
-        return [{
-            "username": conn["username"],
-            "has_permission": conn["has_permission"],
-            "is_host": conn["is_host"]
-        } for conn in self.active_connections[session_id]]
+        members = list(self.local_members(session_id))
+        for _, remote in self.remote_members.get(session_id, {}).values():
+            members.extend(remote)
+        return members
 
-    def update_permission(self, session_id: str, username: str, has_permission: bool):
+    def _members_changed(self, session_id: str):
+        # Remote lists changed; the cached member_update is stale
         if session_id in self.active_connections:
-            for conn in self.active_connections[session_id]:
-                if conn["username"] == username:
-                    conn["has_permission"] = has_permission
+            self.active_connections[session_id].touch()
 
-    def has_permission(self, session_id: str, username: str) -> bool:
-        if session_id in self.active_connections:
-            for conn in self.active_connections[session_id]:
-                if conn["username"] == username:
-                    return conn["has_permission"]
-        return False
+    def _deliver_members(self, session_id: str, messages: Sequence[str] = ()):
+        """Queue a member_delta for this worker's members of the session.
+
+        Changes are batched for MEMBER_UPDATE_DEBOUNCE, so a join storm costs
+        one delta per window instead of a full list per join per member.
+        """
+        members = self.active_connections.get(session_id)
+        if members is None:
+            return
+        members.messages.extend(messages)
+        if members.flush is None:
+            members.flush = asyncio.get_running_loop().call_later(
+                MEMBER_UPDATE_DEBOUNCE, self._flush_members, session_id, members)
+
+    def _flush_members(self, session_id: str, members: SessionMembers):
+        members.flush = None
+        if self.active_connections.get(session_id) is not members:
+            return
+        if members.announce:
+            members.announce = False
+            self._publish_event(session_id, {
+                "kind": "members",
+                "members": self.local_members(session_id),
+                "messages": members.announcements
+            })
+            members.announcements = []
+        # Copies: remote lists are updated in place, which would hide the change
+        current = {member["id"]: dict(member) for member in self.get_members(session_id)}
+        sent = members.sent
+        changes = []
+        for key, member in current.items():
+            previous = sent.get(key)
+            if previous is None:
+                changes.append({"op": "join", "member": member})
+            elif previous != member:
+                changes.append({"op": "update", "member": member})
+        changes.extend({"op": "leave", "id": key} for key in sent if key not in current)
+        messages, members.messages = members.messages, []
+        if not changes and not messages:
+            return
+        members.sent = current
+        members.sent_version += 1
+        members.update_payload = None
+        self._deliver_payload(session_id, json.dumps({
+            "type": "member_delta",
+            "base": members.sent_version - 1,  # the version these changes apply to
+            "version": members.sent_version,
+            "changes": changes,
+            "messages": messages
+        }))
+        self._record_members(session_id)
+
+    def send_members(self, member: Member):
+        """The full member list, for a member that is new or lost track."""
+        members = self.active_connections.get(member.session_id)
+        if members is None:
+            return
+        if members.update_payload is None:
+            # Pending changes are already in it; deltas are applied idempotently
+            members.update_payload = json.dumps({
+                "type": "member_update",
+                "version": members.sent_version,
+                "members": self.get_members(member.session_id)
+            })
+        self.enqueue(member, members.update_payload)
+
+    def _record_members(self, session_id: str):
+        # The PTY owner sees every worker's members, so only it writes the count
+        if session_id in self.pty_processes:
+            session_store.update(session_id, member_count=len(self.get_members(session_id)))
 
-    def create_pty(self, session_id: str):
+    async def broadcast_members(self, session_id: str, message: Optional[str] = None):
+        """This worker's members of the session changed; tell everyone."""
+        members = self.active_connections.get(session_id)
+        if members is None:
+            # The last one here left; nothing to batch for
+            self._publish_event(session_id, {
+                "kind": "members",
+                "members": [],
+                "messages": [message] if message else []
+            })
+            self._record_members(session_id)
+            return
+        members.announce = True
+        if message:
+            members.announcements.append(message)
+        self._deliver_members(session_id, [message] if message else ())
+
+    def update_permission(self, session_id: str, username: str, has_permission: bool):
+        # Applies to every connection of that user, wherever it is
+        members = self.active_connections.get(session_id)
+        if members is not None and members.set_permission(username, has_permission):
+            # Our list changed; republish it at the next flush
+            members.announce = True
+        for _, remote in self.remote_members.get(session_id, {}).values():
+            for i, member in enumerate(remote):
+                if member["username"] == username and member["has_permission"] != has_permission:
+                    # Replaced, not mutated: announcements compare against these lists
+                    remote[i] = {**member, "has_permission": has_permission}
+                    self._members_changed(session_id)
+
+    async def set_permission(self, session_id: str, username: str, has_permission: bool):
+        # Applied on every worker, since the member may be connected anywhere
+        self.update_permission(session_id, username, has_permission)
+        self._deliver_members(session_id)
+        self._publish_event(session_id, {
+            "kind": "permission",
+            "username": username,
+            "has_permission": has_permission
+        })
+
+    async def create_pty(self, session_id: str, record: bool = False):
         if session_id not in self.pty_processes:
-            master, slave = pty.openpty()
-            process = subprocess.Popen(
-                ["/bin/bash"],
-                stdin=slave,
-                stdout=slave,
-                stderr=slave,
-                preexec_fn=os.setsid
-            )
+            started = time.perf_counter()
+            shell = self.pool.take()
+            PTY_POOL_TAKES.inc(1, "miss" if shell is None else "hit")
+            if shell is None:
+                # Fork/exec off the event loop
+                shell = await asyncio.to_thread(spawn_shell)
+                if session_id in self.pty_processes:
+                    # Another member started it while we waited
+                    self._watch_exit(shell[1], lambda: None)
+                    self._terminate(*shell)
+                    return
+            master, process = shell
+            PTY_START_SECONDS.observe(time.perf_counter() - started)
+            self._watch_exit(process, lambda: self._shell_exited(session_id, process))
+            if self.lifecycle is None:
+                self.lifecycle = asyncio.create_task(self._enforce_limits())
+            # The master fd is driven by the event loop: readiness callbacks feed a
+            # per-session queue drained by a reader task, so no read ever blocks.
+            os.set_blocking(master, False)
+            output = asyncio.Queue()
+            asyncio.get_running_loop().add_reader(master, self._read_output, session_id, master, output)
+            batcher = OutputBatcher(output)
+            label = metrics.session_label(session_id)
+            if metrics.ENABLED:
+                logger.info("Metrics label of session %s is %s", session_id, label)
             self.pty_processes[session_id] = {
                 "master": master,
-                "slave": slave,
-                "process": process
+                "process": process,
+                "started_at": time.monotonic(),
+                "last_activity": time.monotonic(),  # last input or output, for SESSION_IDLE_TIMEOUT
+                "marks": PromptMarks(),
+                "at_prompt": asyncio.Event(),  # the shell is waiting for a command line; set by its first prompt
+                "commands": collections.deque(),  # queued ShellCommands
+                "command": None,  # the running ShellCommand
+                "command_runner": None,
+                "history": CommandHistory(),  # terminal_output messages
+                "decoder": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+                "seq": 0,  # sequence number of the next terminal_chunk frame
+                "scrollback": ScrollbackBuffer(),
+                "screen": None,  # Screen, while streaming members want snapshots
+                "screen_decoder": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+                "size": (SCREEN_COLS, SCREEN_ROWS),
+                "sizes": {},  # "worker:member id": (cols, rows, is_host), most recently updated last
+                "resize_timer": None,
+                "batcher": batcher,
+                "reader": asyncio.create_task(self._pump_output(session_id, batcher)),
+                "writer": PtyWriter(master, label),
+                "limiter": OutputLimiter(),
+                "throttled": False,  # reads are being paused by the output rate limit
+                "recorder": None,
+                "label": label
             }
+            if record and recorder.SAFE_SESSION_ID.match(session_id):
+                self.pty_processes[session_id]["recorder"] = recorder.SessionRecorder(
+                    RECORDINGS_DIR, session_id, SCREEN_COLS, SCREEN_ROWS
+                )
+            # Input from members on other workers; mirrors start over from the new shell
+            self._drop_mirror(session_id)
+            self._join_bus(session_id)
+            self.bus.subscribe(bus_key(session_id, "input"), self._on_input)
+            self._publish_state(session_id)
+            session_store.update(session_id, active=True)
+            self._spawn(self._apply_output_quota(session_id, self.pty_processes[session_id]["limiter"]))
 
-    def execute_command(self, session_id: str, command: str) -> str:
-        if session_id not in self.pty_processes:
-            self.create_pty(session_id)
+    @staticmethod
+    def _read_pty(master: int, output: asyncio.Queue) -> int:
+        try:
+            data = os.read(master, PTY_READ_SIZE)
+        except BlockingIOError:
+            return 0
+        except OSError:
+            data = b""
+        if not data:
+            # EOF/EIO: the shell is gone, stop watching the fd
+            asyncio.get_running_loop().remove_reader(master)
+            output.put_nowait(None)
+            return 0
+        output.put_nowait(data)
+        return len(data)
+
+    def _read_output(self, session_id: str, master: int, output: asyncio.Queue):
+        # Charged as read, so a paused session can't run ahead in its queue
+        size = self._read_pty(master, output)
+        pty_session = self.pty_processes.get(session_id)
+        if size and pty_session is not None:
+            self._limit_output(session_id, pty_session, size)
+
+    async def _pump_output(self, session_id: str, batcher: OutputBatcher):
+        while True:
+            data = await batcher.next_frame()
+            pty_session = self.pty_processes.get(session_id)
+            if pty_session is None:
+                return
+            if data is None:
+                if pty_session["command"] is not None:
+                    pty_session["command"].done.set()
+                return
+            pty_session["last_activity"] = time.monotonic()
+            session_store.touch(session_id)
+            PTY_READ_BYTES.inc(len(data), pty_session["label"])
+            OUTPUT_FRAMES.inc(1, pty_session["label"])
+            self._track_commands(pty_session, data)
+            # Indexed under the seq stream_output is about to assign
+            pty_session["scrollback"].write_frame(pty_session["seq"], data)
+            if pty_session["recorder"]:
+                pty_session["recorder"].output(data)
+            parsed = self._feed_screen(session_id, pty_session, data)
+            if parsed:
+                self._charge_output(session_id, pty_session, seconds=parsed)
+            await self.stream_output(session_id, pty_session, data)
+            if parsed:
+                # Let other sessions in before parsing the next frame
+                await asyncio.sleep(0)
+
+    # Output rate limits
+    async def _apply_output_quota(self, session_id: str, limiter: OutputLimiter):
+        # A session may set its own quota at creation
+        try:
+            session = await session_store.get(session_id)
+        except PyMongoError as e:
+            logger.warning("Could not load the output quota of session %s: %s", session_id, e)
+            return
+        quota = session.get("output_rate_limit") if session else None
+        if quota:
+            limiter.rate = min(quota, OUTPUT_RATE_MAX) if OUTPUT_RATE_MAX else quota
+
+    def _output_rate(self, session_id: str, limiter: OutputLimiter) -> float:
+        if not OUTPUT_WORKER_RATE:
+            return limiter.rate
+        # Sessions that sent rate-limited output lately split the worker's rate
+        now = time.monotonic()
+        self.bulk_output[session_id] = now
+        if now - self.share_updated > OUTPUT_SHARE_INTERVAL:
+            stale = now - OUTPUT_SHARE_INTERVAL
+            for busy in [busy for busy, seen in self.bulk_output.items() if seen < stale]:
+                del self.bulk_output[busy]
+            self.output_share = OUTPUT_WORKER_RATE / len(self.bulk_output)
+            self.share_updated = now
+        return min(limiter.rate, self.output_share) if limiter.rate else self.output_share
+
+    def _limit_output(self, session_id: str, pty_session: Dict, size: int):
+        if not pty_session["limiter"].is_echo(size):
+            self._charge_output(session_id, pty_session, size)
+
+    def _charge_output(self, session_id: str, pty_session: Dict, size: int = 0, seconds: float = 0.0):
+        # seconds: event loop time the output cost on top of its size (screen
+        # parsing), charged as the bytes the session could have sent meanwhile
+        limiter = pty_session["limiter"]
+        rate = self._output_rate(session_id, limiter)
+        if not rate:
+            return
+        delay = limiter.charge(size + seconds * rate, rate)
+        if delay <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        if limiter.resume is None:
+            # Stop reading; the shell blocks on the full tty until we resume
+            loop.remove_reader(pty_session["master"])
+            OUTPUT_THROTTLES.inc()
+        else:
+            limiter.resume.cancel()
+        limiter.resume = loop.call_later(delay, self._resume_output, session_id, pty_session)
+        if limiter.clear is not None:
+            limiter.clear.cancel()
+            limiter.clear = None
+        self._set_throttled(session_id, pty_session, True)
+
+    def _resume_output(self, session_id: str, pty_session: Dict):
+        limiter = pty_session["limiter"]
+        limiter.resume = None
+        if self.pty_processes.get(session_id) is not pty_session or pty_session["batcher"].eof:
+            return
+        loop = asyncio.get_running_loop()
+        loop.add_reader(pty_session["master"], self._read_output, session_id,
+                        pty_session["master"], pty_session["batcher"].source)
+        limiter.clear = loop.call_later(OUTPUT_THROTTLE_HOLD, self._set_throttled, session_id, pty_session, False)
+
+    def _set_throttled(self, session_id: str, pty_session: Dict, throttled: bool):
+        if not throttled:
+            pty_session["limiter"].clear = None
+        if pty_session["throttled"] == throttled:
+            return
+        pty_session["throttled"] = throttled
+        self._deliver(session_id, {"type": "output_throttled", "throttled": throttled})
+        self._publish_event(session_id, {"kind": "throttled", "throttled": throttled})
+
+    def output_throttled(self, session_id: str) -> bool:
+        pty_session = self.output_state(session_id)
+        return pty_session["throttled"] if pty_session else False
+
+    async def stream_output(self, session_id: str, pty_session: Dict, data: bytes):
+        seq = pty_session["seq"]
+        pty_session["seq"] = seq + 1
+        # Mirrors on other workers get the same frame
+        if self._has_peers(session_id):
+            self.bus.publish(bus_key(session_id, "output"), pack_frame(FRAME_OUTPUT, seq, data))
+        self._fan_out(session_id, pty_session, seq, data)
+
+    def _fan_out(self, session_id: str, pty_session: Dict, seq: int, data: bytes):
+        started = time.perf_counter() if metrics.ENABLED else 0
+        members = self.active_connections.get(session_id)
+        binary_members, deflate_members, json_members = members.streams() if members is not None else ((), (), ())
         
-        master = self.pty_processes[session_id]["master"]
+        # Binary members get the raw bytes; each encoding is built at most once
+        if binary_members:
+            binary_frame = pack_frame(FRAME_OUTPUT, seq, data)
+            for member in binary_members:
+                self.enqueue(member, binary_frame)
         
+        if deflate_members:
+            # Compressed once, however large the audience
+            deflate_frame = pack_output(FRAME_OUTPUT, seq, data, True)
+            COMPRESSION_BYTES.inc(len(data), "raw")
+            COMPRESSION_BYTES.inc(len(deflate_frame) - FRAME_HEADER.size, "compressed")
+            for member in deflate_members:
+                self.enqueue(member, deflate_frame)
+        
+        if not json_members:
+            # Nobody needs text; drop any half-decoded character instead of decoding
+            pty_session["decoder"].reset()
+        else:
+            # The incremental decoder holds back multi-byte sequences split across reads
+            text = pty_session["decoder"].decode(data)
+            if text:
+                payload = json.dumps({
+                    "type": "terminal_chunk",
+                    "seq": seq,
+                    "data": text
+                })
+                for member in json_members:
+                    self.enqueue(member, payload)
+        if metrics.ENABLED:
+            BROADCAST_SECONDS.observe(time.perf_counter() - started)
+
+    async def write_input(self, session_id: str, data: bytes):
+        if session_id in self.mirrors:
+            # The PTY lives on another worker
+            self.bus.publish(bus_key(session_id, "input"), data)
+            return
+        if session_id not in self.pty_processes:
+            await self.create_pty(session_id)
+        pty_session = self.pty_processes[session_id]
+        pty_session["writer"].write(data)
+        pty_session["limiter"].input()
+        pty_session["last_activity"] = time.monotonic()
+        session_store.touch(session_id)
+        if pty_session["recorder"] and RECORD_INPUT:
+            pty_session["recorder"].input(data)
+        # Backpressure: the caller stops reading its socket while the tty is full
+        await pty_session["writer"].drain()
+
+    # Commands
+    def _track_commands(self, pty_session: Dict, data: bytes):
+        # Follow the shell through its integration marks; output between the
+        # running command's start and end marks is that command's
+        command = pty_session["command"]
+        for part in pty_session["marks"].feed(data):
+            if isinstance(part, bytes):
+                if command is not None and command.written:
+                    room = COMMAND_OUTPUT_BYTES - len(command.output)
+                    if room > 0:
+                        command.output += part[:room]
+                continue
+            mark = part[0]
+            if mark == "A":
+                pty_session["at_prompt"].set()
+            elif mark == "C":
+                pty_session["at_prompt"].clear()
+                if command is not None:
+                    # Up to here it was the echoed command line
+                    command.output.clear()
+            elif mark == "D" and command is not None and command.written:
+                command.exit_code = part[1]
+                command.done.set()
+                command = None  # the prompt that follows isn't its output
+
+    def _start_runner(self, session_id: str, pty_session: Dict):
+        runner = pty_session["command_runner"]
+        if runner is None or runner.done():
+            pty_session["command_runner"] = asyncio.create_task(self._run_commands(session_id, pty_session))
+
+    async def _run_commands(self, session_id: str, pty_session: Dict):
+        commands = pty_session["commands"]
+        while commands:
+            command = commands.popleft()
+            command.status = "running"
+            pty_session["command"] = command
+            try:
+                await self._run_command(session_id, pty_session, command)
+            finally:
+                pty_session["command"] = None
+            await self._command_finished(session_id, command)
+
+    async def _run_command(self, session_id: str, pty_session: Dict, command: ShellCommand):
+        # Never type into a program that is still running (it would reach the
+        # shell once the program exits): wait for the prompt. A program that
+        # reads keys itself (python3, less, vim) gets the line as its input.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + command.timeout
+        while not pty_session["at_prompt"].is_set():
+            if self._reading_program(pty_session):
+                command.status = "input"
+                await self.write_input(session_id, (command.command + "\r").encode())
+                # Let it take effect (exit() brings the prompt back) before the next command looks
+                try:
+                    await asyncio.wait_for(pty_session["at_prompt"].wait(), COMMAND_INPUT_SETTLE)
+                except asyncio.TimeoutError:
+                    pass
+                return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                command.status = "busy"
+                return
+            waiters = [asyncio.ensure_future(pty_session["at_prompt"].wait()), asyncio.ensure_future(command.done.wait())]
+            await asyncio.wait(waiters, timeout=min(remaining, COMMAND_PROMPT_POLL), return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+            if command.done.is_set():
+                return  # cancelled while waiting
+        await self.broadcast(session_id, {
+            "type": "command",
+            "id": command.id,
+            "command": command.command,
+            "username": command.username
+        }, stream=True)
+        started = time.perf_counter()
+        command.written = True
+        await self.write_input(session_id, (command.command + "\n").encode())
         try:
-            os.write(master, (command + "\n").encode())
-            
-            # Read output with timeout
-            output = ""
-            timeout = 0.5
-            start_time = asyncio.get_event_loop().time()
-            
-            while asyncio.get_event_loop().time() - start_time < timeout:
-                ready, _, _ = select.select([master], [], [], 0.1)
-                if ready:
-                    try:
-                        data = os.read(master, 4096).decode('utf-8', errors='replace')
-                        output += data
-                    except:
-                        break
+            await asyncio.wait_for(command.done.wait(), command.timeout)
+        except asyncio.TimeoutError:
+            self._interrupt(pty_session, command, "timeout")
+            await command.done.wait()
+        if command.status == "running":
+            command.status = "completed"
+        COMMAND_SECONDS.observe(time.perf_counter() - started)
+
+    @staticmethod
+    def _reading_program(pty_session: Dict) -> bool:
+        # Something other than the shell holds the terminal, in raw mode
+        master = pty_session["master"]
+        try:
+            foreground = os.tcgetpgrp(master)
+            local_modes = termios.tcgetattr(master)[3]
+        except (OSError, termios.error):
+            return False
+        return foreground != pty_session["process"].pid and not local_modes & termios.ICANON
+
+    def _interrupt(self, pty_session: Dict, command: ShellCommand, status: str):
+        command.status = status
+        try:
+            # Whatever runs in the foreground, not the shell's whole session
+            os.killpg(os.tcgetpgrp(pty_session["master"]), signal.SIGINT)
+        except OSError:
+            pass
+        # A program that ignores SIGINT keeps running, but the queue moves on
+        asyncio.get_running_loop().call_later(COMMAND_INTERRUPT_GRACE, command.done.set)
+
+    async def _command_finished(self, session_id: str, command: ShellCommand):
+        COMMANDS.inc(1, command.status)
+        message = {
+            "type": "terminal_output",
+            "id": command.id,
+            "command": command.command,
+            "output": command.output.decode('utf-8', errors='replace'),
+            "username": command.username,
+            "exit_code": command.exit_code,
+            "status": command.status
+        }
+        pty_session = self.pty_processes.get(session_id)
+        if pty_session is not None:
+            pty_session["history"].append(message)
+        await self.broadcast(session_id, message, stream=False)
+        await self.broadcast(session_id, {
+            "type": "command_finished",
+            "id": command.id,
+            "username": command.username,
+            "exit_code": command.exit_code,
+            "status": command.status
+        }, stream=True)
+
+    # Terminal size
+    def request_resize(self, member: Member, cols: int, rows: int):
+        """Record a member's terminal size; the PTY follows RESIZE_POLICY."""
+        member.size = (cols, rows)
+        self._member_size(member.session_id, member.key, (cols, rows, member.is_host))
+
+    def _member_size(self, session_id: str, key: str, size: Optional[tuple]):
+        # size None: the member left
+        if session_id in self.mirrors:
+            self._publish_event(session_id, {"kind": "resize", "member": key, "size": size})
+            return
+        pty_session = self.pty_processes.get(session_id)
+        if pty_session is None:
+            return
+        sizes = pty_session["sizes"]
+        sizes.pop(key, None)
+        if size is not None:
+            sizes[key] = tuple(size)
+        if RESIZE_POLICY == "fixed":
+            return
+        # Debounce: dragging a window sends a burst of sizes; apply the last one
+        if pty_session["resize_timer"] is not None:
+            pty_session["resize_timer"].cancel()
+        pty_session["resize_timer"] = asyncio.get_running_loop().call_later(
+            RESIZE_DEBOUNCE, self._apply_size, session_id)
+
+    def _apply_size(self, session_id: str):
+        pty_session = self.pty_processes.get(session_id)
+        if pty_session is None:
+            return
+        pty_session["resize_timer"] = None
+        sizes = list(pty_session["sizes"].values())
+        if RESIZE_POLICY == "host":
+            sizes = [size for size in sizes if size[2]]
+            if not sizes:
+                return
+            cols, rows = sizes[-1][:2]
+        else:
+            if not sizes:
+                return
+            cols = min(size[0] for size in sizes)
+            rows = min(size[1] for size in sizes)
+        if (cols, rows) == pty_session["size"]:
+            return
+        pty_session["size"] = (cols, rows)
+        try:
+            set_window_size(pty_session["master"], cols, rows)
+        except OSError as e:
+            logger.warning("Could not resize PTY of session %s: %s", session_id, e)
+            return
+        if pty_session["screen"] is not None:
+            pty_session["screen"].resize(cols, rows)
+        if pty_session["recorder"]:
+            pty_session["recorder"].resize(cols, rows)
+        self._deliver(session_id, {"type": "resize", "cols": cols, "rows": rows})
+        self._publish_event(session_id, {"kind": "resized", "cols": cols, "rows": rows})
+
+    # Shell lifecycle
+    def _terminate(self, master: int, process: subprocess.Popen):
+        # Hang up now; SIGKILL whatever ignores it once the grace period is over
+        asyncio.get_running_loop().remove_reader(master)
+        try:
+            os.close(master)
+        except OSError:
+            pass
+        # signal_session scans /proc, which takes a while with many processes
+        self._spawn(asyncio.to_thread(signal_session, process, signal.SIGHUP))
+        asyncio.get_running_loop().call_later(PTY_KILL_GRACE, self._kill_remaining, process)
+
+    def _kill_remaining(self, process: subprocess.Popen):
+        self._spawn(asyncio.to_thread(kill_remaining, process))
+
+    def _watch_exit(self, process: subprocess.Popen, on_exit):
+        """Reap the shell as soon as it exits, then call on_exit."""
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            # No pidfd (non-Linux or an old kernel): _enforce_limits polls instead
+            self.unwatched[process.pid] = (process, on_exit)
+            return
+        asyncio.get_running_loop().add_reader(pidfd, self._reap, pidfd, process, on_exit)
+
+    @staticmethod
+    def _reap(pidfd: int, process: subprocess.Popen, on_exit):
+        asyncio.get_running_loop().remove_reader(pidfd)
+        os.close(pidfd)
+        process.poll()
+        remove_cgroup(process.pid)
+        on_exit()
+
+    def _shell_exited(self, session_id: str, process: subprocess.Popen):
+        logger.info("Shell %s of session %s exited with %s", process.pid, session_id, process.returncode)
+        pty_session = self.pty_processes.get(session_id)
+        if pty_session is not None and pty_session["process"] is process:
+            self.end_session(session_id, "exited")
+
+    def end_session(self, session_id: str, reason: str):
+        """Stop a session's shell and disconnect its members on every worker."""
+        SESSIONS_ENDED.inc(1, reason)
+        self._publish_event(session_id, {"kind": "ended", "reason": reason})
+        self._close_members(session_id, reason)
+        if session_id in self.pty_processes:
+            self._close_pty(session_id)
+
+    def _close_members(self, session_id: str, reason: str):
+        self._deliver(session_id, {
+            "type": "session_ended",
+            "reason": reason,
+            "message": SESSION_END_MESSAGES.get(reason, "The session has ended")
+        })
+        for member in list(self.active_connections.get(session_id, ())):
+            self.close_member(member)
+
+    async def _enforce_limits(self):
+        while True:
+            await asyncio.sleep(LIFECYCLE_INTERVAL)
+            for pid, (process, on_exit) in list(self.unwatched.items()):
+                if process.poll() is not None:
+                    del self.unwatched[pid]
+                    remove_cgroup(pid)
+                    on_exit()
+            now = time.monotonic()
+            for session_id, pty_session in list(self.pty_processes.items()):
+                if SESSION_MAX_LIFETIME and now - pty_session["started_at"] >= SESSION_MAX_LIFETIME:
+                    self.end_session(session_id, "lifetime")
+                elif SESSION_IDLE_TIMEOUT and now - pty_session["last_activity"] >= SESSION_IDLE_TIMEOUT:
+                    self.end_session(session_id, "idle")
+
+    async def run_command(self, session_id: str, command: str, username: str,
+                          timeout: Optional[float] = None):
+        """Queue a command on the session's shell, wherever it runs.
+
+        Commands run one at a time in arrival order. Non-streaming members
+        get each one's output as terminal_output once it finishes; streaming
+        members see it live, between command and command_finished.
+        """
+        if session_id in self.mirrors:
+            self._publish_event(session_id, {
+                "kind": "execute", "command": command, "username": username, "timeout": timeout
+            })
+            return
+        if session_id not in self.pty_processes:
+            await self.create_pty(session_id)
+        pty_session = self.pty_processes[session_id]
+        timeout = min(timeout or COMMAND_TIMEOUT, COMMAND_MAX_TIMEOUT)
+        queued = ShellCommand(command, username, timeout)
+        commands = pty_session["commands"]
+        if len(commands) >= COMMAND_QUEUE_SIZE:
+            queued.status = "rejected"
+            await self._command_finished(session_id, queued)
+            return
+        commands.append(queued)
+        await self.broadcast(session_id, {
+            "type": "command_queued",
+            "id": queued.id,
+            "command": command,
+            "username": username,
+            "position": len(commands) - (pty_session["command"] is None)
+        })
+        self._start_runner(session_id, pty_session)
+
+    async def cancel_command(self, session_id: str, command_id: int, username: str, is_host: bool):
+        """Drop a queued command, or interrupt it if it is running.
+
+        Allowed for whoever asked for the command, and for the host.
+        """
+        if session_id in self.mirrors:
+            self._publish_event(session_id, {
+                "kind": "cancel", "id": command_id, "username": username, "is_host": is_host
+            })
+            return
+        pty_session = self.pty_processes.get(session_id)
+        if pty_session is None:
+            return
+        running = pty_session["command"]
+        if running is not None and running.id == command_id:
+            if (is_host or running.username == username) and running.status == "running":
+                if running.written:
+                    self._interrupt(pty_session, running, "cancelled")
                 else:
-                    if output:
-                        break
-            
-            return output
-        except Exception as e:
-            return f"Error: {str(e)}"
+                    running.status = "cancelled"
+                    running.done.set()
+            return
+        for queued in pty_session["commands"]:
+            if queued.id == command_id:
+                if is_host or queued.username == username:
+                    pty_session["commands"].remove(queued)
+                    queued.status = "cancelled"
+                    await self._command_finished(session_id, queued)
+                return
+
+    # Cross-worker bus
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    def _has_peers(self, session_id: str) -> bool:
+        # Whether another worker follows the session; with a single worker
+        # (memory://) nobody does, and broadcasts and output skip the bus
+        return session_id in self.mirrors or bool(self.peers.get(session_id))
+
+    def _publish_event(self, session_id: str, event: Dict):
+        event["origin"] = self.worker_id
+        self.bus.publish(bus_key(session_id, "events"), json.dumps(event).encode())
+
+    def _join_bus(self, session_id: str):
+        if session_id not in self.bus_sessions:
+            self.bus_sessions.add(session_id)
+            self.bus.subscribe(bus_key(session_id, "events"), self._on_event)
+            # Other workers answer with their members
+            self._publish_event(session_id, {"kind": "hello"})
+
+    def _leave_bus(self, session_id: str):
+        self._drop_mirror(session_id)
+        self.remote_members.pop(session_id, None)
+        self.peers.pop(session_id, None)
+        if session_id in self.bus_sessions:
+            self.bus_sessions.discard(session_id)
+            self.bus.unsubscribe(bus_key(session_id, "events"), self._on_event)
+
+    def _start_mirror(self, session_id: str):
+        self.mirrors[session_id] = {
+            "seq": 0,
+            "scrollback": ScrollbackBuffer(),
+            "screen": None,
+            "screen_decoder": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+            "decoder": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+            "size": (SCREEN_COLS, SCREEN_ROWS),
+            "throttled": False,
+            "history": CommandHistory(),
+            "synced": False  # output is ignored until the owner sends its state
+        }
+        self.bus.subscribe(bus_key(session_id, "output"), self._on_output)
+        self._publish_event(session_id, {"kind": "sync"})
+
+    def _drop_mirror(self, session_id: str):
+        if self.mirrors.pop(session_id, None) is not None:
+            self.bus.unsubscribe(bus_key(session_id, "output"), self._on_output)
+
+    def _publish_state(self, session_id: str, target: Optional[str] = None):
+        # Everything a mirror needs to join mid-session; target None resets all mirrors
+        pty_session = self.pty_processes[session_id]
+        self._publish_event(session_id, {
+            "kind": "state",
+            "target": target,
+            "seq": pty_session["seq"],
+            "size": pty_session["size"],
+            "throttled": pty_session["throttled"],
+            "history": list(pty_session["history"]),  # serialized messages
+            # Mirrors without a snapshot rebuild the screen from the scrollback
+            "snapshot": pty_session["screen"].snapshot() if pty_session["screen"] is not None else None,
+            "scrollback": base64.b64encode(pty_session["scrollback"].getvalue()).decode()
+        })
+
+    @staticmethod
+    def _bus_session(channel: str) -> str:
+        return channel[len(BUS_PREFIX):].rsplit(":", 1)[0]
+
+    def _on_output(self, channel: str, payload: bytes):
+        session_id = self._bus_session(channel)
+        mirror = self.mirrors.get(session_id)
+        if mirror is None or not mirror["synced"]:
+            return
+        _, seq, data = unpack_frame(payload)
+        if seq < mirror["seq"]:
+            return
+        mirror["seq"] = seq + 1
+        mirror["scrollback"].write_frame(seq, data)
+        self._feed_screen(session_id, mirror, data)
+        self._fan_out(session_id, mirror, seq, data)
+
+    def _on_input(self, channel: str, payload: bytes):
+        self._spawn(self.write_input(self._bus_session(channel), payload))
+
+    def _on_event(self, channel: str, payload: bytes):
+        event = json.loads(payload)
+        origin = event["origin"]
+        if origin == self.worker_id:
+            return
+        session_id = self._bus_session(channel)
+        kind = event["kind"]
+        if kind == "members" and not event["members"]:
+            # Its last member of the session left
+            self.peers.get(session_id, {}).pop(origin, None)
+        else:
+            self.peers.setdefault(session_id, {})[origin] = time.monotonic()
+        if kind == "broadcast":
+            mirror = self.mirrors.get(session_id)
+            if mirror is not None and event["message"].get("type") == "terminal_output":
+                mirror["history"].append(event["message"])
+            self._deliver(session_id, event["message"], event["stream"])
+        elif kind == "members":
+            remote = self.remote_members.setdefault(session_id, {})
+            previous = remote.get(origin, (0, []))[1]
+            if event["members"]:
+                remote[origin] = (time.monotonic(), event["members"])
+            else:
+                remote.pop(origin, None)
+            # Periodic re-announcements only refresh the entry
+            if event["members"] != previous:
+                self._members_changed(session_id)
+                self._record_members(session_id)
+            if event["members"] != previous or event.get("messages"):
+                self._deliver_members(session_id, event.get("messages", ()))
+            self._close_if_idle(session_id)
+        elif kind == "permission":
+            self.update_permission(session_id, event["username"], event["has_permission"])
+            self._deliver_members(session_id)
+        elif kind == "hello":
+            if session_id in self.active_connections:
+                self._publish_event(session_id, {"kind": "members", "members": self.local_members(session_id)})
+        elif kind == "sync":
+            if session_id in self.pty_processes:
+                self._publish_state(session_id, target=origin)
+        elif kind == "state":
+            mirror = self.mirrors.get(session_id)
+            if mirror is None or event["target"] not in (None, self.worker_id):
+                return
+            cols, rows = event["size"]
+            first = not mirror["synced"]
+            mirror.update({
+                "seq": event["seq"],
+                "scrollback": ScrollbackBuffer(),
+                "screen": None,
+                "size": (cols, rows),
+                "throttled": event["throttled"],
+                "history": CommandHistory(),
+                "synced": True
+            })
+            mirror["history"].extend(event["history"])
+            mirror["scrollback"].write(base64.b64decode(event["scrollback"]))
+            if event["snapshot"] is not None:
+                mirror["screen"] = Screen(cols, rows)
+                mirror["screen"].feed(event["snapshot"])
+            mirror["screen_decoder"].reset()
+            mirror["decoder"].reset()
+            for member in self.active_connections.get(session_id, ()):
+                self.send_replay(member)
+                if first:
+                    # They joined before the mirror had anything to show
+                    self.send_history(member)
+        elif kind == "ended":
+            self._close_members(session_id, event["reason"])
+        elif kind == "resize":
+            if session_id in self.pty_processes:
+                self._member_size(session_id, event["member"], event["size"])
+        elif kind == "resized":
+            mirror = self.mirrors.get(session_id)
+            if mirror is not None:
+                mirror["size"] = (event["cols"], event["rows"])
+                if mirror["screen"] is not None:
+                    mirror["screen"].resize(event["cols"], event["rows"])
+            self._deliver(session_id, {"type": "resize", "cols": event["cols"], "rows": event["rows"]})
+        elif kind == "throttled":
+            mirror = self.mirrors.get(session_id)
+            if mirror is not None:
+                mirror["throttled"] = event["throttled"]
+            self._deliver(session_id, {"type": "output_throttled", "throttled": event["throttled"]})
+        elif kind == "execute":
+            if session_id in self.pty_processes:
+                self._spawn(self.run_command(session_id, event["command"], event["username"], event["timeout"]))
+        elif kind == "cancel":
+            if session_id in self.pty_processes:
+                self._spawn(self.cancel_command(session_id, event["id"], event["username"], event["is_host"]))
+
+    async def _heartbeat(self):
+        # Keep PTY ownership and our member lists alive on the bus; forget
+        # members of workers that stopped announcing them
+        while True:
+            await asyncio.sleep(SESSION_OWNER_TTL / 3)
+            try:
+                for session_id in list(self.pty_processes):
+                    if not await self.bus.refresh(bus_key(session_id, "owner"), self.worker_id, SESSION_OWNER_TTL):
+                        logger.warning("Lost bus ownership of session %s", session_id)
+                for session_id in list(self.active_connections):
+                    self._publish_event(session_id, {"kind": "members", "members": self.local_members(session_id)})
+            except (ConnectionError, bus.BusError) as e:
+                logger.warning("Bus heartbeat failed: %s", e)
+            expired = time.monotonic() - SESSION_OWNER_TTL
+            for session_id, remote in list(self.remote_members.items()):
+                stale = [worker for worker, (seen, _) in remote.items() if seen < expired]
+                for worker in stale:
+                    del remote[worker]
+                if stale:
+                    self._members_changed(session_id)
+                    self._deliver_members(session_id)
+                    self._close_if_idle(session_id)
+            for session_id, peers in list(self.peers.items()):
+                for worker in [worker for worker, seen in peers.items() if seen < expired]:
+                    del peers[worker]
+                if not peers:
+                    del self.peers[session_id]
 
 manager = ConnectionManager()
 
+# Gauges read from the manager at scrape time
+metrics.registry.callback_gauge(
+    "termdesk_active_sessions", "Sessions with at least one member", (),
+    lambda: [((), len(manager.active_connections))])
+metrics.registry.callback_gauge(
+    "termdesk_active_ptys", "Running session shells", (),
+    lambda: [((), len(manager.pty_processes))])
+metrics.registry.callback_gauge(
+    "termdesk_pty_pool_idle", "Pre-spawned shells waiting for a session", (),
+    lambda: [((), len(manager.pool))])
+metrics.registry.callback_gauge(
+    "termdesk_session_members", "Members per session", ("session",),
+    lambda: [((metrics.session_label(session_id),), len(members))
+             for session_id, members in manager.active_connections.items()])
+metrics.registry.callback_gauge(
+    "termdesk_send_queue_depth", "Deepest member send queue per session", ("session",),
+    lambda: [((metrics.session_label(session_id),), max(member.queue.qsize() for member in members))
+             for session_id, members in manager.active_connections.items() if members])
+
+async def monitor_event_loop():
+    # A task that should wake every LOOP_LAG_INTERVAL; anything later is loop lag
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
 # Models
 class Session(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -151,9 +2241,14 @@ class Session(BaseModel):
     host_username: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     active: bool = True
+    member_count: int = 0
+    # Kept as a BSON date: the TTL index expires sessions by it
+    last_activity: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    output_rate_limit: Optional[int] = None  # bytes/s; None uses OUTPUT_RATE_LIMIT
 
 class SessionCreate(BaseModel):
     host_username: str
+    output_rate_limit: Optional[int] = Field(default=None, gt=0)  # capped at OUTPUT_RATE_MAX
 
 # API Routes
 @api_router.get("/")
@@ -162,101 +2257,278 @@ async def root():
 
 @api_router.post("/sessions", response_model=Session)
 async def create_session(input: SessionCreate):
-    session = Session(host_username=input.host_username)
+    session = Session(host_username=input.host_username, output_rate_limit=input.output_rate_limit)
     doc = session.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.sessions.insert_one(doc)
+    await session_store.insert(doc)
     return session
 
 @api_router.get("/sessions/{session_id}")
 async def get_session(session_id: str):
-    session = await db.sessions.find_one({"session_id": session_id}, {"_id": 0})
+    session = await session_store.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Not under /api, so it isn't exposed wherever the app's API is
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    if metrics.TOKEN and not secrets.compare_digest(
+            request.headers.get("authorization", ""), f"Bearer {metrics.TOKEN}"):
+        raise HTTPException(status_code=401, detail="Metrics need a bearer token")
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@api_router.get("/sessions/{session_id}/recording")
+async def get_recording(session_id: str, start: float = 0.0, end: Optional[float] = None):
+    # Asciicast v2 header plus the output between start and end (seconds)
+    cast = await asyncio.to_thread(recorder.read_range, RECORDINGS_DIR, session_id, start, end, False)
+    if cast is None:
+        raise HTTPException(status_code=404, detail="Recording not found")
+    return Response(content=cast, media_type="application/x-asciicast")
+
+@api_router.get("/sessions/{session_id}/replay")
+async def replay_session(session_id: str, speed: float = 1.0, start: float = 0.0, end: Optional[float] = None):
+    # Streams the recording from `start` at `speed`x real time (0 = no pacing)
+    if speed < 0:
+        raise HTTPException(status_code=400, detail="speed must not be negative")
+    if await asyncio.to_thread(recorder.read_index, RECORDINGS_DIR, session_id) is None:
+        raise HTTPException(status_code=404, detail="Recording not found")
+    
+    async def events():
+        chunks = recorder.iter_chunks(RECORDINGS_DIR, session_id, start, end, include_input=False)
+        previous = start
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            for line in chunk:
+                if speed and line.startswith("["):
+                    elapsed = json.loads(line)[0]
+                    if elapsed > previous:
+                        await asyncio.sleep((elapsed - previous) / speed)
+                        previous = elapsed
+                yield line
+    
+    return StreamingResponse(events(), media_type="application/x-asciicast")
+
+@api_router.get("/sessions/{session_id}/search")
+async def search_session(session_id: str, q: str, limit: int = 50):
+    # Word/prefix search: each word of q must start a word of the output, so
+    # text from the middle of a word isn't found. truncated means only the
+    # first recorder.MAX_SEARCH_CHUNKS candidate chunks were searched.
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    found = await asyncio.to_thread(recorder.search, RECORDINGS_DIR, session_id, q, max(1, min(limit, 500)))
+    if found is None:
+        raise HTTPException(status_code=404, detail="Recording not found")
+    return {"session_id": session_id, "query": q, **found}
+
+async def handle_message(member: Member, message: Dict):
+    """Act on one JSON message from a member.
+
+    A malformed message raises KeyError, TypeError, ValueError or
+    AttributeError, which the endpoint answers with an error.
+    """
+    session_id, username, is_host = member.session_id, member.username, member.is_host
+    kind = message["type"]
+    if kind == "input":
+        # Raw keystrokes (Ctrl-C, arrows, tab completion) for interactive programs
+        if not member.has_permission:
+            await manager.send(member, {
+                "type": "error",
+                "message": "You don't have permission to send input"
+            })
+            return
+        await manager.write_input(session_id, message["data"].encode())
+    
+    elif kind == "resize":
+        # Terminal size of this member; the PTY follows RESIZE_POLICY
+        try:
+            cols, rows = int(message["cols"]), int(message["rows"])
+        except (KeyError, TypeError, ValueError):
+            cols = rows = 0
+        if not (0 < cols <= MAX_COLS and 0 < rows <= MAX_ROWS):
+            await manager.send(member, {
+                "type": "error",
+                "message": f"Terminal size must be between 1x1 and {MAX_COLS}x{MAX_ROWS}"
+            })
+            return
+        manager.request_resize(member, cols, rows)
+    
+    elif kind == "execute_command":
+        command = message["command"]
+        if not isinstance(command, str):
+            raise TypeError("command must be a string")
+        if "\n" in command or "\r" in command:
+            # Each line would end a command of its own, and their output couldn't be told apart
+            await manager.send(member, {
+                "type": "error",
+                "message": "Commands must be a single line"
+            })
+            return
+        # Attributed to the sending connection, not a name it claims
+        requester = username
+        
+        # Check permission
+        if not member.has_permission:
+            await manager.send(member, {
+                "type": "error",
+                "message": "You don't have permission to execute commands"
+            })
+            return
+        
+        # Queued behind other members' commands; the output is broadcast when it finishes
+        try:
+            timeout = float(message["timeout"]) if message.get("timeout") else None
+        except (TypeError, ValueError):
+            timeout = None
+        if timeout is not None and not timeout > 0:
+            timeout = None
+        await manager.run_command(session_id, command, requester, timeout)
+    
+    elif kind == "cancel_command":
+        try:
+            command_id = int(message["id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        await manager.cancel_command(session_id, command_id, username, is_host)
+    
+    elif kind == "members_sync":
+        # A delta didn't apply (its base wasn't the client's version)
+        manager.send_members(member)
+    
+    elif kind == "grant_permission":
+        if is_host:
+            target_user = message["username"]
+            await manager.set_permission(session_id, target_user, True)
+    
+    elif kind == "revoke_permission":
+        if is_host:
+            target_user = message["username"]
+            await manager.set_permission(session_id, target_user, False)
+
 # WebSocket endpoint
 @app.websocket("/api/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     # Get username and is_host from query params
     username = websocket.query_params.get("username", "Anonymous")
     is_host = websocket.query_params.get("is_host", "false") == "true"
+    # Streaming members get PTY output as terminal_chunk frames the moment it is read
+    stream = websocket.query_params.get("stream", "false") == "true"
+    # Binary members stream raw output frames and send keystrokes as binary frames
+    protocol = "binary" if websocket.query_params.get("protocol") == "binary" else "json"
+    # Binary members may also ask for deflated output frames
+    compress = websocket.query_params.get("compress") == "deflate"
+
+    if VALIDATE_WS_SESSIONS:
+        try:
+            known = await session_store.get(session_id) is not None
+        except PyMongoError as e:
+            # Running shells don't need Mongo, so an outage shouldn't lock everyone out
+            logger.warning("Could not validate session %s: %s", session_id, e)
+            known = True
+        if not known:
+            await websocket.accept()
+            await websocket.close(code=4404, reason="Session not found")
+            return
     
-    await manager.connect(websocket, session_id, username, is_host)
-    
-    # Create PTY for host
-    if is_host:
-        manager.create_pty(session_id)
+    # A reconnecting client gets its old place (name, host role, permissions) back
+    resume_token = websocket.query_params.get("resume")
+    member = await manager.resume(websocket, session_id, resume_token) if resume_token else None
+    if member is not None:
+        username, is_host = member.username, member.is_host
+    else:
+        member = await manager.connect(websocket, session_id, username, is_host, stream, protocol, compress)
+        
+        # Create PTY for host, recording it if asked to; other members mirror it
+        record = RECORD_ALL_SESSIONS or websocket.query_params.get("record", "false") == "true"
+        await manager.attach(session_id, is_host, record=record)
     
-    # Notify all members
-    members = manager.get_members(session_id)
-    await manager.broadcast(session_id, {
-        "type": "member_update",
-        "members": members
-    })
+    # Everyone else hears about the newcomer in the next member_delta; the
+    # newcomer (or a resumed member, which missed deltas) gets the full list
+    await manager.broadcast_members(session_id)
+    manager.send_members(member)
     
     # Send initial welcome message
-    await websocket.send_json({
+    welcome = {
         "type": "welcome",
-        "message": f"Welcome to session {session_id}, {username}!"
-    })
+        "message": f"Welcome to session {session_id}, {username}!",
+        "resume_token": member.token,
+        "resumed": member.token == resume_token,
+        "output_throttled": manager.output_throttled(session_id)
+    }
+    if member.stream:
+        pty_session = manager.output_state(session_id)
+        welcome["seq"] = pty_session["seq"] if pty_session else 0
+        welcome["cols"], welcome["rows"] = pty_session["size"] if pty_session else (SCREEN_COLS, SCREEN_ROWS)
+        welcome["protocol"] = member.protocol
+        welcome["compression"] = "deflate" if member.compress else None
+        if member.compress:
+            welcome["dictionary"] = base64.b64encode(COMPRESS_DICTIONARY).decode()
+    await manager.send(member, welcome)
+    # Late joiners catch up with one snapshot/scrollback frame before live output;
+    # clients that saw output before (last_seq) get only what they missed
+    try:
+        last_seq = int(websocket.query_params["last_seq"])
+    except (KeyError, ValueError):
+        last_seq = None
+    if last_seq is None or not manager.send_missing(member, last_seq):
+        manager.send_replay(member)
+    # The app's members don't stream; they see past command results instead,
+    # and a resumed one those that finished after the last it saw (last_command)
+    if member.token != resume_token:
+        manager.send_history(member)
+    else:
+        try:
+            last_command = int(websocket.query_params["last_command"])
+        except (KeyError, ValueError):
+            last_command = member.last_command
+        manager.send_history(member, last_command)
     
+    dropped = False  # the connection broke without a close
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
             
-            if message["type"] == "execute_command":
-                command = message["command"]
-                requester = message["username"]
-                
-                # Check permission
-                if not manager.has_permission(session_id, requester):
-                    await websocket.send_json({
-                        "type": "error",
-                        "message": "You don't have permission to execute commands"
-                    })
+            if frame.get("bytes") is not None:
+                try:
+                    frame_type, _, payload = unpack_frame(frame["bytes"])
+                except ValueError:
                     continue
-                
-                # Execute command
-                output = manager.execute_command(session_id, command)
-                
-                # Broadcast to all
-                await manager.broadcast(session_id, {
-                    "type": "terminal_output",
-                    "command": command,
-                    "output": output,
-                    "username": requester
-                })
+                if frame_type == FRAME_INPUT:
+                    if not member.has_permission:
+                        await manager.send(member, {
+                            "type": "error",
+                            "message": "You don't have permission to send input"
+                        })
+                        continue
+                    await manager.write_input(session_id, payload)
+                continue
             
-            elif message["type"] == "grant_permission":
-                if is_host:
-                    target_user = message["username"]
-                    manager.update_permission(session_id, target_user, True)
-                    members = manager.get_members(session_id)
-                    await manager.broadcast(session_id, {
-                        "type": "member_update",
-                        "members": members
-                    })
-            
-            elif message["type"] == "revoke_permission":
-                if is_host:
-                    target_user = message["username"]
-                    manager.update_permission(session_id, target_user, False)
-                    members = manager.get_members(session_id)
-                    await manager.broadcast(session_id, {
-                        "type": "member_update",
-                        "members": members
-                    })
+            try:
+                await handle_message(member, json.loads(frame["text"]))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                await manager.send(member, {
+                    "type": "error",
+                    "message": f"Malformed message: {e!r}"
+                })
     
-    except WebSocketDisconnect:
-        manager.disconnect(websocket, session_id)
-        members = manager.get_members(session_id)
-        await manager.broadcast(session_id, {
-            "type": "member_update",
-            "members": members,
-            "message": f"{username} left the session"
-        })
+    except WebSocketDisconnect as e:
+        dropped = e.code != 1000
+    finally:
+        # Whatever ended the loop, the member is released
+        if member.ws is not websocket:
+            pass  # taken over by a resumed connection
+        elif dropped and manager.detach(member):
+            # Dropped, not closed: hold the member's place until it resumes
+            await manager.broadcast_members(session_id)
+        else:
+            manager.disconnect(member)
+            await manager.broadcast_members(session_id, f"{username} left the session")
 
 app.include_router(api_router)
 
@@ -274,6 +2546,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def create_indexes():
+    try:
+        await session_store.ensure_indexes()
+    except PyMongoError as e:
+        logger.warning("Could not create session indexes: %s", e)
+
+@app.on_event("startup")
+async def start_monitoring():
+    app.state.indexes = asyncio.create_task(create_indexes())
+    await manager.bus.start()
+    manager.pool.start()
+    if metrics.ENABLED:
+        app.state.loop_monitor = asyncio.create_task(monitor_event_loop())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await session_store.close()
+    client.close()
+    await manager.bus.close()
+    await asyncio.to_thread(manager.pool.stop)
+    await asyncio.to_thread(recorder.writer.stop)
\ No newline at end of file
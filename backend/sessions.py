@@ -0,0 +1,144 @@
+"""Session metadata in front of MongoDB.
+
+Lookups go through a TTL/LRU cache, and concurrent misses for the same id
+share one query, so reconnect storms don't turn into Mongo load. State
+changes (active, member count, last activity) are merged in memory and
+written with one bulk_write per flush interval.
+"""
+import asyncio
+import collections
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))  # session documents kept per worker
+CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))  # seconds a cached document is trusted
+NEGATIVE_TTL = float(os.environ.get('SESSION_CACHE_NEGATIVE_TTL', '2'))  # seconds an unknown id stays unknown
+FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '1'))  # write-behind batching window
+EXPIRE_AFTER = int(os.environ.get('SESSION_EXPIRE_AFTER', str(7 * 24 * 3600)))  # TTL on last_activity; 0 keeps sessions
+
+CACHE_LOOKUPS = metrics.registry.counter(
+    "termdesk_session_cache_total", "Session metadata lookups, by cache result", ("result",))
+STATE_WRITES = metrics.registry.counter(
+    "termdesk_session_state_writes_total", "Session documents updated by write-behind flushes")
+
+
+class SessionStore:
+    def __init__(self, collection: Callable, mongo_seconds=None):
+        self.collection = collection  # returns the Motor collection, looked up on each use
+        self.mongo_seconds = mongo_seconds
+        self.cache: "collections.OrderedDict[str, tuple]" = collections.OrderedDict()  # id: (expires at, doc or None)
+        self.loading: Dict[str, asyncio.Future] = {}
+        self.pending: Dict[str, Dict] = {}  # id: fields for the next $set
+        self.touched = set()  # ids whose last_activity is stamped at the next flush
+        self.flusher: Optional[asyncio.Task] = None
+
+    def _observe(self, operation: str, started: float):
+        if self.mongo_seconds is not None:
+            self.mongo_seconds.observe(time.perf_counter() - started, operation)
+
+    async def ensure_indexes(self):
+        collection = self.collection()
+        await collection.create_index("session_id", unique=True)
+        if EXPIRE_AFTER:
+            await collection.create_index("last_activity", expireAfterSeconds=EXPIRE_AFTER)
+
+    def _put(self, session_id: str, doc: Optional[Dict]):
+        ttl = CACHE_TTL if doc is not None else NEGATIVE_TTL
+        self.cache[session_id] = (time.monotonic() + ttl, doc)
+        self.cache.move_to_end(session_id)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        """The session document, or None if there is no such session."""
+        entry = self.cache.get(session_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.cache.move_to_end(session_id)
+            CACHE_LOOKUPS.inc(1, "hit")
+            return entry[1]
+        CACHE_LOOKUPS.inc(1, "miss")
+        future = self.loading.get(session_id)
+        if future is None:
+            future = self.loading[session_id] = asyncio.ensure_future(self._load(session_id))
+            future.add_done_callback(lambda _: self.loading.pop(session_id, None))
+        # One waiter giving up must not cancel the query for the rest
+        return await asyncio.shield(future)
+
+    async def _load(self, session_id: str) -> Optional[Dict]:
+        started = time.perf_counter()
+        doc = await self.collection().find_one({"session_id": session_id}, {"_id": 0})
+        self._observe("find_one", started)
+        if doc is not None and session_id in self.pending:
+            doc.update(self.pending[session_id])
+        self._put(session_id, doc)
+        return doc
+
+    async def insert(self, doc: Dict):
+        started = time.perf_counter()
+        await self.collection().insert_one(doc)
+        self._observe("insert_one", started)
+        self._put(doc["session_id"], {k: v for k, v in doc.items() if k != "_id"})
+
+    def update(self, session_id: str, **fields):
+        """Queue a $set for the next flush; the cached document shows it at once."""
+        self.pending.setdefault(session_id, {}).update(fields)
+        entry = self.cache.get(session_id)
+        if entry is not None and entry[1] is not None:
+            entry[1].update(fields)
+        self._schedule()
+
+    def touch(self, session_id: str):
+        # Called per output frame and keystroke, so it only remembers the id
+        self.touched.add(session_id)
+        if self.flusher is None:
+            self._schedule()
+
+    def _schedule(self):
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FLUSH_INTERVAL)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        touched, self.touched = self.touched, set()
+        now = datetime.now(timezone.utc)
+        for session_id in touched:
+            pending.setdefault(session_id, {})["last_activity"] = now
+            entry = self.cache.get(session_id)
+            if entry is not None and entry[1] is not None:
+                entry[1]["last_activity"] = now
+        if not pending:
+            return
+        requests = [UpdateOne({"session_id": session_id}, {"$set": fields}) for session_id, fields in pending.items()]
+        started = time.perf_counter()
+        try:
+            await self.collection().bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            logger.warning("Session state flush of %d sessions failed: %s", len(requests), e)
+            # Retry with the next flush; anything queued since is newer and wins
+            for session_id, fields in pending.items():
+                self.pending[session_id] = {**fields, **self.pending.get(session_id, {})}
+            self._schedule()
+            return
+        self._observe("bulk_write", started)
+        STATE_WRITES.inc(len(requests))
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
@@ -0,0 +1,18 @@
+# rcfile of session shells (bash --rcfile). Loads the usual bashrc, then
+# brackets every command with OSC 133 marks so the server can tell which
+# output belongs to which command and how it exited:
+#   ESC ] 133 ; C BEL        command starts (PS0, after the command line is read)
+#   ESC ] 133 ; D ; n BEL    command finished with exit status n
+#   ESC ] 133 ; A BEL        prompt shown, the shell is reading input again
+# Terminals ignore OSC sequences they don't know.
+
+[ -f ~/.bashrc ] && . ~/.bashrc
+
+__termdesk_prompt() {
+    local status=$?
+    printf '\033]133;D;%s\007\033]133;A\007' "$status"
+    return $status
+}
+
+PROMPT_COMMAND="__termdesk_prompt${PROMPT_COMMAND:+; $PROMPT_COMMAND}"
+PS0=$'\033]133;C\007'"$PS0"
@@ -0,0 +1,381 @@
+"""Local load and latency benchmark for the TermDesk WebSocket endpoint.
+
+Starts the backend in-process (MongoDB replaced by an in-memory stand-in),
+opens N sessions with M viewers each against /api/ws/{session_id}, and
+measures keystroke-to-echo latency, broadcast throughput under high-volume
+output, server memory per session and event-loop lag. Results are printed and
+saved as JSON so runs can be compared across versions:
+
+    python backend_bench.py --sessions 10 --viewers 20 --output bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+import websockets
+
+ROOT_DIR = Path(__file__).parent
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "termdesk_bench")
+
+import server  # noqa: E402
+import uvicorn  # noqa: E402
+
+DONE_MARKER = "BENCH_2_DONE"  # printed by `echo BENCH_$((1+1))_DONE`, absent from the echoed command
+
+
+class InMemoryCollection:
+    """Just enough of a Motor collection for the endpoints the benchmark uses."""
+
+    def __init__(self):
+        self.docs = []
+
+    @staticmethod
+    def _matches(doc, query):
+        return all(doc.get(key) == value for key, value in query.items())
+
+    async def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    async def find_one(self, query, projection=None):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                return {k: v for k, v in doc.items() if k != "_id"}
+        return None
+
+    async def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                doc.update(update.get("$set", {}))
+                return
+        if upsert:
+            self.docs.append({**query, **update.get("$set", {})})
+
+    async def bulk_write(self, requests, ordered=True):
+        # Only UpdateOne is used (session write-behind); pymongo keeps its fields private
+        for request in requests:
+            await self.update_one(request._filter, request._doc, request._upsert)
+
+    async def create_index(self, *args, **kwargs):
+        return None
+
+
+class InMemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, InMemoryCollection())
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+    }
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class BenchServer:
+    """Runs the app under uvicorn on its own event loop thread."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        config = uvicorn.Config(server.app, log_level="warning", ws="websockets", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.loop = None
+        self.thread = threading.Thread(target=self._run, name="bench-server", daemon=True)
+        self.lag = []
+        self.probing = False
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve(sockets=[self.sock]))
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+    async def _probe(self, interval):
+        loop = asyncio.get_running_loop()
+        while self.probing:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.lag.append(max(0.0, loop.time() - started - interval))
+
+    def start_lag_probe(self, interval=0.01):
+        self.probing = True
+        asyncio.run_coroutine_threadsafe(self._probe(interval), self.loop)
+
+    def stop_lag_probe(self):
+        self.probing = False
+
+
+class Client:
+    """One WebSocket member that records when output arrives."""
+
+    def __init__(self, url, protocol="binary"):
+        self.url = url
+        self.protocol = protocol
+        self.ws = None
+        self.output = bytearray()
+        self.bytes_received = 0
+        self.wire_bytes = 0  # output as sent, i.e. after compression
+        self.frames_received = 0
+        self.waiters = []  # (needle, future)
+        self.reader = None
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None, ping_interval=None)
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for message in self.ws:
+                if self.protocol == "binary":
+                    if not isinstance(message, bytes):
+                        continue
+                    frame_type, _, payload = server.unpack_frame(message)
+                    if frame_type & ~server.FRAME_COMPRESSED != server.FRAME_OUTPUT:
+                        continue
+                    self.wire_bytes += len(payload)
+                    if frame_type & server.FRAME_COMPRESSED:
+                        payload = zlib.decompressobj(-15, zdict=server.COMPRESS_DICTIONARY).decompress(payload)
+                else:
+                    message = json.loads(message)
+                    if message["type"] != "terminal_chunk":
+                        continue
+                    payload = message["data"].encode()
+                    self.wire_bytes += len(payload)
+                self.frames_received += 1
+                self.bytes_received += len(payload)
+                self.output += payload
+                del self.output[:-4096]
+                now = time.perf_counter()
+                for waiter in list(self.waiters):
+                    needle, future = waiter
+                    if needle in self.output and not future.done():
+                        future.set_result(now)
+                        self.waiters.remove(waiter)
+        except websockets.ConnectionClosed:
+            pass
+
+    def wait_for(self, needle: bytes):
+        future = asyncio.get_running_loop().create_future()
+        if needle in self.output:
+            future.set_result(time.perf_counter())
+        else:
+            self.waiters.append((needle, future))
+        return future
+
+    async def send_input(self, data: bytes):
+        if self.protocol == "binary":
+            await self.ws.send(server.pack_frame(server.FRAME_INPUT, 0, data))
+        else:
+            await self.ws.send(json.dumps({"type": "input", "data": data.decode()}))
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader:
+            await self.reader
+
+
+async def create_session(base_url, host):
+    response = await asyncio.to_thread(requests.post, f"{base_url}/api/sessions", json={"host_username": host}, timeout=10)
+    response.raise_for_status()
+    return response.json()["session_id"]
+
+
+async def run_benchmark(args, bench):
+    base_url = f"http://127.0.0.1:{bench.port}"
+    ws_base = f"ws://127.0.0.1:{bench.port}"
+    params = "protocol=binary" if args.protocol == "binary" else "stream=true"
+    if args.compress:
+        params += "&compress=deflate"
+
+    # Sessions and members
+    rss_before = rss_bytes()
+    sessions = []
+    for i in range(args.sessions):
+        session_id = await create_session(base_url, f"host{i}")
+        host = Client(f"{ws_base}/api/ws/{session_id}?username=host{i}&is_host=true&{params}", args.protocol)
+        await host.connect()
+        viewers = []
+        for j in range(args.viewers):
+            viewer = Client(f"{ws_base}/api/ws/{session_id}?username=viewer{i}_{j}&{params}", args.protocol)
+            await viewer.connect()
+            viewers.append(viewer)
+        sessions.append((session_id, host, viewers))
+
+    # Wait for every shell to answer before measuring anything
+    for _, host, _ in sessions:
+        await host.send_input(b"echo BENCH_READY_$((2+2))\n")
+    await asyncio.gather(*(asyncio.wait_for(host.wait_for(b"BENCH_READY_4"), args.timeout) for _, host, _ in sessions))
+    rss_after = rss_bytes()
+
+    bench.start_lag_probe()
+
+    # Keystroke-to-echo latency: the tty echoes typed text straight back
+    echo_latency, fanout_latency = [], []
+    for round_number in range(args.keystrokes):
+        probes = []
+        for index, (_, host, viewers) in enumerate(sessions):
+            token = f"k{round_number}x{index}z".encode()
+            futures = [host.wait_for(token)] + [viewer.wait_for(token) for viewer in viewers]
+            sent = time.perf_counter()
+            await host.send_input(token)
+            probes.append((sent, futures))
+        for sent, futures in probes:
+            arrivals = await asyncio.wait_for(asyncio.gather(*futures), args.timeout)
+            echo_latency.append(arrivals[0] - sent)
+            fanout_latency.extend(arrival - sent for arrival in arrivals[1:])
+        for _, host, _ in sessions:
+            await host.send_input(b"\x15")  # Ctrl-U clears the typed line
+        await asyncio.sleep(args.keystroke_interval)
+
+    # Broadcast throughput under high-volume output
+    members = [client for _, host, viewers in sessions for client in [host] + viewers]
+    received_before = sum(client.bytes_received for client in members)
+    wire_before = sum(client.wire_bytes for client in members)
+    frames_before = sum(client.frames_received for client in members)
+    started = time.perf_counter()
+    done = [client.wait_for(DONE_MARKER.encode()) for client in members]
+    for _, host, _ in sessions:
+        await host.send_input(f"yes | head -c {args.flood_bytes}; echo BENCH_$((1+1))_DONE\n".encode())
+    await asyncio.wait_for(asyncio.gather(*done), args.timeout)
+    elapsed = time.perf_counter() - started
+    received = sum(client.bytes_received for client in members) - received_before
+    wire = sum(client.wire_bytes for client in members) - wire_before
+    frames = sum(client.frames_received for client in members) - frames_before
+
+    bench.stop_lag_probe()
+
+    for client in members:
+        await client.close()
+
+    return {
+        "keystroke_echo": summarize(echo_latency),
+        "viewer_fanout": summarize(fanout_latency),
+        "throughput": {
+            "seconds": round(elapsed, 3),
+            "bytes_delivered": received,
+            "wire_bytes": wire,
+            "frames_delivered": frames,
+            "bytes_per_second": round(received / elapsed) if elapsed else None,
+            "mib_per_second": round(received / elapsed / (1024 * 1024), 3) if elapsed else None,
+        },
+        "memory": {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "bytes_per_session": round((rss_after - rss_before) / args.sessions) if args.sessions else None,
+        },
+        "event_loop_lag": summarize(bench.lag),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=5, help="concurrent sessions")
+    parser.add_argument("--viewers", type=int, default=10, help="viewers per session, besides the host")
+    parser.add_argument("--keystrokes", type=int, default=50, help="latency probes per session")
+    parser.add_argument("--keystroke-interval", type=float, default=0.01, help="pause between probes (s)")
+    parser.add_argument("--flood-bytes", type=int, default=2 * 1024 * 1024, help="output per session in the throughput phase")
+    parser.add_argument("--protocol", choices=("binary", "json"), default="binary",
+                        help="binary frames, or JSON terminal_chunk/input messages")
+    parser.add_argument("--compress", action="store_true", help="ask for deflated output frames (binary only)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-phase timeout (s)")
+    parser.add_argument("--output", default="bench_results.json", help="where to save the JSON results")
+    args = parser.parse_args()
+
+    server.db = InMemoryDatabase()
+    bench = BenchServer()
+    bench.start()
+    print(f"🚀 Benchmarking {args.sessions} sessions x {args.viewers} viewers ({args.protocol}) on port {bench.port}")
+    try:
+        results = asyncio.run(run_benchmark(args, bench))
+    finally:
+        bench.stop()
+
+    report = {
+        "run_id": str(uuid.uuid4())[:8],
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    echo, fanout = results["keystroke_echo"], results["viewer_fanout"]
+    print(f"⌨️  keystroke echo  p50 {echo.get('p50_ms')} ms  p99 {echo.get('p99_ms')} ms")
+    print(f"📡 viewer fan-out  p50 {fanout.get('p50_ms')} ms  p99 {fanout.get('p99_ms')} ms")
+    print(f"📈 throughput      {results['throughput']['mib_per_second']} MiB/s delivered, "
+          f"{results['throughput']['wire_bytes']} bytes on the wire")
+    print(f"💾 memory          {results['memory']['bytes_per_session']} bytes/session")
+    print(f"⏱️  event-loop lag  p99 {results['event_loop_lag'].get('p99_ms')} ms")
+    print(f"📊 Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
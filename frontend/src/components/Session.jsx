@@ -40,36 +40,104 @@ const Session = () => {
   const [command, setCommand] = useState("");
   const [copied, setCopied] = useState(false);
   const [connected, setConnected] = useState(false);
+  // The session's output is over its rate limit and being slowed down
+  const [throttled, setThrottled] = useState(false);
   const scrollRef = useRef(null);
   const commandInputRef = useRef(null);
 
   useEffect(() => {
-    // Connect to WebSocket
-    const websocket = new WebSocket(
-      `${WS_URL}/api/ws/${sessionId}?username=${username}&is_host=${isHost}`,
-    );
+    // Token from the last welcome; a dropped connection resumes with it and
+    // keeps its place (and permissions) instead of rejoining from scratch
+    let resumeToken = null;
+    // Id of the newest command result shown; a resume sends only later ones
+    let lastCommand = null;
+    let retries = 0;
+    let retryTimer = null;
+    let closed = false;
+    let websocket = null;
+    // Version of the member list we hold; deltas name the version they apply to
+    let membersVersion = null;
 
-    websocket.onopen = () => {
-      console.log("WebSocket connected");
-      setConnected(true);
-      toast.success("Connected to session");
-    };
+    const connect = () => {
+      membersVersion = null; // a full list follows the welcome
+      let resume = resumeToken ? `&resume=${resumeToken}` : "";
+      if (resumeToken && lastCommand !== null) {
+        resume += `&last_command=${lastCommand}`;
+      }
+      websocket = new WebSocket(
+        `${WS_URL}/api/ws/${sessionId}?username=${username}&is_host=${isHost}${resume}`,
+      );
+
+      websocket.onopen = () => {
+        console.log("WebSocket connected");
+        setConnected(true);
+        if (!resumeToken) toast.success("Connected to session");
+      };
 
-    websocket.onmessage = (event) => {
-      const message = JSON.parse(event.data);
+      websocket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
 
-      if (message.type === "welcome") {
-        setTerminalOutput((prev) => [
-          ...prev,
-          {
-            type: "system",
-            text: message.message,
-            timestamp: new Date(),
-          },
-        ]);
-      } else if (message.type === "member_update") {
-        setMembers(message.members);
-        if (message.message) {
+        if (message.type === "welcome") {
+          resumeToken = message.resume_token;
+          retries = 0;
+          setThrottled(message.output_throttled);
+          if (message.resumed) return;
+          setTerminalOutput((prev) => [
+            ...prev,
+            {
+              type: "system",
+              text: message.message,
+              timestamp: new Date(),
+            },
+          ]);
+        } else if (message.type === "member_update") {
+          membersVersion = message.version;
+          setMembers(message.members);
+        } else if (message.type === "member_delta") {
+          if (message.messages.length) {
+            setTerminalOutput((prev) => [
+              ...prev,
+              ...message.messages.map((text) => ({
+                type: "system",
+                text,
+                timestamp: new Date(),
+              })),
+            ]);
+          }
+          if (membersVersion === null) return; // the full list is on its way
+          if (message.base !== membersVersion) {
+            // Missed a delta; ask for the full list again
+            membersVersion = null;
+            websocket.send(JSON.stringify({ type: "members_sync" }));
+            return;
+          }
+          membersVersion = message.version;
+          setMembers((prev) => {
+            // Applied by id, so repeating a change the full list had is harmless
+            const byId = new Map(prev.map((m) => [m.id, m]));
+            for (const change of message.changes) {
+              if (change.op === "leave") byId.delete(change.id);
+              else byId.set(change.member.id, change.member);
+            }
+            return Array.from(byId.values());
+          });
+        } else if (message.type === "terminal_output") {
+          lastCommand = message.id;
+          setTerminalOutput((prev) => [
+            ...prev,
+            {
+              type: "command",
+              command: message.command,
+              output: message.output,
+              username: message.username,
+              exitCode: message.exit_code,
+              status: message.status,
+              timestamp: new Date(),
+            },
+          ]);
+        } else if (message.type === "output_throttled") {
+          setThrottled(message.throttled);
+        } else if (message.type === "session_ended") {
           setTerminalOutput((prev) => [
             ...prev,
             {
@@ -78,38 +146,43 @@ const Session = () => {
               timestamp: new Date(),
             },
           ]);
+        } else if (message.type === "error") {
+          toast.error(message.message);
         }
-      } else if (message.type === "terminal_output") {
-        setTerminalOutput((prev) => [
-          ...prev,
-          {
-            type: "command",
-            command: message.command,
-            output: message.output,
-            username: message.username,
-            timestamp: new Date(),
-          },
-        ]);
-      } else if (message.type === "error") {
-        toast.error(message.message);
-      }
-    };
+      };
 
-    websocket.onerror = (error) => {
-      console.error("WebSocket error:", error);
-      toast.error("Connection error");
-    };
+      websocket.onerror = (error) => {
+        console.error("WebSocket error:", error);
+        toast.error("Connection error");
+      };
 
-    websocket.onclose = () => {
-      console.log("WebSocket disconnected");
-      setConnected(false);
-      toast.info("Disconnected from session");
+      websocket.onclose = (event) => {
+        console.log("WebSocket disconnected");
+        setConnected(false);
+        // 1000 is a deliberate close (leaving, session ended); 4404 an unknown session
+        if (
+          !closed &&
+          resumeToken &&
+          event.code !== 1000 &&
+          event.code !== 4404 &&
+          retries < 5
+        ) {
+          retryTimer = setTimeout(connect, 500 * 2 ** retries);
+          retries += 1;
+          return;
+        }
+        toast.info("Disconnected from session");
+      };
+
+      setWs(websocket);
     };
 
-    setWs(websocket);
+    connect();
 
     return () => {
-      websocket.close();
+      closed = true;
+      clearTimeout(retryTimer);
+      websocket.close(1000);
     };
   }, [sessionId, username, isHost]);
 
@@ -166,7 +239,7 @@ const Session = () => {
   };
 
   const handleLeaveSession = () => {
-    if (ws) ws.close();
+    if (ws) ws.close(1000);
     navigate("/");
   };
 
@@ -231,6 +304,16 @@ const Session = () => {
                 ></div>
                 {connected ? "ONLINE" : "OFFLINE"}
               </Badge>
+              {throttled && (
+                <Badge
+                  variant="secondary"
+                  data-testid="throttled-badge"
+                  title="This session is producing output faster than its rate limit"
+                  className="bg-black text-yellow-400 border-2 border-yellow-400 px-3 sm:px-4 py-1 sm:py-1.5 text-xs sm:text-sm font-mono font-bold shadow-lg"
+                >
+                  THROTTLED
+                </Badge>
+              )}
               {isHost && (
                 <Badge
                   variant="secondary"
@@ -319,6 +402,15 @@ const Session = () => {
                             <span className="text-terminal">
                               {entry.command}
                             </span>
+                            {entry.status && entry.status !== "completed" ? (
+                              <span className="text-red-500 text-xs ml-2">
+                                [{entry.status}]
+                              </span>
+                            ) : entry.exitCode ? (
+                              <span className="text-red-500 text-xs ml-2">
+                                [exit {entry.exitCode}]
+                              </span>
+                            ) : null}
                           </div>
                         </div>
                         <div className="text-terminal whitespace-pre-wrap pl-3 sm:pl-6 text-xs sm:text-sm leading-relaxed bg-black/50 px-3 py-2 rounded border-l border-terminal-dim">
@@ -422,7 +514,7 @@ const Session = () => {
                 >
                   {members.map((member, index) => (
                     <div
-                      key={index}
+                      key={member.id}
                       data-testid={`member-${member.username}`}
                       className="group terminal-border p-3 sm:p-4 rounded bg-black/80 hover:bg-[#00ff41]/5 hover:terminal-glow transition-all duration-300 animate-slide-in"
                       style={{ animationDelay: `${index * 0.1}s` }}
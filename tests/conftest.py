@@ -0,0 +1,70 @@
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "termdesk_test")
+
+import backend_bench  # noqa: E402
+import server  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    """Point the server at the benchmark's in-memory MongoDB stand-in."""
+    db = backend_bench.InMemoryDatabase()
+    monkeypatch.setattr(server, "db", db)
+    # The module-level store's flush task belongs to the loop that made it
+    monkeypatch.setattr(server.session_store, "flusher", None)
+    return db
+
+
+@pytest.fixture
+def shell_home(tmp_path, monkeypatch):
+    """Run session shells with an empty HOME, away from the user's rc files."""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    return tmp_path
+
+
+class FakeWebSocket:
+    """Records what the server sends; JSON frames are decoded."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        pass
+
+
+async def wait_for(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("Timed out waiting for condition")
+        await asyncio.sleep(0.01)
+
+
+async def close_pty(manager, session_id: str):
+    """Close a session's PTY and wait for its shell to go away."""
+    process = manager.pty_processes[session_id]["process"]
+    manager._close_pty(session_id)
+    if manager.heartbeat is not None:
+        manager.heartbeat.cancel()
+    await asyncio.gather(*manager.background, return_exceptions=True)
+    await asyncio.to_thread(process.wait, 5)
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+import bus
+from bus import BusError, LocalBroker, RedisBus
+
+from .conftest import wait_for
+
+
+async def decode(data: bytes):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return await bus.read_reply(reader)
+
+
+@pytest.mark.parametrize("value", [
+    None, 0, -42, "OK", b"", b"binary\r\n\x00data", [b"message", b"channel", b"payload"], [1, [b"nested", None], "PONG"],
+])
+def test_reply_round_trip(value):
+    assert asyncio.run(decode(bus.encode_reply(value))) == value
+
+
+def test_error_reply_is_returned():
+    error = asyncio.run(decode(bus.encode_reply(BusError("ERR nope"))))
+    assert isinstance(error, BusError)
+    assert str(error) == "ERR nope"
+
+
+def test_command_encoding():
+    assert bus.encode_command("SET", "key", b"v\r\n", 1500) == (
+        b"*4\r\n$3\r\nSET\r\n$3\r\nkey\r\n$3\r\nv\r\n\r\n$4\r\n1500\r\n")
+    assert asyncio.run(decode(bus.encode_command("GET", "key"))) == [b"GET", b"key"]
+
+
+def test_truncated_reply():
+    with pytest.raises(ConnectionError):
+        asyncio.run(decode(b"$5\r\nab"[:3]))
+
+
+async def with_bus(kind, scenario):
+    if kind == "memory":
+        session_bus = bus.InProcessBus()
+        await session_bus.start()
+        try:
+            return await scenario(session_bus, None)
+        finally:
+            await session_bus.close()
+    broker = LocalBroker()
+    server = await broker.start()
+    port = server.sockets[0].getsockname()[1]
+    session_bus = RedisBus(f"redis://127.0.0.1:{port}/0")
+    await session_bus.start()
+    try:
+        return await scenario(session_bus, broker)
+    finally:
+        await session_bus.close()
+        await broker.close()
+
+
+@pytest.mark.parametrize("kind", ["memory", "redis"])
+def test_publish_subscribe(kind):
+    async def scenario(session_bus, broker):
+        received = []
+        callback = lambda channel, payload: received.append((channel, payload))
+        session_bus.subscribe("a", callback)
+        if broker is not None:
+            await wait_for(lambda: broker.channels.get(b"a"))
+        session_bus.publish("a", b"one")
+        session_bus.publish("b", b"elsewhere")
+        await wait_for(lambda: received)
+        session_bus.unsubscribe("a", callback)
+        if broker is not None:
+            await wait_for(lambda: not broker.channels.get(b"a"))
+        session_bus.publish("a", b"two")
+        await asyncio.sleep(0.05)
+        return received
+
+    assert asyncio.run(with_bus(kind, scenario)) == [("a", b"one")]
+
+
+@pytest.mark.parametrize("kind", ["memory", "redis"])
+def test_claims(kind):
+    async def scenario(session_bus, broker):
+        assert await session_bus.get("owner") is None
+        assert await session_bus.claim("owner", "w1", 5)
+        assert not await session_bus.claim("owner", "w2", 5)
+        assert await session_bus.get("owner") == "w1"
+        assert await session_bus.refresh("owner", "w1", 5)
+        assert not await session_bus.refresh("owner", "w2", 5)
+        await session_bus.release("owner", "w2")
+        assert await session_bus.get("owner") == "w1"
+        await session_bus.release("owner", "w1")
+        assert await session_bus.get("owner") is None
+        # A claim lapses after its ttl
+        assert await session_bus.claim("owner", "w2", 0.05)
+        await asyncio.sleep(0.1)
+        assert await session_bus.get("owner") is None
+        assert await session_bus.claim("owner", "w1", 5)
+
+    asyncio.run(with_bus(kind, scenario))
+
+
+def test_unknown_command_raises():
+    async def scenario(session_bus, broker):
+        with pytest.raises(BusError):
+            await session_bus._command("FLUSHALL")
+        # Replies stay in order after an error
+        assert await session_bus._command("PING") == "PONG"
+
+    asyncio.run(with_bus("redis", scenario))
@@ -0,0 +1,154 @@
+import asyncio
+import json
+
+import bus
+import server
+from server import PromptMarks
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+def merged(parts):
+    # Adjacent output bytes joined, so results don't depend on where reads split
+    result = []
+    for part in parts:
+        if isinstance(part, bytes) and result and isinstance(result[-1], bytes):
+            result[-1] += part
+        else:
+            result.append(part)
+    return result
+
+
+def test_marks_split_output():
+    marks = PromptMarks()
+    parts = marks.feed(b"ls\r\n\x1b]133;C\x07a  b\r\n\x1b]133;D;0\x07\x1b]133;A\x07$ ")
+    assert parts == [b"ls\r\n", ("C",), b"a  b\r\n", ("D", 0), ("A",), b"$ "]
+    assert marks.pending == b""
+
+
+def test_mark_split_across_reads():
+    data = b"out\x1b]133;D;127\x07\x1b]133;A\x07$ "
+    for cut in range(1, len(data)):
+        marks = PromptMarks()
+        parts = marks.feed(data[:cut]) + marks.feed(data[cut:])
+        assert merged(parts) == [b"out", ("D", 127), ("A",), b"$ "], cut
+
+
+def test_mark_without_status():
+    assert PromptMarks().feed(b"\x1b]133;D\x07") == [("D", None)]
+
+
+def test_unterminated_mark_is_output():
+    data = b"\x1b]133;" + b"x" * 40
+    assert b"".join(PromptMarks().feed(data)) == data
+
+
+def test_escape_that_is_not_a_mark():
+    marks = PromptMarks()
+    assert merged(marks.feed(b"red \x1b") + marks.feed(b"[31m")) == [b"red \x1b[31m"]
+
+
+def test_command_statuses(shell_home):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("commands")
+        pty_session = manager.pty_processes["commands"]
+        history = pty_session["history"]
+        try:
+            await manager.run_command("commands", "sleep 5", "guest", timeout=0.5)
+            await manager.run_command("commands", "echo queued", "guest")
+            queued = pty_session["commands"][-1]
+            # Only the host or whoever queued it may cancel
+            await manager.cancel_command("commands", queued.id, "someone", False)
+            assert queued in pty_session["commands"]
+            await manager.cancel_command("commands", queued.id, "guest", False)
+            await manager.run_command("commands", "echo $((6 * 7))", "guest")
+            await wait_for(lambda: len(history.entries) == 3, timeout=10)
+        finally:
+            await close_pty(manager, "commands")
+        return {message["command"]: message for message in map(json.loads, history)}
+
+    finished = asyncio.run(scenario())
+    assert finished["echo queued"]["status"] == "cancelled"
+    assert finished["sleep 5"]["status"] == "timeout"
+    assert finished["echo $((6 * 7))"]["status"] == "completed"
+    assert finished["echo $((6 * 7))"]["exit_code"] == 0
+    assert "42" in finished["echo $((6 * 7))"]["output"]
+
+
+def test_full_queue_rejects(shell_home, monkeypatch):
+    monkeypatch.setattr(server, "COMMAND_QUEUE_SIZE", 1)
+
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("full")
+        try:
+            for command in ("sleep 5", "true", "false"):
+                await manager.run_command("full", command, "guest", timeout=0.5)
+            return [(m["command"], m["status"]) for m in map(json.loads, manager.pty_processes["full"]["history"])]
+        finally:
+            await close_pty(manager, "full")
+
+    assert ("false", "rejected") in asyncio.run(scenario())
+
+
+def test_lines_go_to_a_program_reading_input(shell_home):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("repl")
+        history = manager.pty_processes["repl"]["history"]
+        try:
+            # Started from the terminal, so no command waits for it to end
+            await manager.write_input("repl", b"python3 -q\r")
+            await wait_for(lambda: b">>> " in manager.pty_processes["repl"]["scrollback"].getvalue())
+            for command in ("print(6 * 7)", "exit()", "echo after"):
+                await manager.run_command("repl", command, "guest", timeout=5)
+            await wait_for(lambda: len(history.entries) == 3, timeout=10)
+            scrollback = manager.pty_processes["repl"]["scrollback"].getvalue()
+        finally:
+            await close_pty(manager, "repl")
+        return [json.loads(payload) for payload in history], scrollback
+
+    finished, scrollback = asyncio.run(scenario())
+    assert b"42" in scrollback
+    assert [m["status"] for m in finished] == ["input", "input", "completed"]
+    assert finished[2]["output"].strip() == "after"
+
+
+def test_busy_shell_times_out(shell_home):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("busy")
+        history = manager.pty_processes["busy"]["history"]
+        try:
+            # sleep doesn't read its input, so nothing may be typed into it
+            await manager.write_input("busy", b"sleep 2\r")
+            await asyncio.sleep(0.2)
+            await manager.run_command("busy", "echo early", "guest", timeout=0.5)
+            await wait_for(lambda: len(history.entries) == 1, timeout=5)
+        finally:
+            await close_pty(manager, "busy")
+        return json.loads(next(iter(history)))
+
+    assert asyncio.run(scenario())["status"] == "busy"
+
+
+def test_multi_line_commands_are_refused(shell_home, monkeypatch):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        monkeypatch.setattr(server, "manager", manager)
+        await manager.create_pty("lines")
+        try:
+            websocket = FakeWebSocket()
+            member = await manager.connect(websocket, "lines", "host", True)
+            for command in ("echo a; sleep 0.5\necho b", "echo a\recho b"):
+                await server.handle_message(member, {"type": "execute_command", "command": command})
+            await wait_for(lambda: len(websocket.sent) >= 2)
+            assert not manager.pty_processes["lines"]["commands"]
+            return websocket.sent
+        finally:
+            await close_pty(manager, "lines")
+
+    sent = asyncio.run(scenario())
+    errors = [m for m in sent if isinstance(m, dict) and m["type"] == "error"]
+    assert [m["message"] for m in errors] == ["Commands must be a single line"] * 2
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import zlib
+
+import bus
+import server
+from server import COMPRESS_DICTIONARY, FRAME_COMPRESSED, FRAME_OUTPUT, pack_frame, pack_output, unpack_frame
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+def inflate(payload: bytes) -> bytes:
+    # What the client does, with the dictionary from its welcome
+    decompressor = zlib.decompressobj(-15, zdict=COMPRESS_DICTIONARY)
+    return decompressor.decompress(payload) + decompressor.flush()
+
+
+def test_frame_round_trip():
+    frame = pack_frame(FRAME_OUTPUT, 0xFFFFFFFF, b"data")
+    assert unpack_frame(frame) == (FRAME_OUTPUT, 0xFFFFFFFF, b"data")
+
+
+def test_output_is_compressed():
+    data = b"\x1b[0m\x1b[01;34mdirectory\x1b[0m  file.txt\r\n" * 40
+    frame_type, seq, payload = unpack_frame(pack_output(FRAME_OUTPUT, 7, data, True))
+    assert frame_type == FRAME_OUTPUT | FRAME_COMPRESSED
+    assert seq == 7
+    assert len(payload) < len(data) // 4
+    assert inflate(payload) == data
+
+
+def test_frames_are_compressed_independently():
+    # Each frame starts from the primed dictionary, so any one decodes on its own
+    first = unpack_frame(pack_output(FRAME_OUTPUT, 1, b"first frame " * 50, True))[2]
+    second = unpack_frame(pack_output(FRAME_OUTPUT, 2, b"second frame " * 50, True))[2]
+    assert inflate(second) == b"second frame " * 50
+    assert inflate(first) == b"first frame " * 50
+
+
+def test_small_and_incompressible_frames_go_raw():
+    small = b"x" * (server.COMPRESS_MIN_BYTES - 1)
+    assert pack_output(FRAME_OUTPUT, 1, small, True) == pack_frame(FRAME_OUTPUT, 1, small)
+    noise = os.urandom(4096)
+    assert pack_output(FRAME_OUTPUT, 2, noise, True) == pack_frame(FRAME_OUTPUT, 2, noise)
+    text = b"compressible " * 100
+    assert pack_output(FRAME_OUTPUT, 3, text, False) == pack_frame(FRAME_OUTPUT, 3, text)
+
+
+def test_members_get_the_framing_they_asked_for(shell_home):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("deflate")
+        try:
+            plain, deflated = FakeWebSocket(), FakeWebSocket()
+            await manager.connect(plain, "deflate", "host", True, stream=True, protocol="binary")
+            await manager.connect(deflated, "deflate", "viewer", False, stream=True, protocol="binary", compress=True)
+            await manager.write_input("deflate", b"printf 'row %s\\n' $(seq 1 200)\r")
+            await wait_for(lambda: b"row 200" in received(plain))
+            await wait_for(lambda: received(deflated) == received(plain))
+            return deflated.sent
+        finally:
+            await close_pty(manager, "deflate")
+
+    def received(websocket: FakeWebSocket) -> bytes:
+        output = b""
+        for frame in websocket.sent:
+            if not isinstance(frame, bytes):
+                continue
+            frame_type, _, payload = unpack_frame(frame)
+            if frame_type & ~FRAME_COMPRESSED == FRAME_OUTPUT:
+                output += inflate(payload) if frame_type & FRAME_COMPRESSED else payload
+        return output
+
+    frames = asyncio.run(scenario())
+    assert any(unpack_frame(frame)[0] & FRAME_COMPRESSED for frame in frames if isinstance(frame, bytes))
@@ -0,0 +1,129 @@
+import asyncio
+import fcntl
+import os
+
+import server
+
+
+def nonblocking_pipe():
+    read_fd, write_fd = os.pipe()
+    flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+    fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return read_fd, write_fd
+
+
+def read_available(fd: int) -> bytes:
+    os.set_blocking(fd, False)
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def test_writes_in_one_iteration_are_coalesced(monkeypatch):
+    read_fd, write_fd = nonblocking_pipe()
+    writes = []
+    real_write = os.write
+
+    def counting_write(fd, data):
+        if fd == write_fd:
+            writes.append(bytes(data))
+        return real_write(fd, data)
+
+    monkeypatch.setattr(server.os, "write", counting_write)
+
+    async def scenario():
+        writer = server.PtyWriter(write_fd, "test")
+        for key in (b"l", b"s", b"\r"):
+            writer.write(key)
+        assert writes == []
+        await asyncio.sleep(0)
+        assert writes == [b"ls\r"]
+        writer.close()
+
+    try:
+        asyncio.run(scenario())
+        assert read_available(read_fd) == b"ls\r"
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_drain_waits_for_a_full_tty():
+    read_fd, write_fd = nonblocking_pipe()
+    # Far more than the pipe holds, so some of it has to wait for the reader
+    data = bytes(range(256)) * 1024
+
+    async def scenario():
+        writer = server.PtyWriter(write_fd, "test", max_pending=4096)
+        writer.write(data)
+        drain = asyncio.create_task(writer.drain())
+        await asyncio.sleep(0.05)
+        assert writer.watching
+        assert len(writer.pending) > writer.max_pending
+        assert not drain.done()
+
+        received = bytearray()
+        while not drain.done():
+            received += read_available(read_fd)
+            await asyncio.sleep(0.01)
+        assert len(writer.pending) <= writer.max_pending
+
+        while writer.pending or writer.watching:
+            received += read_available(read_fd)
+            await asyncio.sleep(0.01)
+        received += read_available(read_fd)
+        return bytes(received)
+
+    try:
+        assert asyncio.run(asyncio.wait_for(scenario(), 10)) == data
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_close_releases_senders():
+    read_fd, write_fd = nonblocking_pipe()
+
+    async def scenario():
+        writer = server.PtyWriter(write_fd, "test", max_pending=1024)
+        writer.write(b"x" * 1024 * 1024)
+        await asyncio.sleep(0.01)
+        drain = asyncio.create_task(writer.drain())
+        await asyncio.sleep(0.01)
+        assert not drain.done()
+        writer.close()
+        await asyncio.wait_for(drain, 1)
+        assert not writer.pending and not writer.watching
+        # Input after close is dropped
+        writer.write(b"late")
+        assert not writer.pending
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_write_to_a_gone_shell_closes():
+    read_fd, write_fd = nonblocking_pipe()
+    os.close(read_fd)
+
+    async def scenario():
+        writer = server.PtyWriter(write_fd, "test")
+        writer.write(b"exit\r")
+        await asyncio.sleep(0)
+        assert writer.closed
+        await asyncio.wait_for(writer.drain(), 1)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        os.close(write_fd)
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import bus
+import server
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+class MemberView:
+    """A client's member list, kept the way the frontend keeps it."""
+
+    def __init__(self, websocket: FakeWebSocket):
+        self.websocket = websocket
+        self.read = 0
+        self.version = None
+        self.members = {}
+        self.messages = []
+
+    def update(self):
+        for message in self.websocket.sent[self.read:]:
+            if message["type"] == "member_update":
+                self.version = message["version"]
+                self.members = {member["id"]: member for member in message["members"]}
+            elif message["type"] == "member_delta":
+                # A delta on another version would make the client resync
+                assert message["base"] == self.version
+                self.version = message["version"]
+                for change in message["changes"]:
+                    if change["op"] == "leave":
+                        self.members.pop(change["id"], None)
+                    else:
+                        self.members[change["member"]["id"]] = change["member"]
+                self.messages.extend(message["messages"])
+        self.read = len(self.websocket.sent)
+        return self
+
+    def users(self):
+        return sorted((m["username"], m["is_host"], m["has_permission"]) for m in self.members.values())
+
+
+@pytest.fixture
+def workers(shell_home, monkeypatch):
+    monkeypatch.setattr(server, "MEMBER_UPDATE_DEBOUNCE", 0.01)
+    session_bus = bus.InProcessBus()
+    return server.ConnectionManager(session_bus, "A"), server.ConnectionManager(session_bus, "B")
+
+
+async def join(manager, session_id, username, is_host):
+    # What the WebSocket endpoint does for a new member
+    websocket = FakeWebSocket()
+    member = await manager.connect(websocket, session_id, username, is_host)
+    await manager.attach(session_id, is_host)
+    await manager.broadcast_members(session_id, f"{username} joined the session")
+    manager.send_members(member)
+    return member, MemberView(websocket)
+
+
+async def leave(manager, member):
+    manager.disconnect(member)
+    await manager.broadcast_members(member.session_id, f"{member.username} left the session")
+
+
+async def shut_down(*managers):
+    for manager in managers:
+        for session_id in list(manager.pty_processes):
+            await close_pty(manager, session_id)
+        if manager.heartbeat is not None:
+            manager.heartbeat.cancel()
+        for task in list(manager.background):
+            task.cancel()
+
+
+def test_members_across_workers(workers):
+    a, b = workers
+
+    async def scenario():
+        try:
+            host, host_view = await join(a, "s", "host", True)
+            guest, guest_view = await join(b, "s", "guest", False)
+            everyone = [("guest", False, False), ("host", True, True)]
+            await wait_for(lambda: host_view.update().users() == everyone)
+            await wait_for(lambda: guest_view.update().users() == everyone)
+            assert "guest joined the session" in host_view.messages
+            assert {m["id"] for m in host_view.members.values()} == {host.key, guest.key}
+
+            # Granted on the host's worker, applied where the guest is connected
+            await a.set_permission("s", "guest", True)
+            granted = [("guest", False, True), ("host", True, True)]
+            await wait_for(lambda: host_view.update().users() == granted)
+            await wait_for(lambda: guest_view.update().users() == granted)
+            assert guest.has_permission
+
+            await b.set_permission("s", "guest", False)
+            await wait_for(lambda: host_view.update().users() == everyone)
+            await wait_for(lambda: guest_view.update().users() == everyone)
+
+            await leave(b, guest)
+            await wait_for(lambda: host_view.update().users() == [("host", True, True)])
+            assert "guest left the session" in host_view.messages
+            return [message["type"] for message in host_view.websocket.sent if "member" in message["type"]]
+        finally:
+            await shut_down(a, b)
+
+    types = asyncio.run(scenario())
+    # One full list on joining, deltas after that
+    assert types.count("member_update") == 1
+    assert types.count("member_delta") >= 4
+
+
+def test_joins_are_batched(workers):
+    a, _ = workers
+
+    async def scenario():
+        try:
+            _, host_view = await join(a, "batch", "host", True)
+            await wait_for(lambda: host_view.update().users())
+            sent = len(host_view.websocket.sent)
+            for n in range(5):
+                await join(a, "batch", f"viewer{n}", False)
+            await wait_for(lambda: len(host_view.update().members) == 6)
+            return host_view.websocket.sent[sent:]
+        finally:
+            await shut_down(a)
+
+    deltas = asyncio.run(scenario())
+    assert len(deltas) == 1
+    assert [change["op"] for change in deltas[0]["changes"]] == ["join"] * 5
+    assert len(deltas[0]["messages"]) == 5
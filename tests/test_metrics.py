@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import metrics
+import server
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    monkeypatch.setattr(metrics, "TOKEN", "")
+    return TestClient(server.app)
+
+
+def test_metrics_are_not_on_the_api(client):
+    assert client.get("/metrics").status_code == 200
+    assert client.get("/api/metrics").status_code == 404
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, "TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_disabled(client, monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    assert client.get("/metrics").status_code == 404
+
+
+def test_session_ids_are_not_exposed(client, monkeypatch):
+    member = SimpleNamespace(queue=asyncio.Queue())
+    monkeypatch.setattr(server.manager, "active_connections", {"c0ffee42": [member]})
+    server.PTY_READ_BYTES.inc(10, metrics.session_label("c0ffee42"))
+    try:
+        text = client.get("/metrics").text
+    finally:
+        server.PTY_READ_BYTES.remove(metrics.session_label("c0ffee42"))
+    assert "c0ffee42" not in text
+    label = metrics.session_label("c0ffee42")
+    assert f'termdesk_session_members{{session="{label}"}} 1' in text
+    assert f'termdesk_pty_read_bytes_total{{session="{label}"}} 10' in text
+    # Stable for an id, distinct between ids
+    assert metrics.session_label("c0ffee42") == label
+    assert metrics.session_label("c0ffee43") != label
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bus
+import server
+from server import OutputLimiter
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server, "time", SimpleNamespace(monotonic=lambda: now[0], perf_counter=time.perf_counter))
+    return now
+
+
+def test_charge_within_burst(clock):
+    limiter = OutputLimiter(rate=1000, burst=500)
+    assert limiter.charge(400, 1000) == 0.0
+    # 300 bytes over: 0.3 s at 1000 bytes/s
+    assert limiter.charge(400, 1000) == pytest.approx(0.3)
+
+
+def test_bucket_refills_up_to_burst(clock):
+    limiter = OutputLimiter(rate=1000, burst=500)
+    limiter.charge(500, 1000)
+    clock[0] += 0.2
+    assert limiter.charge(200, 1000) == 0.0
+    clock[0] += 60
+    assert limiter.charge(0, 1000) == 0.0
+    assert limiter.tokens == 500
+
+
+def test_echo_is_free_right_after_input(clock, monkeypatch):
+    monkeypatch.setattr(server, "ECHO_BYTES", 100)
+    limiter = OutputLimiter()
+    assert not limiter.is_echo(10)
+    limiter.input()
+    assert limiter.is_echo(60)
+    assert limiter.is_echo(40)
+    # The allowance is per input
+    assert not limiter.is_echo(1)
+    limiter.input()
+    clock[0] += server.ECHO_WINDOW * 2
+    assert not limiter.is_echo(1)
+
+
+def test_busy_sessions_share_the_worker_rate(clock, monkeypatch):
+    monkeypatch.setattr(server, "OUTPUT_WORKER_RATE", 1000)
+    interval = server.OUTPUT_SHARE_INTERVAL
+    manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+    unlimited, capped = OutputLimiter(rate=0), OutputLimiter(rate=300)
+    assert manager._output_rate("a", unlimited) == 1000
+
+    clock[0] += interval * 0.3
+    # A session's own quota applies under its share
+    assert manager._output_rate("b", capped) == 300
+    # The share is redone once per interval
+    clock[0] += interval * 0.8
+    assert manager._output_rate("a", unlimited) == 500
+    assert manager._output_rate("b", capped) == 300
+
+    # "b" went quiet, so "a" has the worker to itself again
+    clock[0] += interval * 2
+    assert manager._output_rate("a", unlimited) == 1000
+    assert list(manager.bulk_output) == ["a"]
+
+
+def test_worker_rate_disabled(monkeypatch):
+    monkeypatch.setattr(server, "OUTPUT_WORKER_RATE", 0)
+    manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+    assert manager._output_rate("a", OutputLimiter(rate=300)) == 300
+
+
+def test_flooding_session_is_throttled(shell_home):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("flood")
+        pty_session = manager.pty_processes["flood"]
+        pty_session["limiter"] = OutputLimiter(rate=256 * 1024, burst=16 * 1024)
+        try:
+            websocket = FakeWebSocket()
+            await manager.connect(websocket, "flood", "host", True)
+            started = time.monotonic()
+            await manager.write_input("flood", b"head -c 200000 /dev/zero | tr '\\0' x; echo; echo DONE_$((1 + 1))\r")
+            await wait_for(lambda: b"DONE_2" in pty_session["scrollback"].getvalue(), timeout=10)
+            elapsed = time.monotonic() - started
+            await wait_for(lambda: not pty_session["throttled"], timeout=5)
+            throttled = [m["throttled"] for m in websocket.sent if isinstance(m, dict) and m["type"] == "output_throttled"]
+            return elapsed, throttled
+        finally:
+            await close_pty(manager, "flood")
+
+    elapsed, throttled = asyncio.run(scenario())
+    # 200 KB at 256 KiB/s after a 16 KiB burst
+    assert elapsed > 0.5
+    assert throttled == [True, False]
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import bus
+import recorder
+import server
+
+from .conftest import close_pty, wait_for
+
+
+@pytest.fixture(autouse=True)
+def chunk_per_event(monkeypatch):
+    # Every event closes its chunk, so chunk boundaries are predictable
+    monkeypatch.setattr(recorder, "CHUNK_BYTES", 1)
+
+
+def record(directory, session_id, events, size=(80, 24)):
+    """Record (seconds, output) events and wait for the writer to finish."""
+    session = recorder.SessionRecorder(directory, session_id, *size)
+    for elapsed, data in events:
+        session.started = time.monotonic() - elapsed
+        session.output(data)
+    session.close()
+    recorder.writer.stop()
+
+
+def event_times(cast):
+    return [json.loads(line)[0] for line in cast.splitlines()[1:]]
+
+
+def test_read_range(tmp_path):
+    record(tmp_path, "range", [(1, b"one\r\n"), (5, b"five\r\n"), (9, b"nine\r\n")])
+    cast = recorder.read_range(tmp_path, "range")
+    header = json.loads(cast.splitlines()[0])
+    assert (header["version"], header["width"], header["height"]) == (2, 80, 24)
+    assert [json.loads(line)[2] for line in cast.splitlines()[1:]] == ["one\r\n", "five\r\n", "nine\r\n"]
+    assert [round(t) for t in event_times(recorder.read_range(tmp_path, "range", 4, 10))] == [5, 9]
+    assert [round(t) for t in event_times(recorder.read_range(tmp_path, "range", 0, 6))] == [1, 5]
+    assert event_times(recorder.read_range(tmp_path, "range", 20)) == []
+    assert recorder.read_range(tmp_path, "missing") is None
+
+
+def test_search_words_and_prefixes(tmp_path):
+    record(tmp_path, "search", [
+        (1, b"\x1b[32mFIRST_1\x1b[0m ok\r\n"),
+        (2, b"then SECOND_2\r\n"),
+        (3, b"second again\r\n"),
+    ])
+    found = recorder.search(tmp_path, "search", "second")
+    assert not found["truncated"]
+    assert [(round(r["time"]), r["line"]) for r in found["results"]] == [(2, "then SECOND_2"), (3, "second again")]
+    # Matches are found inside words only through a word that starts there
+    assert recorder.search(tmp_path, "search", "cond_2")["results"] == []
+    assert [r["line"] for r in recorder.search(tmp_path, "search", "first_1 ok")["results"]] == ["FIRST_1 ok"]
+    assert recorder.search(tmp_path, "search", "missing")["results"] == []
+    assert recorder.search(tmp_path, "nothing", "second") is None
+
+
+def test_search_limit_and_truncation(tmp_path, monkeypatch):
+    record(tmp_path, "many", [(n, b"needle %d\r\n" % n) for n in range(1, 6)])
+    assert len(recorder.search(tmp_path, "many", "needle", limit=2)["results"]) == 2
+    monkeypatch.setattr(recorder, "MAX_SEARCH_CHUNKS", 3)
+    found = recorder.search(tmp_path, "many", "needle")
+    assert found["truncated"]
+    assert [r["line"] for r in found["results"]] == ["needle 1", "needle 2", "needle 3"]
+
+
+def test_search_match_spanning_reads(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, "CHUNK_BYTES", 64 * 1024)
+    record(tmp_path, "split", [(1, b"hello wor"), (2, b"ld\r\n")])
+    results = recorder.search(tmp_path, "split", "hello world")["results"]
+    assert [(round(r["time"]), r["line"]) for r in results] == [(1, "hello world")]
+
+
+def test_term_indexes_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, "SEARCH_INDEX_CACHE", 2)
+    monkeypatch.setattr(recorder, "term_indexes", recorder.collections.OrderedDict())
+    for session_id in ("one", "two", "three"):
+        record(tmp_path, session_id, [(1, b"needle\r\n")])
+    recorder.search(tmp_path, "one", "needle")
+    recorder.search(tmp_path, "two", "needle")
+    recorder.search(tmp_path, "one", "needle")
+    recorder.search(tmp_path, "three", "needle")
+    # "two" was searched least recently
+    assert list(recorder.term_indexes) == ["one", "three"]
+    assert recorder.search(tmp_path, "two", "needle")["results"]
+
+
+def test_recording_continues(tmp_path):
+    record(tmp_path, "resume", [(1, b"before\r\n"), (4, b"restart\r\n")])
+    assert recorder.search(tmp_path, "resume", "before")["results"]
+    record(tmp_path, "resume", [(2, b"after\r\n")], size=(100, 30))
+    cast = recorder.read_range(tmp_path, "resume")
+    lines = [json.loads(line) for line in cast.splitlines()]
+    assert lines[0]["width"] == 80
+    events = [(round(t), kind, text) for t, kind, text in lines[1:]]
+    assert events == [(1, "o", "before\r\n"), (4, "o", "restart\r\n"), (4, "r", "100x30"), (6, "o", "after\r\n")]
+    # The term index picks up the appended chunks
+    assert [round(r["time"]) for r in recorder.search(tmp_path, "resume", "after")["results"]] == [6]
+
+
+def test_resume_drops_unindexed_data(tmp_path):
+    record(tmp_path, "torn", [(1, b"kept\r\n")])
+    data_path, index_path, _ = recorder.recording_paths(tmp_path, "torn")
+    size = data_path.stat().st_size
+    with open(data_path, "ab") as data_file:
+        data_file.write(b"half a chunk")
+    with open(index_path, "a") as index_file:
+        index_file.write('{"offset": ')
+    record(tmp_path, "torn", [(1, b"more\r\n")])
+    texts = [json.loads(line)[2] for line in recorder.read_range(tmp_path, "torn").splitlines()[1:]]
+    assert texts == ["kept\r\n", "more\r\n"]
+    assert recorder.read_index(tmp_path, "torn")[2]["offset"] == size
+
+
+def test_input_can_be_left_out(tmp_path):
+    session = recorder.SessionRecorder(tmp_path, "typed", 80, 24)
+    session.input(b"hunter2\r")
+    session.output(b"ok\r\n")
+    session.close()
+    recorder.writer.stop()
+    assert "hunter2" in recorder.read_range(tmp_path, "typed")
+    cast = recorder.read_range(tmp_path, "typed", include_input=False)
+    assert "hunter2" not in cast
+    assert "ok" in cast
+
+
+@pytest.mark.parametrize("record_input", [False, True])
+def test_keystrokes_are_recorded_on_request(tmp_path, shell_home, monkeypatch, record_input):
+    monkeypatch.setattr(server, "RECORDINGS_DIR", tmp_path)
+    monkeypatch.setattr(server, "RECORD_INPUT", record_input)
+
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("typed", record=True)
+        scrollback = manager.pty_processes["typed"]["scrollback"]
+        try:
+            await manager.write_input("typed", b"read -s -p Pass''word: secret; echo READ_$((1 + 1))\r")
+            # Echo is off once the prompt is shown
+            await wait_for(lambda: b"Password:" in scrollback.getvalue())
+            await manager.write_input("typed", b"hunter2\r")
+            await wait_for(lambda: b"READ_2" in scrollback.getvalue())
+        finally:
+            await close_pty(manager, "typed")
+
+    asyncio.run(scenario())
+    recorder.writer.stop()
+    assert ("hunter2" in recorder.read_range(tmp_path, "typed")) == record_input
+    assert "hunter2" not in recorder.read_range(tmp_path, "typed", include_input=False)
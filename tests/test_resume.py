@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+import pytest
+
+import bus
+import server
+from server import CommandHistory
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+@pytest.fixture
+def manager(shell_home, monkeypatch):
+    monkeypatch.setattr(server, "RESUME_GRACE", 30)
+    return server.ConnectionManager(bus.InProcessBus(), "w1")
+
+
+def results(websocket: FakeWebSocket):
+    return [m["command"] for m in websocket.sent if isinstance(m, dict) and m["type"] == "terminal_output"]
+
+
+def test_history_since():
+    history = CommandHistory()
+    for command_id in (1, 2, 3):
+        history.append({"type": "terminal_output", "id": command_id, "output": ""})
+    assert history.newest == 3
+    assert [json.loads(p)["id"] for p in history.since(1)] == [2, 3]
+    assert history.since(3) == []
+    # Evicted or unknown: everything held is newer
+    assert [json.loads(p)["id"] for p in history.since(0)] == [1, 2, 3]
+    assert [json.loads(p)["id"] for p in history.since(None)] == [1, 2, 3]
+
+
+def test_resumed_member_gets_results_it_missed(manager):
+    async def scenario():
+        await manager.create_pty("away")
+        history = manager.pty_processes["away"]["history"]
+        try:
+            await manager.connect(FakeWebSocket(), "away", "host", True)
+            member = await manager.connect(FakeWebSocket(), "away", "guest", False)
+            await manager.run_command("away", "echo BEFORE", "host")
+            await wait_for(lambda: history.newest is not None)
+            before = history.newest
+
+            assert manager.detach(member)
+            assert member.last_command == before
+            await manager.run_command("away", "echo WHILE_AWAY", "host")
+            await wait_for(lambda: history.newest != before)
+            # Detached members are sent nothing
+            assert member.queue.empty()
+
+            websocket = FakeWebSocket()
+            assert await manager.resume(websocket, "away", member.token) is member
+            manager.send_history(member, member.last_command)
+            await wait_for(lambda: results(websocket))
+            await asyncio.sleep(0.05)
+            return results(websocket)
+        finally:
+            await close_pty(manager, "away")
+
+    assert asyncio.run(scenario()) == ["echo WHILE_AWAY"]
+
+
+def test_client_names_the_last_result_it_saw(manager):
+    async def scenario():
+        await manager.create_pty("seen")
+        history = manager.pty_processes["seen"]["history"]
+        try:
+            await manager.connect(FakeWebSocket(), "seen", "host", True)
+            member = await manager.connect(FakeWebSocket(), "seen", "guest", False)
+            for command in ("echo ONE", "echo TWO"):
+                await manager.run_command("seen", command, "host")
+            await wait_for(lambda: len(history.entries) == 2)
+            first = history.entries[0][0]
+            # The second result was queued but never reached the client
+            assert manager.detach(member)
+
+            websocket = FakeWebSocket()
+            await manager.resume(websocket, "seen", member.token)
+            manager.send_history(member, first)
+            await wait_for(lambda: results(websocket))
+            return results(websocket)
+        finally:
+            await close_pty(manager, "seen")
+
+    assert asyncio.run(scenario()) == ["echo TWO"]
+
+
+def test_detached_member_keeps_the_shell(manager):
+    async def scenario():
+        await manager.create_pty("kept")
+        try:
+            host = await manager.connect(FakeWebSocket(), "kept", "host", True)
+            assert manager.detach(host)
+            assert host.detached
+            assert "kept" in manager.pty_processes
+            websocket = FakeWebSocket()
+            assert await manager.resume(websocket, "kept", host.token) is host
+            assert not host.detached and host.ws is websocket
+            # An unknown token, or another session's, resumes nothing
+            assert await manager.resume(FakeWebSocket(), "kept", "nope") is None
+            assert await manager.resume(FakeWebSocket(), "other", host.token) is None
+        finally:
+            await close_pty(manager, "kept")
+
+    asyncio.run(scenario())
+
+
+def test_streaming_member_gets_missed_output(manager):
+    async def scenario():
+        await manager.create_pty("frames")
+        pty_session = manager.pty_processes["frames"]
+        try:
+            member = await manager.connect(FakeWebSocket(), "frames", "host", True, stream=True, protocol="binary")
+            await manager.write_input("frames", b"echo BEFORE_$((1 + 1))\r")
+            await wait_for(lambda: b"BEFORE_2" in pty_session["scrollback"].getvalue())
+            await asyncio.sleep(0.1)
+            last_seq = pty_session["seq"] - 1
+
+            assert manager.detach(member)
+            await manager.write_input("frames", b"echo AWAY_$((2 + 2))\r")
+            await wait_for(lambda: b"AWAY_4" in pty_session["scrollback"].getvalue())
+
+            websocket = FakeWebSocket()
+            await manager.resume(websocket, "frames", member.token)
+            assert manager.send_missing(member, last_seq)
+            await wait_for(lambda: websocket.sent)
+            frame_type, _, payload = server.unpack_frame(websocket.sent[0])
+            return frame_type, payload
+        finally:
+            await close_pty(manager, "frames")
+
+    frame_type, payload = asyncio.run(scenario())
+    assert frame_type == server.FRAME_RESUME
+    assert b"AWAY_4" in payload and b"BEFORE_2" not in payload
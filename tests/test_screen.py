@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+import bus
+import server
+from screen import Screen
+
+from .conftest import FakeWebSocket, close_pty, wait_for
+
+
+def replayed(screen: Screen) -> Screen:
+    copy = Screen(screen.cols, screen.rows)
+    copy.feed(screen.snapshot())
+    return copy
+
+
+def assert_same(a: Screen, b: Screen):
+    assert a.text() == b.text()
+    assert a.attrs == b.attrs
+    assert (a.x, a.y) == (b.x, b.y)
+    assert (a.top, a.bottom) == (b.top, b.bottom)
+    assert a.cursor_visible == b.cursor_visible
+
+
+def test_text_and_cursor():
+    screen = Screen(20, 4)
+    screen.feed("hello\r\nworld\x1b[2;3Hx")
+    assert screen.text().split("\n") == ["hello", "woxld", "", ""]
+    assert (screen.x, screen.y) == (3, 1)
+
+
+def test_snapshot_round_trip():
+    screen = Screen(20, 5)
+    screen.feed("\x1b[1;31mred\x1b[0m plain\r\n\x1b[44mblue bg\x1b[0m\r\n")
+    screen.feed("\x1b[2;4r\x1b[?25l\x1b[3;7H")
+    snapshot = screen.snapshot()
+    assert snapshot.startswith("\x1bc")
+    assert_same(screen, replayed(screen))
+
+
+def test_scrolling_round_trip():
+    screen = Screen(10, 3)
+    screen.feed("".join(f"line {n}\r\n" for n in range(10)))
+    assert screen.text().splitlines()[:2] == ["line 8", "line 9"]
+    assert_same(screen, replayed(screen))
+
+
+def test_alternate_screen_round_trip():
+    screen = Screen(20, 4)
+    screen.feed("shell$ ")
+    screen.feed("\x1b[?1049h\x1b[Hfull screen app")
+    copy = replayed(screen)
+    assert copy.text().startswith("full screen app")
+    assert copy.saved_lines is not None
+    assert_same(screen, copy)
+    # Only the visible screen is sent; the main screen comes back on exit
+    screen.feed("\x1b[?1049l")
+    assert screen.text().startswith("shell$")
+
+
+def test_sequence_split_across_feeds():
+    screen = Screen(20, 2)
+    screen.feed("a\x1b[3")
+    screen.feed("1mb")
+    assert screen.text() == "ab\n"
+    assert screen.attrs[0][1] != screen.attrs[0][0]
+
+
+def test_resize_keeps_cursor_line():
+    screen = Screen(10, 5)
+    screen.feed("1\r\n2\r\n3\r\n4\r\n5")
+    screen.resize(6, 3)
+    assert screen.text().split("\n") == ["3", "4", "5"]
+    assert (screen.x, screen.y) == (1, 2)
+    screen.resize(12, 4)
+    assert screen.text().split("\n") == ["3", "4", "5", ""]
+    screen.feed("\x1b[4;1Hwide enough!")
+    assert screen.text().split("\n")[3] == "wide enough!"
+    assert_same(screen, replayed(screen))
+
+
+def test_resize_truncates_lines():
+    screen = Screen(10, 2)
+    screen.feed("0123456789")
+    screen.resize(4, 2)
+    assert screen.text().splitlines()[0] == "0123"
+    assert screen.x == 3
+    assert_same(screen, replayed(screen))
+
+
+def test_model_is_kept_for_streaming_members(shell_home, monkeypatch):
+    monkeypatch.setattr(server, "JOIN_REPLAY", "snapshot")
+
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("screen")
+        pty_session = manager.pty_processes["screen"]
+        try:
+            # Keeps the session open once the viewer leaves
+            await manager.connect(FakeWebSocket(), "screen", "host", True)
+            await manager.write_input("screen", b"echo BEFORE_$((40 + 2))\r")
+            await wait_for(lambda: b"BEFORE_42" in pty_session["scrollback"].getvalue())
+            # Nobody streams, so nothing is parsed
+            assert pty_session["screen"] is None
+
+            websocket = FakeWebSocket()
+            member = await manager.connect(websocket, "screen", "viewer", False, stream=True)
+            manager.send_replay(member)
+            await wait_for(lambda: websocket.sent)
+            snapshot = websocket.sent[0]
+            assert snapshot["type"] == "snapshot"
+            assert "BEFORE_42" in snapshot["data"]
+            assert snapshot["seq"] == pty_session["seq"]
+
+            await manager.write_input("screen", b"echo AFTER_$((40 + 2))\r")
+            await wait_for(lambda: "AFTER_42" in pty_session["screen"].text())
+
+            manager.disconnect(member)
+            await manager.write_input("screen", b"echo GONE\r")
+            await wait_for(lambda: pty_session["screen"] is None)
+        finally:
+            await close_pty(manager, "screen")
+
+    asyncio.run(scenario())
+
+
+def test_parsing_is_charged(shell_home, monkeypatch):
+    async def scenario():
+        manager = server.ConnectionManager(bus.InProcessBus(), "w1")
+        await manager.create_pty("charged")
+        pty_session = manager.pty_processes["charged"]
+        try:
+            limiter = pty_session["limiter"]
+            before = limiter.tokens
+            manager._charge_output("charged", pty_session, seconds=0.01)
+            # 10 ms of parsing costs what 10 ms of output at the session's rate would
+            assert before - limiter.tokens == pytest.approx(0.01 * limiter.rate, rel=0.05)
+        finally:
+            await close_pty(manager, "charged")
+
+    asyncio.run(scenario())
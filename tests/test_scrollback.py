@@ -0,0 +1,86 @@
+import json
+
+from server import CommandHistory, ScrollbackBuffer
+
+
+def test_ring_keeps_last_bytes():
+    buffer = ScrollbackBuffer(8)
+    buffer.write(b"abcde")
+    assert buffer.getvalue() == b"abcde"
+    buffer.write(b"fghij")
+    assert buffer.getvalue() == b"cdefghij"
+    buffer.write(b"klm")
+    assert buffer.getvalue() == b"fghijklm"
+    buffer.write(b"0123456789")
+    assert buffer.getvalue() == b"23456789"
+    assert len(buffer) == 8
+    assert buffer.total == 23
+
+
+def test_since_replays_missed_frames():
+    buffer = ScrollbackBuffer(64)
+    for seq, data in enumerate([b"one ", b"two ", b"three "], 1):
+        buffer.write_frame(seq, data)
+    assert buffer.since(1) == b"one two three "
+    assert buffer.since(2) == b"two three "
+    assert buffer.since(3) == b"three "
+    assert buffer.since(4) is None
+    assert buffer.since(0) is None
+
+
+def test_evicted_frames_are_forgotten():
+    buffer = ScrollbackBuffer(10)
+    for seq in range(1, 6):
+        buffer.write_frame(seq, b"%d" % seq * 3)  # 15 bytes in all
+    # Frames 1 and 2 start before the oldest byte still held
+    assert buffer.since(2) is None
+    assert buffer.since(3) == b"333444555"
+    assert buffer.since(5) == b"555"
+
+
+def test_partly_evicted_frame_is_forgotten():
+    buffer = ScrollbackBuffer(10)
+    buffer.write_frame(1, b"aaaaaa")
+    buffer.write_frame(2, b"bbbbbb")
+    assert buffer.since(1) is None
+    assert buffer.since(2) == b"bbbbbb"
+
+
+def test_gap_in_sequence_resets_index():
+    buffer = ScrollbackBuffer(64)
+    buffer.write_frame(1, b"one ")
+    buffer.write_frame(2, b"two ")
+    buffer.write_frame(5, b"five ")
+    assert buffer.since(1) is None
+    assert buffer.since(5) == b"five "
+    assert buffer.getvalue() == b"one two five "
+
+
+def result(command_id, output):
+    return {"type": "terminal_output", "id": command_id, "command": "cmd", "output": output,
+            "username": "host", "exit_code": 0, "status": "completed"}
+
+
+def test_history_is_capped_by_size():
+    history = CommandHistory(1000)
+    for command_id in range(1, 11):
+        history.append(result(command_id, "x" * 200))
+    assert history.size <= 1000
+    assert history.size == sum(len(payload) for payload in history)
+    kept = [json.loads(payload)["id"] for payload in history]
+    assert kept == list(range(11 - len(kept), 11))
+    assert len(kept) == 3
+
+
+def test_oversized_result_keeps_its_end():
+    history = CommandHistory(1000)
+    history.append(result(1, "small"))
+    history.append(result(2, "a" * 5000 + "THE END"))
+    assert [json.loads(payload)["id"] for payload in history] == [2]
+    message = json.loads(next(iter(history)))
+    assert message["truncated"]
+    assert message["output"].endswith("THE END")
+    assert history.size <= 1000
+    # Escaped characters count at their encoded size
+    history.append(result(3, "\x1b" * 5000))
+    assert history.size <= 1000
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import sessions
+from backend_bench import InMemoryCollection
+from sessions import SessionStore
+
+from .conftest import wait_for
+
+
+class CountingCollection(InMemoryCollection):
+    def __init__(self):
+        super().__init__()
+        self.finds = 0
+        self.bulk_writes = 0
+        self.failures = 0  # bulk_writes left to fail
+
+    async def find_one(self, query, projection=None):
+        self.finds += 1
+        await asyncio.sleep(0.01)
+        return await super().find_one(query, projection)
+
+    async def bulk_write(self, requests, ordered=True):
+        self.bulk_writes += 1
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("primary stepped down")
+        await super().bulk_write(requests, ordered)
+
+
+@pytest.fixture
+def collection():
+    return CountingCollection()
+
+
+@pytest.fixture
+def store(collection, monkeypatch):
+    monkeypatch.setattr(sessions, "FLUSH_INTERVAL", 0.01)
+    return SessionStore(lambda: collection)
+
+
+def test_lookups_are_cached(store, collection):
+    async def scenario():
+        await store.insert({"session_id": "s1", "active": True})
+        assert await store.get("s1") == {"session_id": "s1", "active": True}
+        assert collection.finds == 0
+        # Concurrent misses share one query, and the miss is remembered
+        assert await asyncio.gather(*[store.get("nope") for _ in range(5)]) == [None] * 5
+        assert collection.finds == 1
+        assert await store.get("nope") is None
+        assert collection.finds == 1
+
+    asyncio.run(scenario())
+
+
+def test_entries_expire(store, collection, monkeypatch):
+    monkeypatch.setattr(sessions, "CACHE_TTL", 0.0)
+    monkeypatch.setattr(sessions, "NEGATIVE_TTL", 0.0)
+
+    async def scenario():
+        await store.insert({"session_id": "s1", "active": True})
+        await store.get("s1")
+        await store.get("s1")
+        await store.get("nope")
+        await store.get("nope")
+        assert collection.finds == 4
+
+    asyncio.run(scenario())
+
+
+def test_updates_are_written_behind(store, collection):
+    async def scenario():
+        await store.insert({"session_id": "s1", "active": True, "members": 0})
+        store.update("s1", members=1)
+        store.update("s1", members=2, active=False)
+        store.touch("s1")
+        # The cache shows the change before it reaches the database
+        assert (await store.get("s1"))["members"] == 2
+        assert collection.docs[0]["members"] == 0
+        await wait_for(lambda: collection.bulk_writes)
+        assert collection.bulk_writes == 1
+        doc = collection.docs[0]
+        assert (doc["members"], doc["active"]) == (2, False)
+        assert "last_activity" in doc
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_is_retried(store, collection):
+    async def scenario():
+        await store.insert({"session_id": "s1", "members": 0})
+        await store.insert({"session_id": "s2", "members": 0})
+        collection.failures = 1
+        store.update("s1", members=1)
+        store.update("s2", members=1)
+        await wait_for(lambda: collection.bulk_writes == 1)
+        # Queued after the failure, so it wins over the retried value
+        store.update("s1", members=5)
+        await wait_for(lambda: collection.bulk_writes == 2 and store.flusher is None)
+        assert [doc["members"] for doc in collection.docs] == [5, 1]
+        assert not store.pending
+
+    asyncio.run(scenario())
+
+
+def test_close_flushes(store, collection, monkeypatch):
+    monkeypatch.setattr(sessions, "FLUSH_INTERVAL", 60)
+
+    async def scenario():
+        await store.insert({"session_id": "s1", "members": 0})
+        store.update("s1", members=3)
+        await store.close()
+        assert collection.docs[0]["members"] == 3
+        assert store.flusher is None
+
+    asyncio.run(scenario())